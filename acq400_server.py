@@ -0,0 +1,435 @@
+"""
+Local emulator of the ACQ400 data port, streaming muxed records over TCP.
+
+    python acq400_server.py                    # serves the muxed file
+    python acq400_server.py --live             # muxes the records as it goes
+    python acq400_server.py --check 4 --duration 10 --rate-hz 200000 --loop
+
+Every client connecting to processing.emulator_port receives the records
+from the first one on, paced at sampling.rate_hz records per second in
+bursts of processing.emulator_burst_records, like the stream of a live box.
+Records of a file are sent with loop.sendfile(), zero-copy from the page
+cache where the OS supports it; live records are muxed burst by burst from
+the scan path (see pipeline.run_direct()) in a worker thread and written
+from a memoryview of the record array.
+
+A client that falls behind by more than processing.emulator_fifo_bursts
+bursts loses the bursts in between, as the FIFO of a real box would
+overflow, and they are counted as dropped. Bursts sent more than a burst
+period after they were due are counted as late. When a client disconnects
+its achieved rate, its jitter (standard deviation of the send time about the
+due time) and its late and dropped bursts are printed; --check runs local
+test clients against the server and reports what they received.
+"""
+
+import argparse
+import asyncio
+import math
+import os
+import time
+
+import numpy as np
+
+import bfield_engine
+import pipeline
+import scan_path
+import sensor_head
+import write_muxed_data
+from config import PROCESSING, SAMPLING
+
+
+class FileRecords:
+    """Records of a muxed .bin file, sent without copying them.
+
+    Args:
+        filename (str): muxed file
+        record_bytes (int): size of one record
+    """
+
+    def __init__(self, filename, record_bytes):
+        self.filename = filename
+        self.record_bytes = record_bytes
+        self.n_records = os.path.getsize(filename) // record_bytes
+        if self.n_records == 0:
+            raise ValueError(f"{filename} holds no complete {record_bytes} byte record")
+        self.data = np.memmap(filename, dtype=np.uint8, mode="r")
+
+    def open(self):
+        """Per-client handle, sendfile() moves the file position"""
+        return open(self.filename, "rb")
+
+    async def send(self, handle, writer, start, n, zero_copy=True):
+        """Sends records [start, start + n)"""
+        a, b = start * self.record_bytes, (start + n) * self.record_bytes
+        if zero_copy:
+            await asyncio.get_running_loop().sendfile(
+                writer.transport, handle, a, b - a
+            )
+        else:
+            writer.write(memoryview(self.data)[a:b])
+            await writer.drain()
+
+
+class LiveRecords:
+    """Records muxed burst by burst from the field of the sensor head.
+
+    Args:
+        dtype (np.dtype): record layout, see write_muxed_data.output_layouts()
+        chunk_samples (int): observer positions per getB() call of the gain
+            pre-pass, defaults to processing.chunk_samples in config.yml
+        cache (bool): take the gains from the run cache, defaults to
+            processing.run_cache
+    """
+
+    def __init__(self, dtype, chunk_samples=None, cache=None):
+        if chunk_samples is None:
+            chunk_samples = PROCESSING["chunk_samples"]
+        if cache is None:
+            cache = PROCESSING["run_cache"]
+        self.dtype = dtype
+        self.record_bytes = dtype.itemsize
+        self.points = scan_path.build_scan_path()
+        self.n_records = write_muxed_data.configured_records()
+        if self.n_records > len(self.points):
+            raise ValueError(
+                f"the path holds {len(self.points)} samples, {self.n_records} needed"
+            )
+        self.offsets, self.rotations = pipeline.record_sensors()
+        self.source = bfield_engine.create_source()
+        self.gains = pipeline.direct_gains(
+            self.source,
+            self.points,
+            self.n_records,
+            self.offsets,
+            self.rotations,
+            max(chunk_samples // len(self.offsets), 1),
+            cache,
+        )
+
+    def open(self):
+        return None
+
+    def records(self, start, n):
+        """Bytes of records [start, start + n)"""
+        positions = self.points.positions(start, start + n)
+        B = sensor_head.compute_sensor_head(
+            self.source, positions, self.offsets, self.rotations
+        )
+        result = write_muxed_data.mux_records(
+            self.dtype,
+            [B[:, sensor] for sensor in range(B.shape[1])],
+            self.gains,
+            positions,
+            start,
+            start + n,
+            self.n_records,
+        )
+        return memoryview(result.view(np.uint8))
+
+    async def send(self, handle, writer, start, n, zero_copy=True):
+        """Sends records [start, start + n), muxed in a worker thread"""
+        loop = asyncio.get_running_loop()
+        writer.write(await loop.run_in_executor(None, self.records, start, n))
+        await writer.drain()
+
+
+class ClientStats:
+    """Pacing statistics of one client's stream"""
+
+    def __init__(self, peer, period):
+        self.peer = peer
+        self.period = period
+        self.records = 0
+        self.bytes = 0
+        self.bursts = 0
+        self.late = 0
+        self.dropped = 0
+        self.lag_sum = 0.0
+        self.lag_squares = 0.0
+        self.lag_max = 0.0
+        self.start = time.time()
+        self.stop = None
+
+    def sent(self, records, n_bytes, lag):
+        """Accounts for a burst sent lag seconds after it was due"""
+        self.records += records
+        self.bytes += n_bytes
+        self.bursts += 1
+        self.lag_sum += lag
+        self.lag_squares += lag * lag
+        self.lag_max = max(self.lag_max, lag)
+        if lag > self.period:
+            self.late += 1
+
+    @property
+    def elapsed(self):
+        return (self.stop or time.time()) - self.start
+
+    @property
+    def jitter(self):
+        """Standard deviation of the send times about the due times"""
+        if not self.bursts:
+            return 0.0
+        mean = self.lag_sum / self.bursts
+        return math.sqrt(max(self.lag_squares / self.bursts - mean * mean, 0.0))
+
+    def report(self, rate_hz):
+        seconds = max(self.elapsed, 1e-9)
+        return (
+            f"{self.peer}: {self.records:,} records in {seconds:.2f} s, "
+            f"{self.records / seconds:,.0f} samples/s of {rate_hz:,.0f} "
+            f"({self.bytes / 1e6 / seconds:,.1f} MB/s), jitter "
+            f"{self.jitter * 1e3:.2f} ms (max lag {self.lag_max * 1e3:.2f} ms), "
+            f"{self.late:,} late and {self.dropped:,} dropped of "
+            f"{self.bursts + self.dropped:,} bursts"
+        )
+
+
+class DataPortEmulator:
+    """asyncio server pacing records to every connected client.
+
+    Args:
+        records: FileRecords or LiveRecords
+        rate_hz (float): records per second, defaults to sampling.rate_hz in
+            config.yml
+        burst_records (int): records per burst, defaults to
+            processing.emulator_burst_records
+        fifo_bursts (int): bursts a client may fall behind before they are
+            dropped, defaults to processing.emulator_fifo_bursts
+        loop (bool): start over at the end of the records instead of
+            closing the connection
+        zero_copy (bool): send file records with sendfile()
+    """
+
+    def __init__(
+        self,
+        records,
+        rate_hz=None,
+        burst_records=None,
+        fifo_bursts=None,
+        loop=False,
+        zero_copy=True,
+    ):
+        if rate_hz is None:
+            rate_hz = SAMPLING["rate_hz"]
+        if burst_records is None:
+            burst_records = PROCESSING["emulator_burst_records"]
+        if fifo_bursts is None:
+            fifo_bursts = PROCESSING["emulator_fifo_bursts"]
+        self.records = records
+        self.rate_hz = rate_hz
+        self.burst_records = burst_records
+        self.fifo_bursts = fifo_bursts
+        self.loop = loop
+        self.zero_copy = zero_copy
+        self.period = burst_records / rate_hz
+        self.clients = []
+
+    async def _send(self, handle, writer, record, count):
+        """Sends count records from record on, wrapping at the end"""
+        n = self.records.n_records
+        a = record % n
+        first = min(count, n - a)
+        await self.records.send(handle, writer, a, first, self.zero_copy)
+        if count > first:
+            await self._send(handle, writer, 0, count - first)
+
+    async def serve_client(self, reader, writer):
+        """Streams the records to one client until it disconnects or, unless
+        looping, the records run out"""
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info("peername")
+        stats = ClientStats(f"{peer[0]}:{peer[1]}" if peer else "client", self.period)
+        self.clients.append(stats)
+        handle = self.records.open()
+        n = self.records.n_records
+        record = burst = 0
+        start = loop.time()
+        try:
+            while self.loop or record < n:
+                due = start + burst * self.period
+                wait = due - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                lag = loop.time() - due
+                behind = int(lag / self.period)
+                if behind > self.fifo_bursts:
+                    # the FIFO of a real box overflows, those samples are lost
+                    stats.dropped += behind
+                    burst += behind
+                    record += behind * self.burst_records
+                    continue
+                count = (
+                    self.burst_records
+                    if self.loop
+                    else min(self.burst_records, n - record)
+                )
+                await self._send(handle, writer, record, count)
+                stats.sent(count, count * self.records.record_bytes, lag)
+                record += count
+                burst += 1
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            stats.stop = time.time()
+            if handle is not None:
+                handle.close()
+            writer.close()
+            print(stats.report(self.rate_hz))
+
+    async def start(self, host="127.0.0.1", port=None):
+        """Starts listening, returns the asyncio.Server"""
+        if port is None:
+            port = PROCESSING["emulator_port"]
+        server = await asyncio.start_server(self.serve_client, host, port)
+        port = server.sockets[0].getsockname()[1]
+        print(
+            f"ACQ400 data port emulator on {host}:{port}: {self.records.n_records:,} "
+            f"records of {self.records.record_bytes} bytes at {self.rate_hz:,.0f} "
+            f"samples/s ({self.rate_hz * self.records.record_bytes / 1e6:,.1f} MB/s) "
+            f"in bursts of {self.burst_records:,}"
+        )
+        return server
+
+    def summary(self):
+        """Totals over every client served"""
+        records = sum(c.records for c in self.clients)
+        late = sum(c.late for c in self.clients)
+        dropped = sum(c.dropped for c in self.clients)
+        return (
+            f"{len(self.clients)} clients, {records:,} records, "
+            f"{late:,} late and {dropped:,} dropped bursts"
+        )
+
+
+async def receive(host, port, duration_s, record_bytes):
+    """Test client: reads the stream for duration_s seconds.
+
+    Returns:
+        tuple: (bytes received, seconds, True if a whole number of records
+        arrived)
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    received = 0
+    start = time.time()
+    try:
+        while time.time() - start < duration_s:
+            try:
+                data = await asyncio.wait_for(reader.read(1 << 20), 1.0)
+            except asyncio.TimeoutError:
+                continue
+            if not data:
+                break
+            received += len(data)
+    finally:
+        seconds = time.time() - start
+        writer.close()
+    return received, seconds, received % record_bytes == 0
+
+
+async def main(args):
+    layouts = write_muxed_data.output_layouts()
+    with_position = next(iter(layouts))
+    if args.live:
+        records = LiveRecords(layouts[with_position], cache=args.cache)
+    else:
+        filename = args.filename or with_position
+        dtype = layouts.get(filename, layouts[with_position])
+        records = FileRecords(filename, dtype.itemsize)
+    emulator = DataPortEmulator(
+        records,
+        rate_hz=args.rate_hz,
+        burst_records=args.burst_records,
+        loop=args.loop,
+        zero_copy=args.zero_copy,
+    )
+    server = await emulator.start(args.host, args.port)
+    async with server:
+        if not args.check:
+            await server.serve_forever()
+            return
+        port = server.sockets[0].getsockname()[1]
+        results = await asyncio.gather(
+            *[
+                receive(args.host, port, args.duration, records.record_bytes)
+                for client in range(args.check)
+            ]
+        )
+        # let the server notice the disconnects and report them
+        await asyncio.sleep(2 * emulator.period + 0.1)
+    for client, (received, seconds, aligned) in enumerate(results):
+        print(
+            f"test client {client}: {received / records.record_bytes / seconds:,.0f} "
+            f"samples/s, {received / 1e6 / seconds:,.1f} MB/s"
+            f"{'' if aligned else ', NOT record aligned'}"
+        )
+    print(emulator.summary())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "filename",
+        nargs="?",
+        help="muxed file to serve, defaults to the with_position_ output",
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help="mux the records from the scan path as they are sent",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PROCESSING["emulator_port"],
+        help="TCP port, 0 picks a free one",
+    )
+    parser.add_argument(
+        "--rate-hz",
+        type=float,
+        default=SAMPLING["rate_hz"],
+        help="records per second sent to each client",
+    )
+    parser.add_argument(
+        "--burst-records",
+        type=int,
+        default=PROCESSING["emulator_burst_records"],
+        help="records per paced burst",
+    )
+    parser.add_argument(
+        "--loop",
+        action="store_true",
+        help="start over at the end of the records instead of disconnecting",
+    )
+    parser.add_argument(
+        "--no-zero-copy",
+        dest="zero_copy",
+        action="store_false",
+        help="write file records from a memoryview instead of sendfile()",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=PROCESSING["run_cache"],
+        help="with --live, take the gains from a pre-pass, not the run cache",
+    )
+    parser.add_argument(
+        "--check",
+        type=int,
+        default=0,
+        metavar="N",
+        help="run N local test clients for --duration seconds, then exit",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10.0,
+        help="seconds the --check clients read for",
+    )
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
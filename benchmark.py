@@ -0,0 +1,423 @@
+"""
+Benchmarks of every stage of the simulation at several scales.
+
+    python benchmark.py run                      # small and medium scales
+    python benchmark.py run --scale full --workdir /scratch/bench
+    python benchmark.py compare                  # latest run against the one before
+    python benchmark.py list
+
+Each scale is config.yml with the sample rate of SCALES and every output
+redirected into a scratch directory, with the run cache off. The stages
+
+    path     scan path positions, chunk by chunk
+    getB     field of the source along the path
+    offsets  every sensor of the head written to disk (offset_path_scan.py)
+    mux      ACQ400 records of the configured scan counts (write_muxed_data.py)
+    reader   data_reader.py loading the muxed file and scanning the sensors
+
+run in that order, each in a fresh process so its peak RSS is its own, and
+report samples/s, MB/s and peak RSS; the fastest of
+processing.benchmark_repeat runs is kept. Peak RSS counts the pages of the
+memory-mapped outputs touched, and the reader reads a file just written,
+from the page cache.
+
+Every run is appended to files.benchmark_history in config.yml, with the
+commit, host and library versions. compare flags stages of the latest run
+that are slower, or use more memory, than the previous run of the same scale
+by more than processing.benchmark_threshold, and exits with status 1 if any
+are. The speed of stages faster than processing.benchmark_min_seconds in
+either run is timer and scheduler noise, and is not compared. Nothing needs a
+network or a GPU.
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import yaml
+
+import bfield_engine
+import data_reader
+import scan_path
+import segment_dedup
+import sensor_head
+import write_muxed_data
+from config import CONFIG_FILE, FILES, PROCESSING
+
+# sample rate of each scale, None keeps that of config.yml
+SCALES = {"small": 100, "medium": 1000, "full": None}
+
+STAGES = ("path", "getB", "offsets", "mux", "reader")
+
+
+def scale_config(scale, workdir, base=None):
+    """Writes the config.yml of a scale, with every output in workdir.
+
+    Args:
+        scale (str): key of SCALES
+        workdir (str): scratch directory of the outputs
+        base (str): config file to start from, defaults to the one in use
+
+    Returns:
+        str: the config file written
+    """
+    if base is None:
+        base = CONFIG_FILE
+    with open(base) as fh:
+        config = yaml.safe_load(fh)
+    config = copy.deepcopy(config)
+    if SCALES[scale] is not None:
+        config["sampling"]["rate_hz"] = SCALES[scale]
+    files = config["files"]
+    prefix = files["output_dir"].rstrip("/") + "/"
+
+    def moved(filename):
+        if isinstance(filename, str) and filename.startswith(prefix):
+            return os.path.join(workdir, filename[len(prefix) :])
+        return filename
+
+    for key, value in files.items():
+        files[key] = (
+            [moved(f) for f in value] if isinstance(value, list) else moved(value)
+        )
+    files["output_dir"] = workdir
+    config["processing"].update(run_cache=False, resume=False)
+    filename = os.path.join(workdir, f"config_{scale}.yml")
+    with open(filename, "w") as fh:
+        yaml.safe_dump(config, fh, sort_keys=False)
+    return filename
+
+
+def run_stage(name):
+    """Runs one stage in this process, with the config of OCTOBEE_CONFIG.
+
+    Returns:
+        dict: samples processed and bytes produced or moved
+    """
+    chunk_samples = PROCESSING["chunk_samples"]
+    points = scan_path.build_scan_path()
+    if name == "path":
+        n_bytes = 0
+        for start, stop, positions in points.iter_chunks(chunk_samples):
+            n_bytes += positions.nbytes
+        return {"samples": len(points), "bytes": n_bytes}
+    if name == "getB":
+        source = bfield_engine.create_source()
+        n_bytes = 0
+        for start, stop, positions in points.iter_chunks(chunk_samples):
+            n_bytes += source.getB(positions).nbytes
+        return {"samples": len(points), "bytes": n_bytes}
+    if name == "offsets":
+        source = bfield_engine.create_source()
+        offsets = sensor_head.sensor_offsets()
+        rotations = sensor_head.sensor_rotations()
+        filenames = sensor_head.output_filenames(offsets, FILES["output_dir"])
+        if PROCESSING["dedup_segments"]:
+            segment_dedup.compute_sensor_head_dedup(
+                source, points, filenames, offsets, rotations
+            )
+        else:
+            sensor_head.compute_sensor_head_chunked(
+                source, points, filenames, offsets, rotations
+            )
+        return {
+            "samples": len(points) * len(offsets),
+            "bytes": sum(os.path.getsize(f) for f in filenames),
+        }
+    if name == "mux":
+        n_records = write_muxed_data.configured_records()
+        stats = write_muxed_data.write_muxed_files(
+            FILES["input_list"],
+            points,
+            n_records,
+            write_muxed_data.output_layouts(),
+        )
+        return {
+            "samples": n_records,
+            "bytes": stats["read_bytes"] + stats["write_bytes"],
+        }
+    if name == "reader":
+        layouts = write_muxed_data.output_layouts()
+        filename = next(iter(layouts))
+        data = data_reader.raw_binary_file_to_array(filename, layouts[filename])
+        np.abs(data_reader.sensor_view(data)).max(axis=0)
+        return {"samples": len(data), "bytes": data.nbytes}
+    raise ValueError(f"unknown stage {name}, expected one of {', '.join(STAGES)}")
+
+
+def measure(name, config_file, repeat=None):
+    """Runs a stage in a fresh process with config_file, keeping the fastest
+    of repeat runs.
+
+    Args:
+        name (str): stage, see STAGES
+        config_file (str): config of the scale, see scale_config()
+        repeat (int): runs of the stage, defaults to
+            processing.benchmark_repeat in config.yml
+
+    Returns:
+        dict: samples, bytes, seconds, samples/s, MB/s and peak RSS in MB,
+        or the error of a failed stage
+    """
+    if repeat is None:
+        repeat = PROCESSING["benchmark_repeat"]
+    env = dict(os.environ, OCTOBEE_CONFIG=config_file)
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for i in range(repeat):
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "stage", name],
+            env=env,
+            cwd=here,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            return {"error": result.stderr.strip().splitlines()[-1:] or ["failed"]}
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    stats = min(runs, key=lambda run: run["seconds"])
+    stats["repeat"] = repeat
+    seconds = max(stats["seconds"], 1e-9)
+    stats["samples_per_s"] = stats["samples"] / seconds
+    stats["mb_per_s"] = stats["bytes"] / 1e6 / seconds
+    return stats
+
+
+def _commit():
+    """Short hash of the checked out commit, None outside a git checkout"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def load_history(filename=None):
+    """Benchmark runs recorded so far, oldest first"""
+    if filename is None:
+        filename = FILES["benchmark_history"]
+    try:
+        with open(filename) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return []
+
+
+def save_history(history, filename=None):
+    if filename is None:
+        filename = FILES["benchmark_history"]
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    tmp = f"{filename}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(history, fh, indent=2)
+    os.replace(tmp, filename)
+
+
+def run(
+    scales, stages=STAGES, workdir=None, keep=False, history_file=None, repeat=None
+):
+    """Benchmarks the stages at every scale and appends the runs to the
+    history.
+
+    Args:
+        scales (list): keys of SCALES
+        stages (list): stages to run, later stages need the outputs of
+            earlier ones
+        workdir (str): scratch directory, a temporary one by default
+        keep (bool): leave the outputs in workdir
+        repeat (int): runs of every stage, the fastest is kept
+        history_file (str): defaults to files.benchmark_history in config.yml
+
+    Returns:
+        list: the new history entries
+    """
+    root = workdir or tempfile.mkdtemp(prefix="octobee_bench_")
+    entries = []
+    try:
+        for scale in scales:
+            directory = os.path.join(root, scale)
+            os.makedirs(directory, exist_ok=True)
+            config_file = scale_config(scale, directory)
+            entry = {
+                "time": datetime.datetime.now().isoformat(timespec="seconds"),
+                "commit": _commit(),
+                "host": platform.node(),
+                "cpus": os.cpu_count(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "scale": scale,
+                "stages": {},
+            }
+            print(f"{scale} scale:")
+            for name in stages:
+                stats = measure(name, config_file, repeat)
+                entry["stages"][name] = stats
+                print(format_stage(name, stats))
+            entries.append(entry)
+            if not keep:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        if not keep and workdir is None:
+            shutil.rmtree(root, ignore_errors=True)
+    history = load_history(history_file)
+    save_history(history + entries, history_file)
+    return entries
+
+
+def format_stage(name, stats):
+    if "error" in stats:
+        return f"  {name:8s} FAILED: {' '.join(stats['error'])}"
+    return (
+        f"  {name:8s} {stats['samples']:14,d} samples {stats['seconds']:8.2f} s "
+        f"{stats['samples_per_s']:14,.0f} samples/s {stats['mb_per_s']:9,.1f} MB/s "
+        f"{stats['peak_rss_mb']:8,.0f} MB peak RSS"
+    )
+
+
+def compare(latest, baseline, threshold=None, min_seconds=None):
+    """Stages of latest that regressed against baseline.
+
+    A stage regresses if its samples/s dropped, or its peak RSS grew, by more
+    than threshold, a fraction defaulting to processing.benchmark_threshold.
+    The samples/s of a stage that took less than min_seconds, defaulting to
+    processing.benchmark_min_seconds, in either run are not compared.
+
+    Returns:
+        list: (stage, metric, baseline value, latest value) of every
+        regression
+    """
+    if threshold is None:
+        threshold = PROCESSING["benchmark_threshold"]
+    if min_seconds is None:
+        min_seconds = PROCESSING["benchmark_min_seconds"]
+    regressions = []
+    for name, stats in latest["stages"].items():
+        before = baseline["stages"].get(name)
+        if before is None or "error" in before:
+            continue
+        if "error" in stats:
+            regressions.append((name, "error", None, stats["error"]))
+            continue
+        timed = min(stats["seconds"], before["seconds"]) >= min_seconds
+        if timed and stats["samples_per_s"] < (1 - threshold) * before["samples_per_s"]:
+            regressions.append(
+                (name, "samples_per_s", before["samples_per_s"], stats["samples_per_s"])
+            )
+        if stats["peak_rss_mb"] > (1 + threshold) * before["peak_rss_mb"]:
+            regressions.append(
+                (name, "peak_rss_mb", before["peak_rss_mb"], stats["peak_rss_mb"])
+            )
+    return regressions
+
+
+def print_comparison(latest, baseline, regressions, min_seconds=None):
+    if min_seconds is None:
+        min_seconds = PROCESSING["benchmark_min_seconds"]
+    print(
+        f"{latest['scale']} scale: {latest['time']} ({latest['commit']}) against "
+        f"{baseline['time']} ({baseline['commit']})"
+    )
+    for name, stats in latest["stages"].items():
+        before = baseline["stages"].get(name)
+        if before is None or "error" in before or "error" in stats:
+            print(format_stage(name, stats))
+            continue
+        speed = stats["samples_per_s"] / before["samples_per_s"]
+        memory = stats["peak_rss_mb"] / before["peak_rss_mb"]
+        flags = [metric for stage, metric, a, b in regressions if stage == name]
+        short = min(stats["seconds"], before["seconds"]) < min_seconds
+        print(
+            f"  {name:8s} {speed:6.2f}x samples/s {memory:6.2f}x peak RSS"
+            f"{'  (too short to compare speed)' if short else ''}"
+            f"{'  REGRESSION' if flags else ''}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="benchmark the stages")
+    run_parser.add_argument(
+        "--scale",
+        nargs="+",
+        choices=list(SCALES),
+        default=["small", "medium"],
+        help="scales to run, full needs the disk space of a full simulation",
+    )
+    run_parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    run_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=PROCESSING["benchmark_repeat"],
+        help="runs of every stage, the fastest is kept",
+    )
+    run_parser.add_argument("--workdir", help="scratch directory for the outputs")
+    run_parser.add_argument(
+        "--keep", action="store_true", help="leave the outputs in the workdir"
+    )
+    compare_parser = commands.add_parser(
+        "compare", help="flag regressions of the latest run of every scale"
+    )
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=PROCESSING["benchmark_threshold"],
+        help="fractional slowdown or memory growth flagged as a regression",
+    )
+    compare_parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=PROCESSING["benchmark_min_seconds"],
+        help="stages faster than this in either run are not compared for speed",
+    )
+    commands.add_parser("list", help="list the recorded runs")
+    stage_parser = commands.add_parser(
+        "stage", help="run one stage in this process and print its statistics"
+    )
+    stage_parser.add_argument("name", choices=STAGES)
+    args = parser.parse_args()
+
+    if args.command == "stage":
+        start = time.perf_counter()
+        stats = run_stage(args.name)
+        stats["seconds"] = time.perf_counter() - start
+        # ru_maxrss is in kB on Linux
+        stats["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+        print(json.dumps(stats))
+    elif args.command == "run":
+        run(args.scale, args.stages, args.workdir, args.keep, repeat=args.repeat)
+    elif args.command == "list":
+        for entry in load_history():
+            print(f"{entry['time']} {entry['commit']} {entry['scale']}:")
+            for name, stats in entry["stages"].items():
+                print(format_stage(name, stats))
+    else:
+        history = load_history()
+        failed = False
+        for scale in SCALES:
+            runs = [entry for entry in history if entry["scale"] == scale]
+            if len(runs) < 2:
+                continue
+            regressions = compare(runs[-1], runs[-2], args.threshold, args.min_seconds)
+            print_comparison(runs[-1], runs[-2], regressions, args.min_seconds)
+            failed = failed or bool(regressions)
+        if not history:
+            print(f"no benchmark runs in {FILES['benchmark_history']}")
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,221 @@
+"""
+Chunk-level progress journal, to resume long running stages after a crash.
+
+The B-field stages write into outputs that are preallocated before any value
+is computed, and the muxer appends its records in order. A Journal records
+which sample ranges of a set of outputs are complete in a small JSON state
+file, <root>.journal.json, next to the first of them:
+
+    {"key": ..., "files": [[name, inode], ...], "done": [[0, 4000000]],
+     "errors": [...]}
+
+The outputs are flushed before the ranges written into them are recorded and
+the journal is replaced atomically, at most every
+processing.checkpoint_interval_s seconds. It is removed once the stage has
+finished. A stage restarted with the same key reopens the outputs instead of
+recreating them, skips the chunks already done and carries on from the first
+incomplete one.
+
+Statistics sidecars (field_stats.py) of the skipped chunks are rebuilt by
+reading them back with the same chunking and the quantisation errors are
+restored from the journal, so a resumed run writes exactly the files and
+sidecars of an uninterrupted one. With --workers the B-field files are still
+identical, but the block means of the statistics may differ in the last bit:
+their partial sums are grouped by shard, which a resumed run lays out over
+the remaining ranges only.
+
+A journal is only trusted if its key matches and every output is still the
+file it was written into; an output that has been linked into the run cache
+(run_cache.py) since is never written into.
+"""
+
+import json
+import os
+import time
+
+import storage
+from config import PROCESSING
+
+
+def journal_filename(filename):
+    """Journal of the outputs whose first file is filename"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.journal.json"
+
+
+def discard(filenames):
+    """Removes the journal of filenames, the next run starts over"""
+    try:
+        os.remove(journal_filename(filenames[0]))
+    except FileNotFoundError:
+        pass
+
+
+def _merge(ranges):
+    """Sorted (start, stop) ranges with touching or overlapping ones joined"""
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+class Journal:
+    """Completed sample ranges of a set of outputs written together.
+
+    Use create() for freshly created outputs and load() to pick up the
+    journal of an interrupted run.
+
+    Args:
+        filenames (list): the outputs, the journal is kept next to the first
+        key: JSON-able identity of the run, including anything that changes
+            the values or the chunking
+        interval_s (float): seconds between journal updates, defaults to
+            processing.checkpoint_interval_s in config.yml
+    """
+
+    def __init__(self, filenames, key, interval_s=None):
+        if interval_s is None:
+            interval_s = PROCESSING["checkpoint_interval_s"]
+        self.filename = journal_filename(filenames[0])
+        self.filenames = list(filenames)
+        # as it reads back from JSON
+        self.key = json.loads(json.dumps(key))
+        self.interval_s = interval_s
+        self.files = [[f, os.stat(f).st_ino] for f in filenames]
+        self.done = []
+        self.errors = None
+        self._saved = time.time()
+
+    @classmethod
+    def create(cls, filenames, key, interval_s=None):
+        """Starts the journal of freshly created outputs"""
+        journal = cls(filenames, key, interval_s)
+        journal.save()
+        return journal
+
+    @classmethod
+    def load(cls, filenames, key, interval_s=None):
+        """The journal an interrupted run of key left for filenames.
+
+        Returns:
+            Journal or None: None if there is none, or it does not match the
+            run or the files on disk
+        """
+        try:
+            with open(journal_filename(filenames[0])) as fh:
+                state = json.load(fh)
+            journal = cls(filenames, key, interval_s)
+            links = [os.stat(f).st_nlink for f in filenames]
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get("key") != journal.key or state.get("files") != journal.files:
+            return None
+        if any(n != 1 for n in links):
+            # linked elsewhere, e.g. into the run cache
+            return None
+        journal.done = _merge(tuple(r) for r in state["done"])
+        journal.errors = state.get("errors")
+        return journal
+
+    @property
+    def samples_done(self):
+        """Number of samples recorded as complete"""
+        return sum(stop - start for start, stop in self.done)
+
+    def is_done(self, start, stop):
+        """True if samples [start, stop) are complete"""
+        return any(a <= start and stop <= b for a, b in self.done)
+
+    def missing(self, start, stop):
+        """(start, stop) ranges of samples [start, stop) not yet complete"""
+        gaps = []
+        for a, b in self.done:
+            if a > start:
+                gaps.append((start, min(a, stop)))
+            start = max(start, b)
+            if start >= stop:
+                break
+        if start < stop:
+            gaps.append((start, stop))
+        return gaps
+
+    def record(self, start, stop, outputs=(), errors=None):
+        """Marks samples [start, stop) complete, saving the journal if
+        processing.checkpoint_interval_s has passed since the last save.
+
+        Args:
+            start (int): first sample
+            stop (int): one past the last sample
+            outputs: objects with a flush() method, flushed before saving
+            errors (list): storage.QuantisationError of each output covering
+                every range recorded, defaults to the outputs' own
+        """
+        self.done = _merge(self.done + [(start, stop)])
+        if time.time() - self._saved >= self.interval_s:
+            self.save(outputs, errors)
+
+    def save(self, outputs=(), errors=None):
+        """Flushes the outputs and replaces the journal on disk"""
+        for output in outputs:
+            output.flush()
+        if errors is None:
+            errors = [output.error for output in outputs if hasattr(output, "error")]
+        if errors:
+            self.errors = [dict(vars(error)) for error in errors]
+        state = {
+            "key": self.key,
+            "files": self.files,
+            "done": self.done,
+            "errors": self.errors,
+        }
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump(state, fh)
+        os.replace(tmp, self.filename)
+        self._saved = time.time()
+
+    def restore_errors(self, errors):
+        """Sets QuantisationErrors to their state recorded in the journal"""
+        for error, state in zip(errors, self.errors or []):
+            vars(error).update(state)
+
+    def finish(self):
+        """Removes the journal of a completed run"""
+        discard(self.filenames)
+
+
+def restore_stats(stats, outputs, start, stop):
+    """Accounts for samples [start, stop) of a completed chunk in the
+    statistics of each output, reading them back as stored"""
+    for output_stats, output in zip(stats, outputs):
+        output_stats.update(start, output.read(start, stop))
+
+
+def open_outputs(filenames, create, key=None):
+    """Outputs of a stage and their journal, resuming an interrupted run.
+
+    Args:
+        filenames (list): output .npy files
+        create: callable creating fresh storage.OutputArray outputs
+        key: JSON-able identity of the run, None keeps no journal
+
+    Returns:
+        tuple: (list of storage.OutputArray, Journal or None)
+    """
+    if key is None:
+        return create(), None
+    journal = Journal.load(filenames, key)
+    if journal is None:
+        outputs = create()
+        return outputs, Journal.create(filenames, key)
+    outputs = [storage.OutputArray.open(filename) for filename in filenames]
+    journal.restore_errors([output.error for output in outputs])
+    more = f" and {len(filenames) - 1} more" if len(filenames) > 1 else ""
+    print(
+        f"Resuming {filenames[0]}{more}: "
+        f"{journal.samples_done:,} of {len(outputs[0]):,} samples already done"
+    )
+    return outputs, journal
@@ -1,10 +1,15 @@
+import os
+
 import yaml
 
+# python -m octobee run <config> selects the file through OCTOBEE_CONFIG
+CONFIG_FILE = os.environ.get("OCTOBEE_CONFIG", "config.yml")
+
 try:
-    with open("config.yml", "r") as file:
+    with open(CONFIG_FILE, "r") as file:
         config = yaml.safe_load(file)
 except FileNotFoundError:
-    print("Error: config.yml not found. Please create the file.")
+    print(f"Error: {CONFIG_FILE} not found. Please create the file.")
     exit()
 
 FILES = config["files"]
@@ -13,3 +18,4 @@ MOTION_PROFILE = config["motion_profile"]
 SIMULATION_OBJECTS = config["simulation_objects"]
 SAMPLING = config["sampling"]
 SCAN_SETUP = config["scan_setup"]
+PROCESSING = config["processing"]
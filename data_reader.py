@@ -22,11 +22,36 @@ SPAD3 = usr2
 SPAD4 = usr3
 
 uses a numpy structured array to define data and reads in
+
+sensor_view() and position_view() expose all sensor channels as one
+(n_samples, n_sensors, 4) int16 array and the positions as an (n_samples, 3)
+int32 array. Both are strided views over the same record buffer, so
+vectorised analysis across sensors needs no copy:
+
+    data = raw_binary_file_to_array(filename, acq400_dtype(8))
+    S = sensor_view(data)        # S[:, 2, 1] is data["S3Y"]
+    P = position_view(data)      # P[:, 0] is data["XPOS"]
+
+ACQ400Reader opens a file with np.memmap for random access by sample range,
+time range or position box without reading the rest of the file. When the
+muxer left a scan-structure index next to the file (binary_data.bin.index.npy)
+single sweeps and steps are found by plane and line:
+
+    reader = ACQ400Reader("data/with_position_binary_data.bin")
+    sweep = reader.read_segment(plane=12, line=3)
 """
 
-from data_writer import n_sensors_dtype_generator
+import os
+
+import re
+
+from data_writer import TICKS_PER_M, acq400_dtype, n_sensors_dtype_generator
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from config import SYSTEM_PARAMETERS
+import scan_path
+
+_SENSOR_FIELD = re.compile(r"S(\d+)X$")
 
 
 def raw_binary_file_to_array(filename, structured_array_dtype):
@@ -42,6 +67,176 @@ def raw_binary_file_to_array(filename, structured_array_dtype):
     return np.fromfile(filename, dtype=structured_array_dtype)
 
 
+def n_sensors_in(structured_array_dtype):
+    """Number of sensors in an ACQ400 record dtype"""
+    names = np.dtype(structured_array_dtype).names
+    return sum(1 for name in names if _SENSOR_FIELD.match(name))
+
+
+def _field_offset(dtype, name):
+    return dtype.fields[name][1]
+
+
+def sensor_view(data):
+    """Zero-copy (n_samples, n_sensors, 4) int16 view of the sensor channels.
+
+    The last axis is X, Y, Z, T. Writes through the view change data.
+
+    Args:
+        data (np.ndarray): 1D structured array of ACQ400 records, e.g. a
+            memmap of a binary file
+
+    Returns:
+        np.ndarray: view sharing memory with data
+    """
+    n_sensors = n_sensors_in(data.dtype)
+    first = _field_offset(data.dtype, "S1X")
+    for n in range(1, n_sensors + 1):
+        for c, axis in enumerate("XYZT"):
+            if _field_offset(data.dtype, f"S{n}{axis}") != first + 8 * (n - 1) + 2 * c:
+                raise ValueError("sensor channels are not packed S1X..SnT")
+    return as_strided(
+        data["S1X"],
+        shape=(len(data), n_sensors, 4),
+        strides=(data.strides[0], 8, 2),
+    )
+
+
+def position_view(data):
+    """Zero-copy (n_samples, 3) int32 view of the XPOS, YPOS, ZPOS fields.
+
+    Args:
+        data (np.ndarray): 1D structured array of ACQ400 records with
+            position included
+
+    Returns:
+        np.ndarray: view sharing memory with data
+    """
+    if "XPOS" not in data.dtype.names:
+        raise ValueError("records have no position fields")
+    first = _field_offset(data.dtype, "XPOS")
+    for c, name in enumerate(["XPOS", "YPOS", "ZPOS"]):
+        if _field_offset(data.dtype, name) != first + 4 * c:
+            raise ValueError("position fields are not packed XPOS, YPOS, ZPOS")
+    return as_strided(data["XPOS"], shape=(len(data), 3), strides=(data.strides[0], 4))
+
+
+class ACQ400Reader:
+    """Memory-mapped random access reader for ACQ400 binary files.
+
+    Nothing is read on opening; every query returns a memmap slice (or a
+    small copy for position boxes), so pulling one second out of a 50 GB
+    file touches only the pages of that second plus a few dozen records for
+    the binary search.
+
+    Args:
+        filename (str): binary file of ACQ400 records
+        n_sensors (int): sensors per record, defaults to
+            system_parameters.sensor_count in config.yml
+        position_included (bool): True if records carry XPOS, YPOS, ZPOS
+        index_filename (str): scan-structure index sidecar, defaults to
+            filename + ".index.npy" when that exists
+    """
+
+    def __init__(
+        self, filename, n_sensors=None, position_included=True, index_filename=None
+    ):
+        if n_sensors is None:
+            n_sensors = SYSTEM_PARAMETERS["sensor_count"]
+        self.filename = filename
+        self.dtype = acq400_dtype(n_sensors, position_included)
+        self.data = np.memmap(filename, dtype=self.dtype, mode="r")
+        if index_filename is None:
+            index_filename = scan_path.index_filename(filename)
+            if not os.path.exists(index_filename):
+                index_filename = None
+        self.index = None
+        if index_filename is not None:
+            self.index = scan_path.load_index(index_filename)
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, start, stop):
+        """Records [start, stop) as a zero-copy memmap slice"""
+        return self.data[start:stop]
+
+    def read_segment(self, plane, line, kind="y_sweep"):
+        """Records of one sweep or step, located with the index sidecar.
+
+        Args:
+            plane (int): X plane number, from 0
+            line (int): sweep or step number within the plane, from 0
+            kind (str): "y_sweep", "z_step" or "x_step"
+
+        Returns:
+            np.memmap: zero-copy slice of the segment's records
+        """
+        if self.index is None:
+            raise ValueError(f"no scan-structure index for {self.filename}")
+        start, stop = scan_path.find_segment(self.index, plane, line, kind)
+        return self.data[start:stop]
+
+    def _bisect(self, field, value):
+        """First record whose monotonic field is >= value, by binary search
+        on single records so the column is never read as a whole"""
+        lo, hi = 0, len(self.data)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.data[mid][field] < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read_time(self, t0_us, t1_us):
+        """Records with t0_us <= USEC < t1_us.
+
+        Args:
+            t0_us (int): start time in microseconds
+            t1_us (int): end time in microseconds
+
+        Returns:
+            np.memmap: zero-copy slice of the matching records
+        """
+        return self.data[self._bisect("USEC", t0_us) : self._bisect("USEC", t1_us)]
+
+    def read_count(self, cnt0, cnt1):
+        """Records with cnt0 <= CNT < cnt1, see read_time()"""
+        return self.data[self._bisect("CNT", cnt0) : self._bisect("CNT", cnt1)]
+
+    def read_position_box(
+        self, lower_m, upper_m, start=0, stop=None, block_samples=1 << 20
+    ):
+        """Records whose position lies inside an axis-aligned box.
+
+        The requested range is scanned block by block, memory use is bounded
+        by block_samples.
+
+        Args:
+            lower_m: (3,) lower corner of the box in m
+            upper_m: (3,) upper corner of the box in m
+            start (int): first record searched
+            stop (int): one past the last record searched
+            block_samples (int): records examined at a time
+
+        Returns:
+            tuple: (indices, records) of the matching records, as copies
+        """
+        lower = np.floor(np.asarray(lower_m, dtype=np.float64) * TICKS_PER_M)
+        upper = np.ceil(np.asarray(upper_m, dtype=np.float64) * TICKS_PER_M)
+        if stop is None:
+            stop = len(self.data)
+        indices = []
+        for a in range(start, stop, block_samples):
+            b = min(a + block_samples, stop)
+            positions = position_view(self.data[a:b])
+            inside = np.all((positions >= lower) & (positions <= upper), axis=1)
+            indices.append(a + np.flatnonzero(inside))
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        return indices, np.asarray(self.data[indices])
+
+
 if __name__ == "__main__":
     n_sensors = SYSTEM_PARAMETERS["sensor_count"]
     generated_dtype = n_sensors_dtype_generator(n_sensors)
@@ -62,3 +257,21 @@ if __name__ == "__main__":
     print("Accessing the USEC values in the results array")
     print(data_w_position["USEC"])
     print(data_no_position["USEC"])
+
+    print("Zero-copy views of all sensors and positions")
+    sensors = sensor_view(data_w_position)
+    positions = position_view(data_w_position)
+    print(f"sensors {sensors.shape} {sensors.dtype}, positions {positions.shape}")
+    print(f"peak |S| per sensor {np.abs(sensors[..., :3]).max(axis=(0, 2))}")
+
+    print("Random access with the memory-mapped reader")
+    reader = ACQ400Reader("data/with_position_binary_data.bin", n_sensors)
+    one_second = reader.read_time(1_000_000, 2_000_000)
+    print(f"{len(one_second)} records between 1 s and 2 s")
+    indices, records = reader.read_position_box([0, 0.1, 0], [0.01, 0.2, 0.01])
+    print(f"{len(indices)} records inside the position box")
+    if reader.index is not None:
+        sweep = reader.read_segment(plane=0, line=1)
+        print(
+            f"plane 0, Y-sweep 1: {len(sweep)} records, YPOS {sweep['YPOS'][[0, -1]]}"
+        )
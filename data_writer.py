@@ -24,40 +24,60 @@ SPAD4 = usr3
 uses a numpy structured array to define data and writes it out
 """
 
-import ast
+import functools
 import numpy as np
 from config import SYSTEM_PARAMETERS
 
+# position encoder ticks per metre in XPOS, YPOS, ZPOS
+# plucked this conversion factor out of thin air
+TICKS_PER_M = 10000
+
+
+@functools.lru_cache(maxsize=None)
+def _dtype_definition(n_sensors, position_included):
+    """Builds the (name, format) field list once per layout"""
+    if n_sensors < 1:
+        raise ValueError("n_sensors must be integer > 0")
+    channel_def = []
+    for n in range(1, n_sensors + 1):
+        channel_def += [(f"S{n}{axis}", "<i2") for axis in "XYZT"]
+    if position_included:
+        final_strings = ["XPOS", "YPOS", "ZPOS", "CNT", "USEC", "USR1", "USR2", "USR3"]
+    else:
+        final_strings = ["CNT", "USEC", "USR1", "USR2", "USR3"]
+    channel_def += [(n, "<i4") for n in final_strings]
+    return tuple(channel_def)
+
 
 def n_sensors_dtype_generator(n_sensors, position_included=True):
     """Generates dtype string for writing and reading numpy structured arrays.
 
+    Layouts are built once and cached, every call returns a fresh list.
+
     Args:
         n_sensors (int): The number of sensors within the data
         position_included (bool): True if X, Y, Z position fields to be
         included in the data, False otherwise.
 
     Returns:
-        str: a dtype definition of binary data format
+        list: a dtype definition of binary data format
 
     """
-    if n_sensors < 1:
-        raise ValueError("n_sensors must be integer > 0")
-    channel_def_strings = ""
-    for n in range(1, n_sensors + 1):
-        channel_def_strings += (
-            f"('S{n}X','<i2'), ('S{n}Y','<i2'), ('S{n}Z','<i2'), ('S{n}T','<i2'),"
-        )
-    if position_included:
-        final_strings = ["XPOS", "YPOS", "ZPOS", "CNT", "USEC", "USR1", "USR2", "USR3"]
-    else:
-        final_strings = ["CNT", "USEC", "USR1", "USR2", "USR3"]
+    return list(_dtype_definition(n_sensors, position_included))
 
-    for n in final_strings:
-        channel_def_strings += f" ('{n}','<i4'),"
 
-    channel_def = ast.literal_eval(f"[{channel_def_strings}]")
-    return channel_def
+@functools.lru_cache(maxsize=None)
+def acq400_dtype(n_sensors, position_included=True):
+    """Cached np.dtype of the ACQ400 record layout.
+
+    Args:
+        n_sensors (int): The number of sensors within the data
+        position_included (bool): True if X, Y, Z position fields included
+
+    Returns:
+        np.dtype: structured record dtype (96 bytes for 8 sensors)
+    """
+    return np.dtype(list(_dtype_definition(n_sensors, position_included)))
 
 
 def array_to_file(data, filename):
@@ -0,0 +1,404 @@
+"""
+Precomputed 3D B-field lookup table over the scan volume.
+
+The field is computed once on a regular grid covering scan_setup.dimensions_m
+(grown by the sensor offsets and a margin) and stored as a memory-mapped
+(nx, ny, nz, 3) .npy file with a .json sidecar describing the grid and the
+source it was computed for. Path samples are then evaluated by vectorised
+trilinear or tricubic (Catmull-Rom) interpolation, so re-running a scan with
+a different path or sensor layout is an interpolation pass rather than a
+physics pass.
+
+A FieldMap provides getB() and can be used wherever a magpylib source is
+expected, e.g. by sensor_head.compute_sensor_head_chunked() or the process
+pool in parallel.py. Worker processes reopen the memmap from its file instead
+of unpickling the grid.
+
+The field of a polarized sphere jumps at its surface, which no interpolation
+can follow, so observers within a few grid cells of a sphere surface are
+evaluated with the exact source instead.
+
+Run this module to build the map of the current config.yml and report its
+error bound along the scan path:
+
+    python field_map.py
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+import magpylib as magpy
+
+import dipole
+import field_volume
+import scan_path
+import sensor_head
+from config import FILES, PROCESSING, SCAN_SETUP
+
+INTERPOLATIONS = ("linear", "cubic")
+
+
+def meta_filename(filename):
+    """Sidecar filename describing the grid of a field map .npy file"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.json"
+
+
+def _linear_weights(t):
+    return [1 - t, t]
+
+
+def _cubic_weights(t):
+    # Catmull-Rom cubic convolution, exact for quadratics
+    t2 = t * t
+    t3 = t2 * t
+    return [
+        (-t3 + 2 * t2 - t) / 2,
+        (3 * t3 - 5 * t2 + 2) / 2,
+        (-3 * t3 + 4 * t2 + t) / 2,
+        (t3 - t2) / 2,
+    ]
+
+
+def source_description(source):
+    """JSON-able description of a source, used to tell stale maps apart"""
+    if isinstance(source, dipole.SphereDipole):
+        source = source.reference
+    if isinstance(source, magpy.magnet.Sphere):
+        return {
+            "type": "Sphere",
+            "position": np.asarray(source.position).tolist(),
+            "orientation": source.orientation.as_quat().tolist(),
+            "polarization": np.asarray(source.polarization).tolist(),
+            "diameter": float(source.diameter),
+        }
+    return field_volume.source_description(source)
+
+
+def _sphere_surfaces(source):
+    """(centre, radius) of every sphere whose surface the field jumps at"""
+    if isinstance(source, dipole.SphereDipole):
+        return [(source.position, source.radius)]
+    if isinstance(source, magpy.magnet.Sphere):
+        return [(np.asarray(source.position), abs(source.diameter) / 2)]
+    if isinstance(source, FieldMap):
+        return _sphere_surfaces(source.exact_source)
+    return [
+        surface
+        for child in getattr(source, "children", [])
+        for surface in _sphere_surfaces(child)
+    ]
+
+
+def scan_bounds(offsets=None, margin=None):
+    """Lower and upper corner of the volume seen by the sensors.
+
+    Args:
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets, defaults to the
+            sensor head in config.yml
+        margin (float): extra space on every side in m, defaults to
+            processing.field_map_margin_m in config.yml
+
+    Returns:
+        tuple: (lower, upper) arrays of shape (3,)
+    """
+    if offsets is None:
+        offsets = sensor_head.sensor_offsets()
+    if margin is None:
+        margin = PROCESSING["field_map_margin_m"]
+    dimensions = SCAN_SETUP["dimensions_m"]
+    extent = np.array(
+        [dimensions["max_x"], dimensions["max_y"], dimensions["max_z"]], dtype=float
+    )
+    lower = np.minimum(offsets.min(axis=0), 0) - margin
+    upper = extent + np.maximum(offsets.max(axis=0), 0) + margin
+    return lower, upper
+
+
+class FieldMap:
+    """B-field sampled on a regular grid, interpolated in between.
+
+    Args:
+        filename (str): (nx, ny, nz, 3) .npy file of the grid values
+        origin: (3,) position of grid node [0, 0, 0] in m
+        spacing (float): distance between grid nodes in m
+        interpolation (str): "linear" or "cubic", defaults to
+            processing.field_map_interpolation in config.yml
+        exact_source: source evaluated instead of the grid close to a
+            field discontinuity, None interpolates everywhere
+    """
+
+    def __init__(
+        self, filename, origin, spacing, interpolation=None, exact_source=None
+    ):
+        if interpolation is None:
+            interpolation = PROCESSING["field_map_interpolation"]
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f"interpolation must be one of {INTERPOLATIONS}")
+        self.filename = filename
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.spacing = float(spacing)
+        self.interpolation = interpolation
+        self.exact_source = exact_source
+        self.grid = np.load(filename, mmap_mode="r")
+        self.shape = self.grid.shape[:3]
+
+    def __getstate__(self):
+        # worker processes map the grid file themselves
+        state = self.__dict__.copy()
+        del state["grid"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.grid = np.load(self.filename, mmap_mode="r")
+
+    @classmethod
+    def build(
+        cls,
+        source,
+        filename=None,
+        lower=None,
+        upper=None,
+        spacing=None,
+        chunk_samples=None,
+        interpolation=None,
+    ):
+        """Computes the field on the grid and writes the map to disk.
+
+        Args:
+            source: magpylib source (or collection) providing getB()
+            filename (str): .npy file, defaults to files.field_map
+            lower: (3,) lower corner, defaults to scan_bounds()
+            upper: (3,) upper corner, defaults to scan_bounds()
+            spacing (float): grid spacing in m, defaults to
+                processing.field_map_spacing_m in config.yml
+            chunk_samples (int): grid nodes evaluated per getB() call
+            interpolation (str): "linear" or "cubic"
+
+        Returns:
+            FieldMap: the map, with source used as its exact source
+        """
+        if filename is None:
+            filename = FILES["field_map"]
+        if lower is None or upper is None:
+            lower, upper = scan_bounds()
+        if spacing is None:
+            spacing = PROCESSING["field_map_spacing_m"]
+        if chunk_samples is None:
+            chunk_samples = PROCESSING["chunk_samples"]
+        lower = np.asarray(lower, dtype=np.float64)
+        shape = tuple(int(n) for n in np.ceil((upper - lower) / spacing) + 1)
+
+        # whole x slabs per tile, an interrupted build resumes from its tiles
+        slab = max(chunk_samples // (shape[1] * shape[2]), 1)
+        volume = field_volume.FieldVolume(
+            source,
+            lower,
+            spacing,
+            shape,
+            filename,
+            tile=(slab, shape[1], shape[2]),
+            description=source_description(source),
+        )
+        volume.compute()
+        del volume
+        with open(meta_filename(filename), "w") as fh:
+            json.dump(
+                {
+                    "origin": lower.tolist(),
+                    "spacing": spacing,
+                    "shape": list(shape),
+                    "source": source_description(source),
+                },
+                fh,
+                indent=2,
+            )
+        return cls(filename, lower, spacing, interpolation, source)
+
+    @classmethod
+    def load(cls, filename=None, interpolation=None, exact_source=None):
+        """Opens a field map written by build()"""
+        if filename is None:
+            filename = FILES["field_map"]
+        with open(meta_filename(filename)) as fh:
+            meta = json.load(fh)
+        return cls(
+            filename, meta["origin"], meta["spacing"], interpolation, exact_source
+        )
+
+    @classmethod
+    def load_or_build(cls, source, filename=None, spacing=None, interpolation=None):
+        """The field map of source, reusing the one on disk if it matches.
+
+        The map on disk is reused if it was computed for the same source
+        with the same spacing and covers the scan volume.
+        """
+        if filename is None:
+            filename = FILES["field_map"]
+        if spacing is None:
+            spacing = PROCESSING["field_map_spacing_m"]
+        lower, upper = scan_bounds()
+        try:
+            with open(meta_filename(filename)) as fh:
+                meta = json.load(fh)
+            origin = np.array(meta["origin"])
+            top = origin + (np.array(meta["shape"]) - 1) * meta["spacing"]
+            if (
+                meta["source"] == source_description(source)
+                and meta["spacing"] == spacing
+                and np.all(origin <= lower)
+                and np.all(top >= upper)
+                and os.path.exists(filename)
+            ):
+                return cls.load(filename, interpolation, source)
+        except FileNotFoundError:
+            pass
+        print(f"Building field map {filename}...")
+        start = time.time()
+        field_map = cls.build(
+            source, filename, lower, upper, spacing, interpolation=interpolation
+        )
+        print(
+            f"Field map of {np.prod(field_map.shape):,} nodes "
+            f"({field_map.grid.nbytes / 1e6:,.1f} MB) built in {time.time() - start:.2f} s"
+        )
+        return field_map
+
+    def _exact_zone(self, points):
+        """Observers too close to a sphere surface to interpolate across"""
+        reach = (1 if self.interpolation == "linear" else 2) * np.sqrt(3) * self.spacing
+        zone = np.zeros(len(points), dtype=bool)
+        for centre, radius in _sphere_surfaces(self.exact_source):
+            distance = np.sqrt(((points - centre) ** 2).sum(axis=1))
+            zone |= np.abs(distance - radius) < reach
+        return zone
+
+    def getB(self, observers):
+        """Interpolated B-field at the observer positions.
+
+        Args:
+            observers: (..., 3) positions in m inside the grid
+
+        Returns:
+            np.ndarray: (..., 3) B-field
+        """
+        observers = np.asarray(observers, dtype=np.float64)
+        points = observers.reshape(-1, 3)
+        if self.interpolation == "linear":
+            taps, weights = 2, _linear_weights
+        else:
+            taps, weights = 4, _cubic_weights
+
+        u = (points - self.origin) / self.spacing
+        cell = np.floor(u).astype(np.int64)
+        lowest = cell - (taps // 2 - 1)
+        limit = np.array(self.shape) - taps
+        if np.any(lowest < 0) or np.any(lowest > limit):
+            raise ValueError(f"observers outside the field map {self.filename}")
+        t = u - cell
+        w = [weights(t[:, axis]) for axis in range(3)]
+
+        # separable stencil: gather the taps consecutive z nodes of each of
+        # the taps**2 (x, y) stencil rows at once and weight them
+        flat = self.grid.reshape(-1, 3)
+        runs = np.lib.stride_tricks.as_strided(
+            flat,
+            shape=(len(flat) - taps + 1, taps, 3),
+            strides=(flat.strides[0], flat.strides[0], flat.strides[1]),
+            writeable=False,
+        )
+        strides = np.array([self.shape[1] * self.shape[2], self.shape[2], 1])
+        base = lowest @ strides
+        wz = np.stack(w[2], axis=1)
+        B = np.zeros_like(points)
+        for i in range(taps):
+            for j in range(taps):
+                row = base + i * strides[0] + j * strides[1]
+                B += (w[0][i] * w[1][j])[:, np.newaxis] * np.einsum(
+                    "nk,nkc->nc", wz, runs[row]
+                )
+
+        if self.exact_source is not None:
+            zone = self._exact_zone(points)
+            if zone.any():
+                B[zone] = self.exact_source.getB(points[zone])
+        return B.reshape(observers.shape)
+
+    def error_bound(self, source, points, offsets=None, n_probe=None):
+        """Largest interpolation error found along a path.
+
+        The map is compared with source on n_probe samples spread evenly
+        along points, and on the centres of the grid cells they fall in,
+        where interpolation errors peak.
+
+        Args:
+            source: exact source the map was built from
+            points: (n, 3) array-like path
+            offsets (np.ndarray): optional (n_sensors, 3) sensor offsets,
+                every sensor position of the probed samples is compared
+            n_probe (int): path samples compared, defaults to
+                processing.storage_probe_samples in config.yml
+
+        Returns:
+            dict: max_error and max_field over the probe and max_relative,
+            the error as a fraction of max_field
+        """
+        if n_probe is None:
+            n_probe = PROCESSING["storage_probe_samples"]
+        probe = np.unique(np.linspace(0, len(points) - 1, n_probe).astype(np.int64))
+        samples = np.asarray(points[probe])
+        if offsets is not None:
+            samples = (samples[:, np.newaxis, :] + offsets).reshape(-1, 3)
+        centres = (
+            self.origin
+            + (np.floor((samples - self.origin) / self.spacing) + 0.5) * self.spacing
+        )
+        probe_points = np.concatenate([samples, centres])
+        exact = source.getB(probe_points)
+        error = np.abs(self.getB(probe_points) - exact).max()
+        field = np.abs(exact).max()
+        return {
+            "max_error": float(error),
+            "max_field": float(field),
+            "max_relative": float(error / field) if field > 0 else 0.0,
+        }
+
+
+def print_error_bound(bound, interpolation):
+    """Prints the result of FieldMap.error_bound()"""
+    print(
+        f"{interpolation} interpolation error bound (estimated on a path probe): "
+        f"{bound['max_error']:.3g} "
+        f"({bound['max_relative']:.2g} of max |B| {bound['max_field']:.3g})"
+    )
+
+
+if __name__ == "__main__":
+    import bfield_engine
+
+    source = bfield_engine.create_source()
+    field_map = FieldMap.load_or_build(source)
+    print(
+        f"Grid {field_map.shape} at {field_map.spacing * 1e3:.1f} mm spacing, "
+        f"origin {field_map.origin}"
+    )
+    sampled_points = scan_path.build_scan_path()
+    offsets = sensor_head.sensor_offsets()
+    for interpolation in INTERPOLATIONS:
+        interpolated = FieldMap.load(field_map.filename, interpolation, source)
+        print_error_bound(
+            interpolated.error_bound(source, sampled_points, offsets), interpolation
+        )
+
+    chunk = np.asarray(sampled_points[:1_000_000])
+    for name, evaluator in [
+        ("exact source", source),
+        ("linear map", FieldMap.load(field_map.filename, "linear", source)),
+        ("cubic map", FieldMap.load(field_map.filename, "cubic", source)),
+    ]:
+        start = time.time()
+        evaluator.getB(chunk)
+        print(f"{name:14s} {len(chunk) / (time.time() - start):>14,.0f} samples/s")
@@ -0,0 +1,212 @@
+"""
+Per-component B-field statistics accumulated while the field is computed.
+
+Every B-field_*.npy written by the simulation stages gets a small sidecar,
+B-field_*.stats.npz, holding the minimum, maximum, sum and count of each
+component per block of block_samples rows. Whole-file min/max/mean/count
+come straight from the block table, and the range of any leading selection
+of samples (as used by the muxer for gain selection) needs at most one
+partial block to be read from the data.
+
+A sidecar is only trusted when the size and modification time recorded in it
+still match its .npy file.
+"""
+
+import os
+
+import numpy as np
+
+import storage
+from config import PROCESSING
+
+
+def stats_filename(filename):
+    """Sidecar filename for a B-field .npy file"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.stats.npz"
+
+
+class FieldStats:
+    """Block-wise running min/max/sum/count of an (n_samples, 3) array.
+
+    Args:
+        n_samples (int): rows in the array
+        block_samples (int): rows per statistics block, defaults to
+            processing.stats_block_samples in config.yml
+    """
+
+    def __init__(self, n_samples, block_samples=None):
+        if block_samples is None:
+            block_samples = PROCESSING["stats_block_samples"]
+        n_blocks = -(-n_samples // block_samples)
+        self.n_samples = n_samples
+        self.block_samples = block_samples
+        self.minimum = np.full((n_blocks, 3), np.inf)
+        self.maximum = np.full((n_blocks, 3), -np.inf)
+        self.total = np.zeros((n_blocks, 3))
+        self.count = np.zeros(n_blocks, dtype=np.int64)
+
+    def update(self, start, values):
+        """Accounts for values written to rows [start, start + len(values)).
+
+        Args:
+            start (int): first row of values
+            values (np.ndarray): (m, 3) block of the array
+        """
+        m = len(values)
+        if m == 0:
+            return
+        first = start // self.block_samples
+        last = (start + m - 1) // self.block_samples
+        edges = np.arange(first, last + 1) * self.block_samples - start
+        edges[0] = 0
+        blocks = slice(first, last + 1)
+        self.minimum[blocks] = np.minimum(
+            self.minimum[blocks], np.minimum.reduceat(values, edges, axis=0)
+        )
+        self.maximum[blocks] = np.maximum(
+            self.maximum[blocks], np.maximum.reduceat(values, edges, axis=0)
+        )
+        self.total[blocks] += np.add.reduceat(values, edges, axis=0)
+        self.count[blocks] += np.diff(np.append(edges, m))
+
+    def merge(self, other):
+        """Combines statistics gathered over another part of the same array"""
+        if (other.n_samples, other.block_samples) != (
+            self.n_samples,
+            self.block_samples,
+        ):
+            raise ValueError("statistics cover differently shaped arrays")
+        np.minimum(self.minimum, other.minimum, out=self.minimum)
+        np.maximum(self.maximum, other.maximum, out=self.maximum)
+        self.total += other.total
+        self.count += other.count
+
+    @property
+    def complete(self):
+        """True once every row has been accounted for"""
+        return int(self.count.sum()) == self.n_samples
+
+    def summary(self):
+        """Whole-array statistics.
+
+        Returns:
+            dict: per-component min, max and mean, and the row count
+        """
+        count = int(self.count.sum())
+        return {
+            "min": self.minimum.min(axis=0),
+            "max": self.maximum.max(axis=0),
+            "mean": self.total.sum(axis=0) / max(count, 1),
+            "count": count,
+        }
+
+    def prefix_range(self, stop, data):
+        """Per-component (min, max) of rows [0, stop), exactly.
+
+        Whole blocks come from the table, the trailing partial block is read
+        from data.
+
+        Args:
+            stop (int): one past the last row considered
+            data (np.ndarray): the (n, 3) array the statistics describe
+
+        Returns:
+            tuple: (minimums, maximums) arrays of shape (3,)
+        """
+        if not 0 < stop <= self.n_samples:
+            raise ValueError(f"stop must be in 1..{self.n_samples}")
+        full = stop // self.block_samples
+        mins = self.minimum[:full].min(axis=0, initial=np.inf)
+        maxs = self.maximum[:full].max(axis=0, initial=-np.inf)
+        if stop > full * self.block_samples:
+            tail = np.asarray(data[full * self.block_samples : stop])
+            mins = np.minimum(mins, tail.min(axis=0))
+            maxs = np.maximum(maxs, tail.max(axis=0))
+        return mins, maxs
+
+    def save(self, filename):
+        """Writes the sidecar of the .npy file filename"""
+        info = os.stat(filename)
+        # replaced rather than rewritten, it may be linked into the run cache
+        tmp = f"{stats_filename(filename)}.tmp"
+        with open(tmp, "wb") as fh:
+            np.savez(
+                fh,
+                n_samples=self.n_samples,
+                block_samples=self.block_samples,
+                minimum=self.minimum,
+                maximum=self.maximum,
+                total=self.total,
+                count=self.count,
+                data_size=info.st_size,
+                data_mtime_ns=info.st_mtime_ns,
+            )
+        os.replace(tmp, stats_filename(filename))
+
+    @classmethod
+    def load(cls, filename):
+        """Reads the sidecar of the .npy file filename.
+
+        Returns:
+            FieldStats or None: None if there is no sidecar or it is stale
+        """
+        try:
+            sidecar = np.load(stats_filename(filename))
+            info = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        with sidecar:
+            if (int(sidecar["data_size"]), int(sidecar["data_mtime_ns"])) != (
+                info.st_size,
+                info.st_mtime_ns,
+            ):
+                return None
+            stats = cls(int(sidecar["n_samples"]), int(sidecar["block_samples"]))
+            stats.minimum = sidecar["minimum"]
+            stats.maximum = sidecar["maximum"]
+            stats.total = sidecar["total"]
+            stats.count = sidecar["count"]
+        return stats
+
+
+def compute_stats(data, block_samples=None, chunk_samples=None):
+    """Statistics of an existing array in one streaming pass.
+
+    Args:
+        data (np.ndarray): (n, 3) array, typically a memmap of a legacy file
+        block_samples (int): rows per statistics block
+        chunk_samples (int): rows read at a time
+
+    Returns:
+        FieldStats: the statistics
+    """
+    if chunk_samples is None:
+        chunk_samples = PROCESSING["chunk_samples"]
+    stats = FieldStats(len(data), block_samples)
+    for start in range(0, len(data), chunk_samples):
+        stats.update(start, np.asarray(data[start : start + chunk_samples]))
+    return stats
+
+
+def load_or_compute(filename, data=None):
+    """Statistics of a B-field .npy file, from its sidecar when possible.
+
+    Legacy files without a (valid) sidecar get one streaming statistics pass
+    and the sidecar is written for next time.
+
+    Args:
+        filename (str): B-field .npy file
+        data (np.ndarray): already opened contents of filename
+
+    Returns:
+        FieldStats: the statistics
+    """
+    stats = FieldStats.load(filename)
+    if stats is None:
+        print(f"No statistics sidecar for {filename}, computing in one pass...")
+        if data is None:
+            data = storage.open_array(filename)
+        stats = compute_stats(data)
+        stats.save(filename)
+    return stats
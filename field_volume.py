@@ -0,0 +1,327 @@
+"""
+Lazily evaluated B-field over a regular 3D grid, tile by tile.
+
+A FieldVolume is defined by its lower corner, grid spacing and shape. The
+grid coordinates are never materialised: every tile builds its own nodes by
+broadcasting the three axes, evaluates them in one getB() call and writes
+them into a memory-mapped (nx, ny, nz, 3) .npy file. A boolean tile mask
+records which tiles are done, so
+
+    vol = FieldVolume.from_bounds(source, (-5, -5, -5), (5, 5, 5), (40, 40, 40))
+    vol[:, :, 20]     # evaluates only the tiles the z=20 plane cuts
+    vol[:, :, 21]     # reuses them
+    vol.compute(workers=4)   # the remaining tiles, in a process pool
+
+Both the mask (<root>.tiles.npy) and a sidecar describing the grid and
+source (<root>.volume.json) are kept next to the .npy file, so reopening the
+same volume later, e.g. after an interrupted run, only evaluates the tiles
+that are still missing. Without a filename the volume lives in a temporary
+directory that is removed with it.
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from config import PROCESSING
+
+
+def mask_filename(filename):
+    """Tile mask of a volume .npy file"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.tiles.npy"
+
+
+def meta_filename(filename):
+    """Sidecar describing the grid and source of a volume .npy file"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.volume.json"
+
+
+# attributes of magpylib sources (and dipole.SphereDipole) that determine
+# their field
+SOURCE_ATTRIBUTES = (
+    "position",
+    "dimension",
+    "diameter",
+    "radius",
+    "polarization",
+    "moment",
+    "current",
+    "vertices",
+    "matrix",
+)
+
+
+def source_description(source):
+    """JSON-able geometry and magnetisation of a source and its children.
+
+    A source changed in place gets a different description, unlike its
+    repr(), which for magpylib only holds the object's id.
+    """
+    description = {"type": type(source).__name__}
+    for name in SOURCE_ATTRIBUTES:
+        value = getattr(source, name, None)
+        if value is not None:
+            description[name] = np.asarray(value, dtype=np.float64).tolist()
+    orientation = getattr(source, "orientation", None)
+    if orientation is not None:
+        description["orientation"] = orientation.as_quat().tolist()
+    children = getattr(source, "children", None)
+    if children:
+        description["children"] = [source_description(child) for child in children]
+    return description
+
+
+def _fill_tiles(task):
+    """Worker: evaluates tiles into the volume file, returns their numbers"""
+    volume, tiles = task
+    for tile in tiles:
+        volume._evaluate(tile)
+    volume.data.flush()
+    return tiles
+
+
+class FieldVolume:
+    """B-field of a source on a regular grid, evaluated tile by tile on demand.
+
+    Args:
+        source: magpylib source (or anything providing getB())
+        lower: (3,) position of node [0, 0, 0] in m
+        spacing: grid spacing in m, a scalar or one per axis
+        shape: (nx, ny, nz) number of nodes along each axis
+        filename (str): .npy file of the values, a temporary file if None
+        tile: nodes per tile along each axis, a scalar or one per axis,
+            defaults to processing.volume_tile in config.yml
+        description (dict): JSON-able identity of the source; tiles on disk
+            are only reused if it matches. Defaults to source_description(),
+            a source it cannot describe needs one when filename is given.
+    """
+
+    def __init__(
+        self, source, lower, spacing, shape, filename=None, tile=None, description=None
+    ):
+        if tile is None:
+            tile = PROCESSING["volume_tile"]
+        self.source = source
+        self.lower = np.asarray(lower, dtype=np.float64)
+        self.spacing = np.broadcast_to(np.asarray(spacing, dtype=np.float64), (3,))
+        self.shape = tuple(int(n) for n in shape) + (3,)
+        self.tile = tuple(int(t) for t in np.broadcast_to(tile, (3,)))
+        self.axes = [
+            self.lower[i] + np.arange(self.shape[i]) * self.spacing[i] for i in range(3)
+        ]
+        self.n_tiles = tuple(-(-n // t) for n, t in zip(self.shape[:3], self.tile))
+        if description is None:
+            description = source_description(source)
+            if filename is not None and len(description) == 1:
+                raise ValueError(
+                    f"{type(source).__name__} sources need a description to "
+                    f"reuse {filename}"
+                )
+        self._tmpdir = None
+        if filename is None:
+            self._tmpdir = tempfile.mkdtemp(prefix="field_volume_")
+            weakref.finalize(self, shutil.rmtree, self._tmpdir, True)
+            filename = os.path.join(self._tmpdir, "volume.npy")
+        self.filename = filename
+        self._open(description)
+
+    @classmethod
+    def from_bounds(cls, source, lower, upper, shape, **kwargs):
+        """Volume of shape nodes spanning lower to upper, both included, like
+        np.linspace() along each axis"""
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        shape = np.broadcast_to(np.asarray(shape, dtype=np.int64), (3,))
+        spacing = (upper - lower) / np.maximum(shape - 1, 1)
+        return cls(source, lower, spacing, shape, **kwargs)
+
+    def _open(self, description):
+        """Maps the values and tile mask, reusing them if they match"""
+        meta = {
+            "lower": self.lower.tolist(),
+            "spacing": self.spacing.tolist(),
+            "shape": list(self.shape[:3]),
+            "tile": list(self.tile),
+            "source": description,
+        }
+        try:
+            with open(meta_filename(self.filename)) as fh:
+                reuse = json.load(fh) == meta
+            reuse = reuse and os.path.exists(mask_filename(self.filename))
+        except FileNotFoundError:
+            reuse = False
+        if reuse:
+            self.data = np.load(self.filename, mmap_mode="r+")
+            self.done = np.load(mask_filename(self.filename), mmap_mode="r+")
+            return
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        for name in (self.filename, mask_filename(self.filename)):
+            if os.path.exists(name):
+                os.remove(name)
+        self.data = np.lib.format.open_memmap(
+            self.filename, mode="w+", dtype=np.float64, shape=self.shape
+        )
+        self.done = np.lib.format.open_memmap(
+            mask_filename(self.filename), mode="w+", dtype=bool, shape=self.n_tiles
+        )
+        with open(meta_filename(self.filename), "w") as fh:
+            json.dump(meta, fh, indent=2)
+
+    def __getstate__(self):
+        # worker processes map the files themselves
+        state = self.__dict__.copy()
+        del state["data"], state["done"]
+        state["_tmpdir"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.load(self.filename, mmap_mode="r+")
+        self.done = np.load(mask_filename(self.filename), mmap_mode="r")
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 4
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    @property
+    def tiles_done(self):
+        """Number of tiles evaluated so far"""
+        return int(np.count_nonzero(self.done))
+
+    def _slices(self, tile):
+        return tuple(
+            slice(k * t, min((k + 1) * t, n))
+            for k, t, n in zip(tile, self.tile, self.shape[:3])
+        )
+
+    def nodes(self, tile):
+        """(tx, ty, tz, 3) grid positions of a tile, built by broadcasting"""
+        sx, sy, sz = (self.axes[i][s] for i, s in enumerate(self._slices(tile)))
+        nodes = np.empty((len(sx), len(sy), len(sz), 3))
+        nodes[..., 0] = sx[:, None, None]
+        nodes[..., 1] = sy[None, :, None]
+        nodes[..., 2] = sz[None, None, :]
+        return nodes
+
+    def _evaluate(self, tile):
+        """Evaluates a tile into the memmap, without touching the mask"""
+        nodes = self.nodes(tile)
+        B = self.source.getB(nodes.reshape(-1, 3))
+        self.data[self._slices(tile)] = np.reshape(B, nodes.shape)
+
+    def tiles_for(self, key):
+        """Tiles holding the nodes selected by a basic index key.
+
+        Args:
+            key: int, slice or Ellipsis per axis, as for an (nx, ny, nz, 3)
+                array
+
+        Returns:
+            list: (i, j, k) tile numbers
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = next(n for n, k in enumerate(key) if k is Ellipsis)
+            fill = (slice(None),) * (4 - len(key) + 1)
+            key = key[:i] + fill + key[i + 1 :]
+        key = (key + (slice(None),) * 3)[:3]
+        per_axis = []
+        for k, n, t in zip(key, self.shape[:3], self.tile):
+            if not isinstance(k, (int, np.integer, slice)):
+                raise TypeError("FieldVolume supports int and slice indices only")
+            nodes = np.atleast_1d(np.arange(n)[k])
+            per_axis.append(np.unique(nodes // t))
+        return [
+            (int(i), int(j), int(k))
+            for i in per_axis[0]
+            for j in per_axis[1]
+            for k in per_axis[2]
+        ]
+
+    def compute(self, tiles=None, workers=1):
+        """Evaluates the tiles not yet done.
+
+        Args:
+            tiles (list): (i, j, k) tile numbers, all tiles if None
+            workers (int): processes sharing the tiles
+
+        Returns:
+            int: number of tiles evaluated
+        """
+        if tiles is None:
+            tiles = [tuple(int(k) for k in t) for t in np.argwhere(~self.done)]
+        missing = [t for t in tiles if not self.done[t]]
+        if not missing:
+            return 0
+        if workers > 1 and len(missing) > 1:
+            self.data.flush()
+            self.done.flush()
+            batches = [missing[i::workers] for i in range(workers)]
+            with multiprocessing.Pool(processes=workers) as pool:
+                for finished in pool.imap_unordered(
+                    _fill_tiles, [(self, batch) for batch in batches if batch]
+                ):
+                    for tile in finished:
+                        self.done[tile] = True
+        else:
+            for tile in missing:
+                self._evaluate(tile)
+                self.done[tile] = True
+        self.data.flush()
+        self.done.flush()
+        return len(missing)
+
+    def __getitem__(self, key):
+        self.compute(self.tiles_for(key))
+        return np.array(self.data[key])
+
+    def __array__(self, dtype=None, copy=None):
+        self.compute()
+        values = np.array(self.data)
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+
+if __name__ == "__main__":
+    import time
+
+    import bfield_engine
+    import field_map
+
+    source = bfield_engine.create_source()
+    lower, upper = field_map.scan_bounds()
+    spacing = PROCESSING["field_map_spacing_m"]
+    shape = np.ceil((upper - lower) / spacing).astype(int) + 1
+    volume = FieldVolume(source, lower, spacing, shape)
+    n_tiles = np.prod(volume.n_tiles)
+    print(f"Volume {volume.shape[:3]} in {n_tiles} tiles of {volume.tile}")
+
+    start = time.time()
+    plane = volume[:, :, shape[2] // 2]
+    print(
+        f"plane {plane.shape}: {time.time() - start:.2f} s, "
+        f"{volume.tiles_done} of {n_tiles} tiles evaluated"
+    )
+    start = time.time()
+    volume[:, :, shape[2] // 2 + 1]
+    print(f"neighbouring plane: {time.time() - start:.3f} s, from evaluated tiles")
+    start = time.time()
+    volume.compute()
+    print(
+        f"remaining tiles: {time.time() - start:.2f} s, "
+        f"{volume.nbytes / 1e6:,.1f} MB"
+    )
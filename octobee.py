@@ -0,0 +1,105 @@
+"""
+Command line entry point of the simulation.
+
+    python -m octobee run [config.yml]
+
+runs the scan path, the B-field of every sensor and the ACQ400 muxer as one
+streaming pipeline, see pipeline.py. With --direct only the muxed ACQ400
+files are written. The config file defaults to the
+OCTOBEE_CONFIG environment variable, then config.yml.
+"""
+
+import argparse
+import os
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m octobee", description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser(
+        "run", help="run the whole simulation as a streaming pipeline"
+    )
+    run.add_argument(
+        "config",
+        nargs="?",
+        default=os.environ.get("OCTOBEE_CONFIG", "config.yml"),
+        help="configuration file, defaults to config.yml",
+    )
+    run.add_argument(
+        "--chunk-samples",
+        type=int,
+        help="sensor positions evaluated per getB() call",
+    )
+    run.add_argument(
+        "--queue-chunks",
+        type=int,
+        help="chunks held between two stages before the producer waits",
+    )
+    run.add_argument(
+        "--precision",
+        help="storage precision of the B-field files, see storage.py",
+    )
+    run.add_argument(
+        "--direct",
+        action="store_true",
+        help="mux straight from the field evaluation, without intermediate .npy "
+        "files (float64, no dedup, see pipeline.run_direct())",
+    )
+    run.add_argument(
+        "--dedup",
+        action=argparse.BooleanOptionalAction,
+        help="evaluate lines shared by several sensors once and copy them, "
+        "see segment_dedup.py",
+    )
+    run.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=None,
+        help="recompute every sensor even if the run cache (run_cache.py) holds it",
+    )
+    run.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        default=None,
+        help="start over instead of resuming an interrupted run, see checkpoint.py",
+    )
+    args = parser.parse_args(argv)
+    if args.direct:
+        # direct mode is always float64, without dedup or a journal
+        ignored = [
+            option
+            for option, value in (
+                ("--precision", args.precision),
+                ("--dedup/--no-dedup", args.dedup),
+                ("--no-resume", args.resume),
+            )
+            if value is not None
+        ]
+        if ignored:
+            run.error(f"{', '.join(ignored)} cannot be used with --direct")
+
+    # config.py reads the file named here when pipeline.py first imports it
+    os.environ["OCTOBEE_CONFIG"] = args.config
+    import pipeline
+
+    if args.direct:
+        pipeline.run_direct(
+            chunk_samples=args.chunk_samples,
+            queue_chunks=args.queue_chunks,
+            cache=args.cache,
+        )
+        return
+    pipeline.run(
+        chunk_samples=args.chunk_samples,
+        queue_chunks=args.queue_chunks,
+        precision=args.precision,
+        dedup=args.dedup,
+        cache=args.cache,
+        resume=args.resume,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,76 @@
 """
 Offset an existing path by a constant along one, two or three axes
+
+All sensors of the head are evaluated together in a single pass over the
+path, see sensor_head.py.
 """
 
-import numpy as np
-import os
+import argparse
 import time
-import magpylib as magpy
-from config import FILES, SIMULATION_OBJECTS, SYSTEM_PARAMETERS
+
+import bfield_engine
+import checkpoint
+import field_map
+import parallel
+import run_cache
+import scan_path
+import segment_dedup
+import sensor_head
+import storage
+from config import FILES, PROCESSING
 
 if __name__ == "__main__":
-    scan_path_filename = FILES["recorded_scan_path"]
-    # Load path of sample coordinates
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--chunk-samples",
+        type=int,
+        default=PROCESSING["chunk_samples"],
+        help="sensor positions evaluated per getB() call",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=PROCESSING["workers"],
+        help="worker processes sharing the B-field computation",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=list(storage.PRECISIONS),
+        default=PROCESSING["storage_precision"],
+        help="storage precision of the B-field files, see storage.py",
+    )
+    parser.add_argument(
+        "--field-map",
+        action="store_true",
+        help="interpolate from the field lookup table (field_map.py) instead of "
+        "evaluating the source",
+    )
+    parser.add_argument(
+        "--dedup",
+        action=argparse.BooleanOptionalAction,
+        default=PROCESSING["dedup_segments"],
+        help="evaluate lines shared by several sensors once and copy them, "
+        "see segment_dedup.py",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=PROCESSING["run_cache"],
+        help="recompute every sensor even if the run cache (run_cache.py) holds it",
+    )
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        default=PROCESSING["resume"],
+        help="start over instead of resuming an interrupted run, see checkpoint.py",
+    )
+    args = parser.parse_args()
+
+    # Open path of sample coordinates, positions are only computed per chunk
     path_generation_start = time.time()
-    sampled_points = np.load(scan_path_filename)
+    sampled_points = scan_path.load_scan_path()
     print(f"Shape of loaded array {sampled_points.shape}")
     path_generation_end = time.time()
     print(
@@ -21,64 +79,113 @@ if __name__ == "__main__":
     print(f"Generated {sampled_points.shape[0]:,} coordinate points.")
     print("-" * 40)
 
-    # Add z-axis offset
     print(f"sampled_points {sampled_points[0]}")
     print(f"sampled_points {sampled_points[245785]}")
     print(f"sampled_points {sampled_points[-1]}")
 
-    D = SIMULATION_OBJECTS["system_under_test"]["diameter"]
-    P = SIMULATION_OBJECTS["system_under_test"]["polarization"]
-    Cx = SIMULATION_OBJECTS["system_under_test"]["position_m"]["x"]
-    Cy = SIMULATION_OBJECTS["system_under_test"]["position_m"]["y"]
-    Cz = SIMULATION_OBJECTS["system_under_test"]["position_m"]["z"]
+    offsets = sensor_head.sensor_offsets()
+    rotations = sensor_head.sensor_rotations()
+    filenames = sensor_head.output_filenames(offsets, FILES["output_dir"])
+    for offset, filename in zip(offsets, filenames):
+        print(f"sensor offset {offset} -> {filename}")
 
-    z_offset_values = SYSTEM_PARAMETERS["sensor_offsets"]
-    for z_offset_value in z_offset_values:
-
-        sampled_points = np.load(scan_path_filename)
-        z_offset = np.array([0, 0, z_offset_value])
-        sampled_points = sampled_points + z_offset
-
-        print(f"sampled_points {sampled_points[0]}")
-        print(f"sampled_points {sampled_points[245785]}")
-        print(f"sampled_points {sampled_points[-1]}")
-        # Perform the B-field calculation on the generated path
-        print("Starting B-field calculation...")
-        b_field_start = time.time()
+    # Sensors left in the run cache by an unchanged run are linked, not recomputed
+    cache = run_cache.RunCache() if args.cache else None
+    keys = run_cache.sensor_keys(
+        sampled_points,
+        offsets,
+        rotations,
+        run_cache.stage_options(args.precision, args.field_map, args.dedup),
+    )
+    b_field_start = time.time()
+    missing = run_cache.fetch_outputs(cache, keys, filenames)
+    new_offsets = offsets[missing]
+    new_rotations = None if rotations is None else rotations[missing]
+    new_filenames = [filenames[i] for i in missing]
 
+    if missing:
         # Define the magnetic source
+        source_sphere = bfield_engine.create_source()
+        if args.field_map:
+            exact_source = source_sphere
+            source_sphere = field_map.FieldMap.load_or_build(exact_source)
+            field_map.print_error_bound(
+                source_sphere.error_bound(exact_source, sampled_points, new_offsets),
+                source_sphere.interpolation,
+            )
 
-        source_sphere = magpy.magnet.Sphere(
-            position=(Cx, Cy, Cz), polarization=P, diameter=D
+        # Perform the B-field calculation for every sensor in one pass,
+        # journaling progress so a rerun after a crash resumes where it stopped
+        print(f"Starting B-field calculation for {len(missing)} sensors...")
+        journal_key = [keys[i] for i in missing]
+        if not args.resume:
+            checkpoint.discard(new_filenames)
+        if args.workers > 1:
+            report = parallel.compute_sharded(
+                source_sphere,
+                sampled_points,
+                new_filenames,
+                new_offsets,
+                new_rotations,
+                workers=args.workers,
+                chunk_samples=args.chunk_samples,
+                precision=args.precision,
+                journal_key=journal_key,
+            )
+            parallel.print_report(report)
+        elif args.dedup and isinstance(sampled_points, scan_path.ScanPath):
+            dedup = segment_dedup.SegmentDedup(
+                sampled_points.segments,
+                new_offsets,
+                new_rotations,
+                source=source_sphere,
+            )
+            print(f"Coincident sensor lines: dedup ratio {dedup.ratio:.3f}")
+            report = segment_dedup.compute_sensor_head_dedup(
+                source_sphere,
+                sampled_points,
+                new_filenames,
+                new_offsets,
+                new_rotations,
+                args.chunk_samples,
+                args.precision,
+                dedup,
+                journal_key,
+            )
+            segment_dedup.print_report(report)
+        else:
+            sensor_head.compute_sensor_head_chunked(
+                source_sphere,
+                sampled_points,
+                new_filenames,
+                new_offsets,
+                new_rotations,
+                args.chunk_samples,
+                args.precision,
+                journal_key,
+            )
+        run_cache.store_outputs(
+            cache, [keys[i] for i in missing], new_filenames, "sensor"
         )
-
-        # Calculate the B-field for every single point in our path
-        # The 'sampled_points' array is the "grid" that getB needs.
-        B_field_data = source_sphere.getB(sampled_points)
-
-        b_field_end = time.time()
+    b_field_end = time.time()
+    b_field_time = b_field_end - b_field_start
+    print(f"B-field calculation finished in {b_field_time:.2f} seconds.")
+    if missing:
         print(
-            f"B-field calculation finished in {b_field_end - b_field_start:.2f} seconds."
+            f"{len(missing) * len(sampled_points) / b_field_time:,.0f} sensor samples/s, "
+            f"{b_field_time / len(missing):.2f} seconds per computed sensor."
         )
-        print("-" * 40)
+    print(f"{len(offsets) - len(missing)} of {len(offsets)} sensors reused from cache.")
+    storage.print_summary(filenames)
+    print("-" * 40)
 
-        # View the results
-        print(f"Shape of the coordinate array: {sampled_points.shape}")
+    # View the results
+    for offset, filename in zip(offsets, filenames):
+        B_field_data = storage.open_array(filename)
         print(f"Shape of the resulting B-field array: {B_field_data.shape}")
-        print(
-            "\nThis means for each of our N coordinates, we have a corresponding (Bx, By, Bz) vector."
-        )
-
-        print("\nExample Data:")
-        print("Coordinate Point [0]:", sampled_points[0])
+        print("Coordinate Point [0]:", sampled_points[0] + offset)
         print("B-field Vector   [0]:", B_field_data[0])
-
         print(
-            "\nCoordinate Point [170000]:", sampled_points[170000]
+            "Coordinate Point [170000]:", sampled_points[170000] + offset
         )  # End of first Y-sweep
         print("B-field Vector   [170000]:", B_field_data[170000])
-        output_dir = FILES["output_dir"]
-        os.makedirs(output_dir, exist_ok=True) 
-        z_offset_file_tag = int(z_offset_value * 1000)
-        np.save(f"{output_dir}/B-field_zoff_{z_offset_file_tag}.npy", B_field_data)
-        # np.save("simulated_path.npy", sampled_points)
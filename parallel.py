@@ -0,0 +1,281 @@
+"""
+Multi-core sharded B-field computation writing into shared .npy memmaps.
+
+The sample range is split into shards that are evaluated by a process pool.
+Every worker opens the preallocated output files itself and writes straight
+into its own slice, so no field data is ever pickled back to the parent.
+
+Load balancing: the range is cut into workers * shards_per_worker equal
+shards (each at least one chunk long) which are handed out dynamically, a
+worker that finishes early simply picks up the next shard. With the default
+of 4 shards per worker a slow core delays the run by at most ~1/4 of its
+share.
+
+Workers also return the field statistics and quantisation error of their
+shard (a few kB), which the parent merges into the sidecars of each output.
+
+Before dispatching, the first chunk is computed in the parent on a single
+core. Its throughput is the single-core baseline the speed-up is reported
+against.
+"""
+
+import multiprocessing
+import time
+
+import numpy as np
+
+import bfield_engine
+import checkpoint
+import field_stats
+import sensor_head
+import storage
+from config import PROCESSING
+
+
+def shard_ranges(start, stop, n_shards, min_shard_samples=1):
+    """Splits [start, stop) into at most n_shards near-equal (start, stop) ranges.
+
+    Args:
+        start (int): first sample
+        stop (int): one past the last sample
+        n_shards (int): number of shards wanted
+        min_shard_samples (int): smallest shard worth dispatching
+
+    Returns:
+        list: (start, stop) tuples in order
+    """
+    n_samples = max(stop - start, 0)
+    n_shards = max(1, min(n_shards, n_samples // max(min_shard_samples, 1)))
+    edges = start + (np.arange(n_shards + 1) * n_samples) // n_shards
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def fill_range(
+    source, points, filenames, start, stop, chunk_samples, offsets=None, rotations=None
+):
+    """Computes samples [start, stop) into existing .npy output files.
+
+    Args:
+        source: magpylib source (or collection) providing getB()
+        points: (n, 3) array-like path, or the filename of a .npy path
+        filenames (list): preallocated (n, 3) outputs, one per sensor
+        start (int): first sample
+        stop (int): one past the last sample
+        chunk_samples (int): observer positions per getB() call
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets, None evaluates
+            the path itself into filenames[0]
+        rotations (Rotation): optional per-sensor orientations
+
+    Returns:
+        tuple: (field_stats.FieldStats, storage.QuantisationError) lists of
+        the range, one per output
+    """
+    if isinstance(points, str):
+        points = storage.open_array(points)
+    outputs = [storage.OutputArray.open(filename) for filename in filenames]
+    stats = [field_stats.FieldStats(len(output)) for output in outputs]
+    path_chunk = max(chunk_samples // len(outputs), 1)
+    for a, b in bfield_engine.chunk_ranges(stop - start, path_chunk):
+        a, b = a + start, b + start
+        chunk = np.asarray(points[a:b])
+        if offsets is None:
+            stats[0].update(a, outputs[0].write(a, source.getB(chunk)))
+        else:
+            B = sensor_head.compute_sensor_head(source, chunk, offsets, rotations)
+            for sensor, output in enumerate(outputs):
+                stats[sensor].update(a, output.write(a, B[:, sensor]))
+    for output in outputs:
+        output.flush()
+    return stats, [output.error for output in outputs]
+
+
+def _fill_shard(task):
+    """Process pool entry point, returns the shard range, its statistics,
+    quantisation errors and duration"""
+    shard_start = time.time()
+    stats, errors = fill_range(*task)
+    return task[3], task[4], stats, errors, time.time() - shard_start
+
+
+def compute_sharded(
+    source,
+    points,
+    filenames,
+    offsets=None,
+    rotations=None,
+    workers=None,
+    chunk_samples=None,
+    shards_per_worker=None,
+    precision=None,
+    journal_key=None,
+):
+    """Computes the B-field along points on several cores.
+
+    Args:
+        source: magpylib source (or collection) providing getB()
+        points: (n, 3) array-like path, e.g. a scan_path.ScanPath or a
+            memmap of a recorded scan path
+        filenames (list): output .npy filename per sensor
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets, None evaluates
+            the path itself into filenames[0]
+        rotations (Rotation): optional per-sensor orientations
+        workers (int): number of worker processes
+        chunk_samples (int): observer positions per getB() call
+        shards_per_worker (int): shards handed out per worker, more shards
+            balance better at a small dispatch cost
+        precision (str): storage precision of the outputs, defaults to
+            processing.storage_precision in config.yml, see storage.py
+        journal_key: JSON-able identity of the run, finished shards are
+            journaled under it and an interrupted run of the same key
+            resumed with any number of workers, see checkpoint.py
+
+    Returns:
+        dict: timing report with the single-core baseline and speed-up
+    """
+    if workers is None:
+        workers = PROCESSING["workers"]
+    if chunk_samples is None:
+        chunk_samples = PROCESSING["chunk_samples"]
+    if shards_per_worker is None:
+        shards_per_worker = PROCESSING["shards_per_worker"]
+    if offsets is None and len(filenames) != 1:
+        raise ValueError("without sensor offsets exactly one output is written")
+    if offsets is not None and len(filenames) != len(offsets):
+        raise ValueError("one output filename is needed per sensor")
+
+    n_samples = len(points)
+
+    def create():
+        if offsets is None:
+            full_scale = None
+            if storage.is_integer(precision):
+                full_scale = storage.estimate_full_scale(source.getB, points)
+            return [
+                storage.OutputArray.create(
+                    filenames[0], n_samples, precision, full_scale
+                )
+            ]
+        return sensor_head.create_outputs(
+            source, points, filenames, offsets, rotations, precision
+        )
+
+    path_chunk = max(chunk_samples // len(filenames), 1)
+    if journal_key is not None:
+        journal_key = {"run": journal_key, "path_chunk": path_chunk}
+    outputs, journal = checkpoint.open_outputs(filenames, create, journal_key)
+    for output in outputs:
+        output.flush()
+    # workers reopen a memmapped path from its file rather than unpickling it
+    if isinstance(points, (np.memmap, storage.StoredArray)):
+        shared_points = points.filename
+    else:
+        shared_points = points
+
+    stats = [field_stats.FieldStats(n_samples) for filename in filenames]
+    errors = [storage.QuantisationError() for filename in filenames]
+    todo = [(0, n_samples)]
+    if journal is not None:
+        journal.restore_errors(errors)
+        for start, stop in journal.done:
+            for a, b in bfield_engine.chunk_ranges(stop - start, path_chunk):
+                checkpoint.restore_stats(stats, outputs, a + start, b + start)
+        todo = journal.missing(0, n_samples)
+    n_todo = sum(stop - start for start, stop in todo)
+
+    def merge(range_stats, range_errors):
+        for output_stats, output_range_stats in zip(stats, range_stats):
+            output_stats.merge(output_range_stats)
+        for error, range_error in zip(errors, range_errors):
+            error.merge(range_error)
+
+    run_start = time.time()
+    # single-core baseline, measured on the first chunk still to do
+    baseline_rate = float("inf")
+    if todo:
+        baseline_start, stop = todo[0]
+        baseline_stop = min(baseline_start + path_chunk, stop)
+        merge(
+            *fill_range(
+                source,
+                points,
+                filenames,
+                baseline_start,
+                baseline_stop,
+                chunk_samples,
+                offsets,
+                rotations,
+            )
+        )
+        if journal is not None:
+            journal.record(baseline_start, baseline_stop, errors=errors)
+        baseline_time = time.time() - run_start
+        if baseline_time > 0:
+            baseline_rate = (baseline_stop - baseline_start) / baseline_time
+        todo[0] = (baseline_stop, stop)
+
+    n_shards = workers * shards_per_worker
+    shards = [
+        shard
+        for start, stop in todo
+        for shard in shard_ranges(
+            start, stop, max(1, round(n_shards * (stop - start) / n_todo)), path_chunk
+        )
+    ]
+    tasks = [
+        (source, shared_points, filenames, a, b, chunk_samples, offsets, rotations)
+        for a, b in shards
+    ]
+    shard_times = []
+    if tasks:
+        with multiprocessing.Pool(processes=workers) as pool:
+            for start, stop, shard_stats, shard_errors, duration in pool.imap_unordered(
+                _fill_shard, tasks
+            ):
+                merge(shard_stats, shard_errors)
+                # the worker flushed its shard before returning
+                if journal is not None:
+                    journal.record(start, stop, errors=errors)
+                shard_times.append(duration)
+                print(f"  shard {start:,}-{stop:,} done in {duration:.2f} s")
+    for output, error in zip(outputs, errors):
+        output.close(error)
+    for filename, output_stats in zip(filenames, stats):
+        output_stats.save(filename)
+    if journal is not None:
+        journal.finish()
+    wall_time = time.time() - run_start
+
+    serial_estimate = n_todo / baseline_rate
+    speed_up = serial_estimate / wall_time if wall_time > 0 else float("inf")
+    return {
+        "workers": workers,
+        "shards": len(shards),
+        "samples": n_todo,
+        "baseline_samples_per_s": baseline_rate,
+        "samples_per_s": n_todo / wall_time if wall_time > 0 else float("inf"),
+        "wall_time_s": wall_time,
+        "serial_estimate_s": serial_estimate,
+        "speed_up": speed_up,
+        "efficiency": speed_up / workers,
+        "shard_time_max_s": max(shard_times, default=0.0),
+        "shard_time_min_s": min(shard_times, default=0.0),
+    }
+
+
+def print_report(report):
+    """Prints the speed-up report returned by compute_sharded()"""
+    print(
+        f"{report['samples']:,} samples on {report['workers']} workers "
+        f"in {report['shards']} shards: {report['wall_time_s']:.2f} s"
+    )
+    print(
+        f"single-core baseline {report['baseline_samples_per_s']:,.0f} samples/s, "
+        f"sharded {report['samples_per_s']:,.0f} samples/s"
+    )
+    print(
+        f"speed-up {report['speed_up']:.2f}x vs estimated serial "
+        f"{report['serial_estimate_s']:.2f} s, efficiency {report['efficiency']:.0%}"
+    )
+    print(
+        f"shard times {report['shard_time_min_s']:.2f} - {report['shard_time_max_s']:.2f} s"
+    )
@@ -1,82 +1,30 @@
+import argparse
 import os
 import time
 import numpy as np
-import magpylib as magpy
 
-from config import FILES, SCAN_SETUP, SAMPLING, SYSTEM_PARAMETERS, SIMULATION_OBJECTS
+import bfield_engine
+import checkpoint
+import field_map
+import parallel
+import run_cache
+import scan_path
+import storage
+from config import FILES, MOTION_PROFILE, PROCESSING
 
 
 def simulate_constant_velocity_path():
     """
     Simulates the data acquisition path assuming constant velocity for each sweep.
     This generates a PATH, not a grid.
-    """
-    # System Parameters
-    SAMPLE_RATE = SAMPLING["rate_hz"]  # samples/sec
-
-    # Scan Dimensions (m) and Repetitions
-    MAX_X = SCAN_SETUP["dimensions_m"]["max_x"]
-    MAX_Y = SCAN_SETUP["dimensions_m"]["max_y"]
-    MAX_Z = SCAN_SETUP["dimensions_m"]["max_z"]
-    STEP_Z = SCAN_SETUP["step_sizes_m"]["z"]
-    STEP_X = SCAN_SETUP["step_sizes_m"]["x"]
-    N_X_REPEATS = SCAN_SETUP["repetitions"]["x_axis"]
-    N_Z_STEPS_PER_PLANE = SCAN_SETUP["repetitions"]["z_steps_per_plane"]
-
-    # Scan Durations (seconds)
-    TIME_Y_SCAN = SCAN_SETUP["durations_s"]["y_scan"]
-    TIME_Z_STEP = SCAN_SETUP["durations_s"]["z_scan"]
-    TIME_X_STEP = SCAN_SETUP["durations_s"]["x_scan"]
-
-    # Calculate samples per movement
-    SAMPLES_PER_Y_SCAN = int(SAMPLE_RATE * TIME_Y_SCAN)
-    SAMPLES_PER_Z_STEP = int(SAMPLE_RATE * TIME_Z_STEP)
-    SAMPLES_PER_X_STEP = int(SAMPLE_RATE * TIME_X_STEP)
-
-    # Simulation
-    path_segments = []
-    current_x, current_y, current_z = 0.0, 0.0, 0.0
 
+    The full (n, 3) array is materialised from the lazy segment table, prefer
+    scan_path.build_constant_velocity_path() which never holds it in memory.
+    """
     print("Simulating constant velocity scan path...")
     start_time = time.time()
 
-    for i_x in range(N_X_REPEATS):
-        # Scan a full plane (10 Y-sweeps and 10 Z-steps)
-        for i_z_step in range(N_Z_STEPS_PER_PLANE):
-            # Y-Axis Scan (back and forth)
-            start_y, end_y = current_y, MAX_Y if i_z_step % 2 == 0 else 0.0
-
-            y_coords = np.linspace(start_y, end_y, SAMPLES_PER_Y_SCAN)
-            x_coords = np.full(SAMPLES_PER_Y_SCAN, current_x)
-            z_coords = np.full(SAMPLES_PER_Y_SCAN, current_z)
-            path_segments.append(np.column_stack((x_coords, y_coords, z_coords)))
-            current_y = end_y
-
-            # Z-Axis Step
-            start_z, end_z = current_z, current_z + STEP_Z
-
-            z_coords = np.linspace(start_z, end_z, SAMPLES_PER_Z_STEP)
-            x_coords = np.full(SAMPLES_PER_Z_STEP, current_x)
-            y_coords = np.full(SAMPLES_PER_Z_STEP, current_y)
-            path_segments.append(np.column_stack((x_coords, y_coords, z_coords)))
-            current_z = end_z
-
-        current_z = 0.0  # Reset Z for the next plane
-
-        # X-Axis Step (if it's not the last plane)
-        if i_x < N_X_REPEATS - 1:
-            start_x, end_x = current_x, current_x + STEP_X
-
-            x_coords = np.linspace(start_x, end_x, SAMPLES_PER_X_STEP)
-            y_coords = np.full(SAMPLES_PER_X_STEP, current_y)
-            z_coords = np.full(SAMPLES_PER_X_STEP, current_z)
-            path_segments.append(np.column_stack((x_coords, y_coords, z_coords)))
-            current_x = end_x
-
-        print(f"  Completed plane {i_x + 1}/{N_X_REPEATS}...")
-
-    print("\nConcatenating all path segments...")
-    all_sample_points = np.vstack(path_segments)
+    all_sample_points = np.asarray(scan_path.build_constant_velocity_path())
     end_time = time.time()
 
     print("-" * 30)
@@ -87,40 +35,158 @@ def simulate_constant_velocity_path():
     return all_sample_points
 
 
+def write_recorded_scan_path(sampled_points, filename, chunk_samples, precision=None):
+    """
+    Writes a lazy scan path chunk by chunk into a legacy (n, 3) .npy file.
+
+    Args:
+        sampled_points (scan_path.ScanPath): path to materialise
+        filename (str): .npy file the path is written to
+        chunk_samples (int): samples written per chunk
+        precision (str): storage precision, integers span the largest
+            coordinate of the path exactly
+    """
+    full_scale = None
+    if storage.is_integer(precision):
+        segments = sampled_points.segments
+        full_scale = max(np.abs(segments["start"]).max(), np.abs(segments["end"]).max())
+    recorded = storage.OutputArray.create(
+        filename, len(sampled_points), precision, full_scale
+    )
+    for start, stop, points in sampled_points.iter_chunks(chunk_samples):
+        recorded.write(start, points)
+    recorded.close()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--chunk-samples",
+        type=int,
+        default=PROCESSING["chunk_samples"],
+        help="samples evaluated per getB() call",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=PROCESSING["workers"],
+        help="worker processes sharing the B-field computation",
+    )
+    parser.add_argument(
+        "--save-full-path",
+        action="store_true",
+        help="also write the materialised path to files.recorded_scan_path",
+    )
+    parser.add_argument(
+        "--precision",
+        choices=list(storage.PRECISIONS),
+        default=PROCESSING["storage_precision"],
+        help="storage precision of the B-field files, see storage.py",
+    )
+    parser.add_argument(
+        "--field-map",
+        action="store_true",
+        help="interpolate from the field lookup table (field_map.py) instead of "
+        "evaluating the source",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        default=PROCESSING["run_cache"],
+        help="recompute the B-field even if the run cache (run_cache.py) holds it",
+    )
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        default=PROCESSING["resume"],
+        help="start over instead of resuming an interrupted run, see checkpoint.py",
+    )
+    args = parser.parse_args()
+
     scan_path_filepath = FILES["recorded_scan_path"]
+    segments_filepath = FILES["scan_path_segments"]
+    index_filepath = FILES["scan_index"]
     bfield_filepath = FILES["input_list"][0]
+    output_dir = FILES["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
 
-    # 1. Generate the entire path of sample coordinates
+    # 1. Generate the segment table of the path, samples are computed lazily
+    print(f"Simulating {MOTION_PROFILE.get('mode', 'constant_velocity')} scan path...")
     path_generation_start = time.time()
-    sampled_points = simulate_constant_velocity_path()
+    sampled_points = scan_path.build_scan_path()
+    sampled_points.save(segments_filepath)
+    scan_path.save_index(sampled_points.index(), index_filepath)
+    if args.save_full_path:
+        write_recorded_scan_path(
+            sampled_points, scan_path_filepath, args.chunk_samples, args.precision
+        )
     path_generation_end = time.time()
     print(
         f"Path generation finished in {path_generation_end - path_generation_start:.2f} seconds."
     )
-    print(f"Generated {sampled_points.shape[0]:,} coordinate points.")
+    scan_path.print_timing(sampled_points)
     print("-" * 40)
 
-    # 2. Perform the B-field calculation on the generated path
-    print("Starting B-field calculation...")
-    b_field_start = time.time()
-
-    # Define the magnetic source
-    D = SIMULATION_OBJECTS["system_under_test"]["diameter"]
-    P = SIMULATION_OBJECTS["system_under_test"]["polarization"]
-    posx = SIMULATION_OBJECTS["system_under_test"]["position_m"]["x"]
-    posy = SIMULATION_OBJECTS["system_under_test"]["position_m"]["y"]
-    posz = SIMULATION_OBJECTS["system_under_test"]["position_m"]["z"]
-    source_sphere = magpy.magnet.Sphere(
-        position=(posx, posy, posz), polarization=P, diameter=D
+    # 2. Perform the B-field calculation on the generated path, unless an
+    # unchanged run left it in the cache
+    cache = run_cache.RunCache() if args.cache else None
+    key = run_cache.run_key(
+        "path",
+        sampled_points,
+        options=run_cache.stage_options(args.precision, args.field_map),
     )
-
-    # Calculate the B-field for every single point in our path
-    # The 'sampled_points' array is the "grid" that getB needs.
-    B_field_data = source_sphere.getB(sampled_points)
+    print(
+        f"Starting B-field calculation in chunks of {args.chunk_samples:,} samples..."
+    )
+    b_field_start = time.time()
+    if run_cache.fetch_outputs(cache, [key], [bfield_filepath]):
+        # Define the magnetic source
+        source_sphere = bfield_engine.create_source()
+        if args.field_map:
+            exact_source = source_sphere
+            source_sphere = field_map.FieldMap.load_or_build(exact_source)
+            field_map.print_error_bound(
+                source_sphere.error_bound(exact_source, sampled_points),
+                source_sphere.interpolation,
+            )
+
+        # Calculate the B-field for every single point in our path
+        # The 'sampled_points' array is the "grid" that getB needs.
+        # Progress is journaled, a rerun after a crash resumes where it stopped
+        if not args.resume:
+            checkpoint.discard([bfield_filepath])
+        if args.workers > 1:
+            report = parallel.compute_sharded(
+                source_sphere,
+                sampled_points,
+                [bfield_filepath],
+                workers=args.workers,
+                chunk_samples=args.chunk_samples,
+                precision=args.precision,
+                journal_key=key,
+            )
+            parallel.print_report(report)
+        else:
+            bfield_engine.compute_bfield_chunked(
+                source_sphere,
+                sampled_points,
+                bfield_filepath,
+                args.chunk_samples,
+                precision=args.precision,
+                journal_key=key,
+            )
+        run_cache.store_outputs(cache, [key], [bfield_filepath], "path")
+    B_field_data = storage.open_array(bfield_filepath)
 
     b_field_end = time.time()
     print(f"B-field calculation finished in {b_field_end - b_field_start:.2f} seconds.")
+    storage.print_summary(
+        [scan_path_filepath, bfield_filepath]
+        if args.save_full_path
+        else [bfield_filepath]
+    )
     print("-" * 40)
 
     # 3. View the results
@@ -136,7 +202,3 @@ if __name__ == "__main__":
     random_point = np.random.randint(0, sampled_points.shape[0] // 2)
     print(f"\nCoordinate Point [{random_point}]:", sampled_points[random_point])
     print(f"B-field Vector   [{random_point}]:", B_field_data[random_point])
-    output_dir = FILES["output_dir"]
-    os.makedirs(output_dir, exist_ok=True) 
-    np.save(bfield_filepath, B_field_data)
-    np.save(scan_path_filepath, sampled_points)
@@ -23,7 +23,8 @@ import matplotlib.pyplot as plt
 
 import magpylib as magpy
 
-from config import FILES, MOTION_PROFILE, SYSTEM_PARAMETERS, SAMPLING, SIMULATION_OBJECTS
+import scan_program
+from config import FILES, MOTION_PROFILE, SYSTEM_PARAMETERS, SAMPLING, SCAN_SETUP, SIMULATION_OBJECTS
 
 # All a in m/s**2
 x_a = MOTION_PROFILE['acceleration_m_per_s2']['x']
@@ -48,12 +49,6 @@ sample_clock_start = SAMPLING["clock_start"]
 encoder_resolution = SYSTEM_PARAMETERS["encoder_resolution"]
 
 
-pos_y_sweep = np.array([0, 0.300, 0])
-pos_z_shift = np.array([0, 0, 0.015])
-neg_y_sweep = -1 * pos_y_sweep
-neg_z_shift = -1 * pos_z_shift
-x_shift = np.array([0.010, 0, 0])
-
 # dummy magnet
 # add a sphere that defines the system under test
 D = SIMULATION_OBJECTS["system_under_test"]["diameter"]
@@ -62,129 +57,28 @@ Ys = SIMULATION_OBJECTS["system_under_test"]["position_m"]["y"]
 Zs = SIMULATION_OBJECTS["system_under_test"]["position_m"]["z"]
 obj_sphere = magpy.magnet.Sphere(position=(Xs, Ys, Zs), diameter=D)
 
+origin = SYSTEM_PARAMETERS["origin_m"]
+
 
-def walk_sequence(sequence_of_steps):
+def run(scan_setup=None):
     """
-    Recursively walks through the nested list of sequences and yields
-    each individual position vector one by one.
+    Waypoints of the scan the simulation runs: scan_setup.program of
+    config.yml compiled to its segment table by scan_program.py, the start of
+    every move followed by its end.
     """
-    for step in sequence_of_steps:
-        # Check if step is a list/tuple (and therefore a subsequence)
-        if isinstance(step, (list, tuple)):
-            yield from walk_sequence(step)
-        else:
-            # Otherwise it is assumed to be a vector and is yielded directly
-            yield step
-
-
-origin = SYSTEM_PARAMETERS["origin_m"]
-
-pos_yz_sequence = [pos_y_sweep, pos_z_shift, neg_y_sweep, pos_z_shift]
-neg_yz_sequence = [pos_y_sweep, neg_z_shift, neg_y_sweep, neg_z_shift]
-# neg_yz_sequence = [pos_y_sweep, neg_z_shift, neg_y_sweep, neg_z_shift]
-# yz_sequence repeated 10 times
-full_yz_sequence = [
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-    pos_yz_sequence,
-]
-
-full_neg_yz_sequence = [
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-    neg_yz_sequence,
-]
-
-# x_shift
-full_sequence = [
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-    full_yz_sequence,
-    x_shift,
-    full_neg_yz_sequence,
-    x_shift,
-]
-
-
-def run():
-    position = np.array(origin, dtype=np.float64)
-    position_history = [origin.copy()]
-    for vector in walk_sequence(full_sequence):
-        position += vector
-        position_history.append(position.copy())
-        # debug print
-        # print(position)
-        # build the dataset here with the Bx,By,Bz values
-        # SPAD
-        # counters
+    if scan_setup is None:
+        scan_setup = SCAN_SETUP
+    program = scan_setup.get("program") or scan_program.raster_program(scan_setup)
+    segments = scan_program.compile_program(
+        program,
+        scan_setup["durations_s"],
+        None,
+        start=origin,
+        extent=scan_program.scan_extent(scan_setup),
+    )
+    position_history = np.empty((2 * len(segments), 3))
+    position_history[0::2] = segments["start"]
+    position_history[1::2] = segments["end"]
     return position_history
 
 
@@ -0,0 +1,700 @@
+"""
+The whole simulation as one streaming pipeline, run with
+
+    python -m octobee run config.yml
+
+Path generation, the B-field of the sensor head and the muxer run as threads
+connected by bounded queues of chunks, processing.pipeline_queue_chunks deep:
+
+    path --positions--> bfield --rows on disk--> mux
+
+The path stage computes the positions of each chunk of the scan path. The
+B-field stage evaluates every sensor of the head along them (with --dedup
+only the first of coincident lines, see segment_dedup.py) and writes them
+into the sensor files. The muxer writes the ACQ400 records once the B-field
+of the records it muxes is on disk and their gains are known, while the
+B-field stage carries on with the rest of the path. numpy and the field
+kernels release the GIL for the heavy work, so the stages overlap and the
+wall time approaches that of the slowest stage rather than the sum of all
+three.
+
+The files written are those of running path_scan_bfield_computation.py,
+offset_path_scan.py and write_muxed_data.py in turn. Sensor files held by
+the run cache (run_cache.py) are linked rather than recomputed; when all of
+them are, the path and B-field stages are skipped and the muxer reads the
+linked files. The B-field stage journals its progress like
+offset_path_scan.py does (checkpoint.py), so either can resume the other's
+interrupted run.
+
+run_direct(), python -m octobee run --direct, skips the B-field files
+altogether: the B-field stage hands the field of every chunk to the muxer
+in memory and only the ACQ400 records are written, so the disk holds no
+more than the final product. Only the records of the acquisition are
+evaluated, with gains from the run cache or a pre-pass over them.
+
+At the end every stage reports its samples/s, MB/s and the time it spent
+waiting on its queues, and every queue its mean and peak occupancy.
+"""
+
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+import bfield_engine
+import checkpoint
+import field_stats
+import run_cache
+import scan_path
+import segment_dedup
+import sensor_head
+import storage
+import write_muxed_data
+from config import FILES, MOTION_PROFILE, PROCESSING
+
+
+class Aborted(Exception):
+    """Raised in a stage when another stage has failed"""
+
+
+class Channel:
+    """Bounded queue of chunks between two stages, recording its occupancy.
+
+    Args:
+        name (str): name in the report
+        maxsize (int): chunks held before the producer blocks
+        abort (threading.Event): set when any stage fails
+    """
+
+    def __init__(self, name, maxsize, abort):
+        self.name = name
+        self.maxsize = maxsize
+        self.abort = abort
+        self.queue = queue.Queue(maxsize)
+        self.items = 0
+        self.occupancy = 0
+        self.peak = 0
+        self.blocked_s = 0.0
+        self.starved_s = 0.0
+
+    def put(self, item):
+        """Queues a chunk, waiting while the queue is full"""
+        t = time.time()
+        while True:
+            if self.abort.is_set():
+                raise Aborted
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.blocked_s += time.time() - t
+        depth = self.queue.qsize()
+        self.items += 1
+        self.occupancy += depth
+        self.peak = max(self.peak, depth)
+
+    def close(self):
+        """Tells the consumer no more chunks follow"""
+        self.put(None)
+
+    def __iter__(self):
+        """Yields chunks until the producer closes the channel"""
+        while True:
+            t = time.time()
+            while True:
+                if self.abort.is_set():
+                    raise Aborted
+                try:
+                    item = self.queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+            self.starved_s += time.time() - t
+            if item is None:
+                return
+            yield item
+
+    @property
+    def mean_occupancy(self):
+        """Average chunks queued, sampled after every put"""
+        return self.occupancy / self.items if self.items else 0.0
+
+
+class Stage(threading.Thread):
+    """A pipeline stage running body(stage) in its own thread.
+
+    The body counts its work in stage.samples and stage.bytes. A failing
+    stage sets the shared abort event so the others stop too.
+
+    Args:
+        name (str): name in the report
+        body: callable taking the stage
+        abort (threading.Event): shared by all stages
+        inputs (list): channels the stage reads
+        outputs (list): channels the stage writes
+    """
+
+    def __init__(self, name, body, abort, inputs=(), outputs=()):
+        super().__init__(name=name, daemon=True)
+        self.body = body
+        self.abort = abort
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.samples = 0
+        self.bytes = 0
+        self.error = None
+        self.wall_s = 0.0
+
+    def run(self):
+        start = time.time()
+        try:
+            self.body(self)
+        except Aborted:
+            pass
+        except BaseException as error:
+            self.error = error
+            self.abort.set()
+        finally:
+            self.wall_s = time.time() - start
+
+    @property
+    def waiting_s(self):
+        """Time spent waiting for input chunks or for room downstream"""
+        return sum(c.starved_s for c in self.inputs) + sum(
+            c.blocked_s for c in self.outputs
+        )
+
+
+def path_stage(points, path_chunk, out, stop=None):
+    """Body of the stage computing the path positions chunk by chunk, up to
+    sample stop (the whole path by default)"""
+
+    def body(stage):
+        for a, b, positions in points.iter_chunks(path_chunk, 0, stop):
+            out.put((a, b, positions))
+            stage.samples += b - a
+            stage.bytes += positions.nbytes
+        out.close()
+
+    return body
+
+
+def bfield_stage(
+    source,
+    points,
+    filenames,
+    offsets,
+    rotations,
+    precision,
+    dedup,
+    stats,
+    journal_key,
+    inp,
+    out,
+):
+    """Body of the stage writing the B-field of every sensor.
+
+    Args:
+        dedup (segment_dedup.SegmentDedup): plan of coincident lines, None
+            evaluates every sensor
+        stats (list): field_stats.FieldStats per sensor, filled in
+        journal_key: run keys to journal progress under, see checkpoint.py
+        inp (Channel): (start, stop, positions) chunks of the path
+        out (Channel): (start, stop) rows written into every sensor file
+
+    The other arguments are those of sensor_head.compute_sensor_head_chunked().
+    """
+    matrices = None if rotations is None else rotations.as_matrix()
+
+    def body(stage):
+        outputs, journal = checkpoint.open_outputs(
+            filenames,
+            lambda: sensor_head.create_outputs(
+                source, points, filenames, offsets, rotations, precision
+            ),
+            journal_key,
+        )
+        for start, stop, positions in inp:
+            if journal is not None and journal.is_done(start, stop):
+                checkpoint.restore_stats(stats, outputs, start, stop)
+            else:
+                if dedup is not None:
+                    B = segment_dedup.evaluate_chunk(
+                        source,
+                        points,
+                        positions,
+                        start,
+                        offsets,
+                        outputs,
+                        dedup,
+                        matrices,
+                    )[0]
+                else:
+                    B = sensor_head.compute_sensor_head(
+                        source, positions, offsets, rotations
+                    )
+                for sensor, output in enumerate(outputs):
+                    stats[sensor].update(start, output.write(start, B[:, sensor]))
+                if journal is not None:
+                    journal.record(start, stop, outputs)
+                stage.bytes += (
+                    (stop - start) * 3 * sum(output.raw.itemsize for output in outputs)
+                )
+            stage.samples += (stop - start) * len(outputs)
+            out.put((start, stop))
+        for output in outputs:
+            output.close()
+        for filename, sensor_stats in zip(filenames, stats):
+            sensor_stats.save(filename)
+        if journal is not None:
+            journal.finish()
+        out.close()
+
+    return body
+
+
+def mux_stage(input_files, points, n_records, layouts, gains, inp, report):
+    """Body of the muxer stage.
+
+    Args:
+        input_files (list): B-field file of each sensor, in record order
+        points (scan_path.ScanPath): the path
+        n_records (int): records to write
+        layouts (dict): output filename -> record dtype
+        gains: callable returning the gains of every input, called once
+            rows [0, n_records) are on disk
+        inp (Channel): (start, stop) rows on disk, None if the inputs are
+            complete already
+        report (dict): filled with the write_muxed_files() statistics
+    """
+
+    def body(stage):
+        rows = iter(inp) if inp is not None else iter(())
+        on_disk = 0 if inp is not None else n_records
+        while on_disk < n_records:
+            try:
+                start, stop = next(rows)
+            except StopIteration:
+                break
+            on_disk = stop
+        report.update(
+            write_muxed_data.write_muxed_files(
+                input_files, points, n_records, layouts, gains=gains()
+            )
+        )
+        stage.samples = n_records
+        stage.bytes = report["write_bytes"]
+        # let the B-field stage finish the rest of the path
+        for item in rows:
+            pass
+
+    return body
+
+
+def head_stage(source, offsets, rotations, inp, out):
+    """Body of the stage evaluating every sensor along chunks of the path,
+    kept in memory for the record stage.
+
+    Args:
+        inp (Channel): (start, stop, positions) chunks of the path
+        out (Channel): (start, stop, positions, B) with B the (n, n_sensors, 3)
+            field of the chunk
+    """
+
+    def body(stage):
+        for start, stop, positions in inp:
+            B = sensor_head.compute_sensor_head(source, positions, offsets, rotations)
+            out.put((start, stop, positions, B))
+            stage.samples += (stop - start) * len(offsets)
+            stage.bytes += B.nbytes
+        out.close()
+
+    return body
+
+
+def record_stage(layouts, n_records, gains, inp):
+    """Body of the stage muxing the chunks of head_stage() straight into the
+    ACQ400 files of every layout"""
+
+    def body(stage):
+        files = {filename: open(filename, "wb") for filename in layouts}
+        try:
+            for start, stop, positions, B in inp:
+                selections = [B[:, sensor] for sensor in range(B.shape[1])]
+                for filename, dtype in layouts.items():
+                    result = write_muxed_data.mux_records(
+                        dtype, selections, gains, positions, start, stop, n_records
+                    )
+                    result.tofile(files[filename])
+                    stage.bytes += result.nbytes
+                stage.samples += stop - start
+        finally:
+            for fh in files.values():
+                fh.close()
+
+    return body
+
+
+def run_stages(stages):
+    """Starts the stages, waits for all of them and re-raises the first
+    error"""
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+
+def print_report(stages, channels, wall_s):
+    """Prints the throughput of every stage and the occupancy of every queue"""
+    print(
+        f"{'stage':8s} {'samples':>14s} {'wall s':>8s} {'waiting s':>10s} "
+        f"{'samples/s':>12s} {'MB/s':>8s}"
+    )
+    for stage in stages:
+        busy = max(stage.wall_s - stage.waiting_s, 1e-9)
+        print(
+            f"{stage.name:8s} {stage.samples:14,d} {stage.wall_s:8.2f} "
+            f"{stage.waiting_s:10.2f} {stage.samples / busy:12,.0f} "
+            f"{stage.bytes / 1e6 / busy:8,.1f}"
+        )
+    for channel in channels:
+        print(
+            f"queue {channel.name}: {channel.items:,} chunks, occupancy mean "
+            f"{channel.mean_occupancy:.1f} peak {channel.peak} of {channel.maxsize}, "
+            f"producer blocked {channel.blocked_s:.2f} s, "
+            f"consumer starved {channel.starved_s:.2f} s"
+        )
+    busiest = max(stages, key=lambda s: s.wall_s - s.waiting_s, default=None)
+    if busiest is not None:
+        serial = sum(s.wall_s - s.waiting_s for s in stages)
+        print(
+            f"total {wall_s:.2f} s, slowest stage {busiest.name} "
+            f"{busiest.wall_s - busiest.waiting_s:.2f} s busy, "
+            f"{serial:.2f} s of work in all stages"
+        )
+
+
+def run(
+    chunk_samples=None,
+    queue_chunks=None,
+    precision=None,
+    dedup=None,
+    cache=None,
+    resume=None,
+):
+    """Runs the simulation from the scan path to the muxed files.
+
+    Args:
+        chunk_samples (int): observer positions per getB() call, defaults to
+            processing.chunk_samples in config.yml
+        queue_chunks (int): chunks held by each queue, defaults to
+            processing.pipeline_queue_chunks
+        precision (str): storage precision of the sensor files, defaults to
+            processing.storage_precision
+        dedup (bool): evaluate coincident sensor lines once, defaults to
+            processing.dedup_segments
+        cache (bool): reuse sensor files from the run cache, defaults to
+            processing.run_cache
+        resume (bool): resume an interrupted B-field stage, defaults to
+            processing.resume
+
+    Returns:
+        list: the stages, with their counters
+    """
+    if chunk_samples is None:
+        chunk_samples = PROCESSING["chunk_samples"]
+    if queue_chunks is None:
+        queue_chunks = PROCESSING["pipeline_queue_chunks"]
+    if precision is None:
+        precision = PROCESSING["storage_precision"]
+    if dedup is None:
+        dedup = PROCESSING["dedup_segments"]
+    if cache is None:
+        cache = PROCESSING["run_cache"]
+    if resume is None:
+        resume = PROCESSING["resume"]
+    storage.storage_dtype(precision)  # fail before any work on a bad name
+    run_start = time.time()
+
+    print(f"Simulating {MOTION_PROFILE.get('mode', 'constant_velocity')} scan path...")
+    os.makedirs(FILES["output_dir"], exist_ok=True)
+    points = scan_path.build_scan_path()
+    points.save(FILES["scan_path_segments"])
+    scan_path.save_index(points.index(), FILES["scan_index"])
+    scan_path.print_timing(points)
+
+    offsets = sensor_head.sensor_offsets()
+    rotations = sensor_head.sensor_rotations()
+    filenames = sensor_head.output_filenames(offsets, FILES["output_dir"])
+    keys = run_cache.sensor_keys(
+        points, offsets, rotations, run_cache.stage_options(precision, False, dedup)
+    )
+    output_cache = run_cache.RunCache() if cache else None
+    missing = run_cache.fetch_outputs(output_cache, keys, filenames)
+    new_offsets = offsets[missing]
+    new_rotations = None if rotations is None else rotations[missing]
+    new_filenames = [filenames[i] for i in missing]
+    print(f"{len(offsets) - len(missing)} of {len(offsets)} sensors reused from cache.")
+
+    abort = threading.Event()
+    stages, channels = [], []
+    stats = [field_stats.FieldStats(len(points)) for filename in new_filenames]
+    rows = None
+    if missing:
+        positions = Channel("positions", queue_chunks, abort)
+        rows = Channel("rows", queue_chunks, abort)
+        channels = [positions, rows]
+        path_chunk = max(chunk_samples // len(missing), 1)
+        plan = None
+        journal_key = {"run": [keys[i] for i in missing], "path_chunk": path_chunk}
+        source = bfield_engine.create_source()
+        if dedup:
+            plan = segment_dedup.SegmentDedup(
+                points.segments, new_offsets, new_rotations, source=source
+            )
+            journal_key["dedup"] = True
+            print(f"Coincident sensor lines: dedup ratio {plan.ratio:.3f}")
+        if not resume:
+            checkpoint.discard(new_filenames)
+        stages.append(
+            Stage(
+                "path",
+                path_stage(points, path_chunk, positions),
+                abort,
+                (),
+                [positions],
+            )
+        )
+        stages.append(
+            Stage(
+                "bfield",
+                bfield_stage(
+                    source,
+                    points,
+                    new_filenames,
+                    new_offsets,
+                    new_rotations,
+                    precision,
+                    plan,
+                    stats,
+                    journal_key,
+                    positions,
+                    rows,
+                ),
+                abort,
+                [positions],
+                [rows],
+            )
+        )
+
+    input_files = FILES["input_list"]
+    n_records = write_muxed_data.configured_records()
+    layouts = write_muxed_data.output_layouts()
+    live = dict(zip(new_filenames, stats))
+
+    def gains():
+        # sensors computed here have their statistics in memory already
+        return [
+            (
+                write_muxed_data._sensor_gains(
+                    *live[f].prefix_range(n_records, storage.open_array(f))
+                )
+                if f in live
+                else write_muxed_data.input_gains([f], n_records)[0]
+            )
+            for f in input_files
+        ]
+
+    mux_report = {}
+    stages.append(
+        Stage(
+            "mux",
+            mux_stage(input_files, points, n_records, layouts, gains, rows, mux_report),
+            abort,
+            [rows] if rows is not None else [],
+        )
+    )
+
+    run_stages(stages)
+    run_cache.store_outputs(
+        output_cache, [keys[i] for i in missing], new_filenames, "sensor"
+    )
+    write_muxed_data.save_indexes(points, n_records, layouts)
+
+    print("-" * 40)
+    storage.print_summary(filenames)
+    print(f"Wrote {n_records:,} records to {' and '.join(layouts)}")
+    write_muxed_data.print_throughput(mux_report)
+    print("-" * 40)
+    print_report(stages, channels, time.time() - run_start)
+    return stages
+
+
+def cached_gains(cache, keys, filenames, n_records):
+    """Gains of every sensor from the statistics of its cached B-field file,
+    read in place.
+
+    Args:
+        cache (RunCache): cache to look in
+        keys (list): run keys to try for each sensor, in order of preference
+        filenames (list): B-field filename of each sensor
+        n_records (int): records the gains cover
+
+    Returns:
+        list or None: 4 channel gains per sensor, None unless every sensor
+        is cached
+    """
+    cached = []
+    for sensor_keys, filename in zip(keys, filenames):
+        paths = [cache.path(key, filename) for key in sensor_keys]
+        paths = [path for path in paths if path is not None]
+        if not paths:
+            return None
+        cached.append(paths[0])
+    return write_muxed_data.input_gains(cached, n_records)
+
+
+def prepass_gains(source, points, n_records, offsets, rotations, path_chunk):
+    """Gains of every sensor from one pass evaluating records [0, n_records),
+    keeping only the component ranges"""
+    mins = np.full((len(offsets), 3), np.inf)
+    maxs = np.full((len(offsets), 3), -np.inf)
+    for start, stop, positions in points.iter_chunks(path_chunk, 0, n_records):
+        B = sensor_head.compute_sensor_head(source, positions, offsets, rotations)
+        np.minimum(mins, B.min(axis=0), out=mins)
+        np.maximum(maxs, B.max(axis=0), out=maxs)
+    return write_muxed_data.range_gains(mins, maxs)
+
+
+def record_sensors():
+    """Offsets and orientations of the sensors of a record, in the order of
+    files.input_list in config.yml
+
+    Returns:
+        tuple: (n_sensors, 3) offsets and Rotation or None
+    """
+    offsets = sensor_head.sensor_offsets()
+    rotations = sensor_head.sensor_rotations()
+    filenames = sensor_head.output_filenames(offsets, FILES["output_dir"])
+    input_files = FILES["input_list"]
+    unknown = [f for f in input_files if f not in filenames]
+    if unknown:
+        raise ValueError(f"{', '.join(unknown)} are not sensors of the head")
+    sensors = [filenames.index(f) for f in input_files]
+    return offsets[sensors], None if rotations is None else rotations[sensors]
+
+
+def direct_gains(source, points, n_records, offsets, rotations, path_chunk, cache):
+    """Gains of the sensors of record_sensors() over records [0, n_records),
+    from the run cache if cache is set and it holds every sensor, otherwise
+    from prepass_gains()"""
+    t = time.time()
+    gains = None
+    if cache:
+        keys = [
+            run_cache.sensor_keys(
+                points,
+                offsets,
+                rotations,
+                run_cache.stage_options("float64", False, dedup),
+            )
+            for dedup in (False, True)
+        ]
+        gains = cached_gains(
+            run_cache.RunCache(), zip(*keys), FILES["input_list"], n_records
+        )
+    if gains is not None:
+        print(f"Gains from the run cache in {time.time() - t:.2f} s")
+        return gains
+    gains = prepass_gains(source, points, n_records, offsets, rotations, path_chunk)
+    print(
+        f"Gains from a pre-pass over {n_records:,} records in {time.time() - t:.2f} s"
+    )
+    return gains
+
+
+def run_direct(chunk_samples=None, queue_chunks=None, cache=None):
+    """Runs the simulation straight from the scan path to the muxed files,
+    without intermediate B-field files.
+
+    Only the records of the acquisition are evaluated, in float64. The
+    gains have to be known before the first record is written: they are
+    read from the statistics of the sensors in the run cache when it holds
+    all of them, otherwise a pre-pass evaluates the records once more for
+    their ranges. The muxed files are identical to those of run() with
+    --precision float64 and without --dedup; coincident lines are not
+    deduplicated, as copying them needs the earlier samples on disk.
+
+    Args:
+        chunk_samples (int): observer positions per getB() call, defaults to
+            processing.chunk_samples in config.yml
+        queue_chunks (int): chunks held by each queue, defaults to
+            processing.pipeline_queue_chunks
+        cache (bool): take the gains from the run cache, defaults to
+            processing.run_cache
+
+    Returns:
+        list: the stages, with their counters
+    """
+    if chunk_samples is None:
+        chunk_samples = PROCESSING["chunk_samples"]
+    if queue_chunks is None:
+        queue_chunks = PROCESSING["pipeline_queue_chunks"]
+    if cache is None:
+        cache = PROCESSING["run_cache"]
+    run_start = time.time()
+
+    print(f"Simulating {MOTION_PROFILE.get('mode', 'constant_velocity')} scan path...")
+    os.makedirs(FILES["output_dir"], exist_ok=True)
+    points = scan_path.build_scan_path()
+    scan_path.print_timing(points)
+    n_records = write_muxed_data.configured_records()
+    if n_records > len(points):
+        raise ValueError(f"the path holds {len(points)} samples, {n_records} needed")
+    layouts = write_muxed_data.output_layouts()
+
+    offsets, rotations = record_sensors()
+    source = bfield_engine.create_source()
+    path_chunk = max(chunk_samples // len(offsets), 1)
+    gains = direct_gains(
+        source, points, n_records, offsets, rotations, path_chunk, cache
+    )
+    for filename, gain in zip(FILES["input_list"], gains):
+        print(f"{filename} gains {gain}")
+
+    abort = threading.Event()
+    positions = Channel("positions", queue_chunks, abort)
+    fields = Channel("fields", queue_chunks, abort)
+    stages = [
+        Stage(
+            "path",
+            path_stage(points, path_chunk, positions, n_records),
+            abort,
+            (),
+            [positions],
+        ),
+        Stage(
+            "bfield",
+            head_stage(source, offsets, rotations, positions, fields),
+            abort,
+            [positions],
+            [fields],
+        ),
+        Stage("mux", record_stage(layouts, n_records, gains, fields), abort, [fields]),
+    ]
+    run_stages(stages)
+    write_muxed_data.save_indexes(points, n_records, layouts)
+
+    print("-" * 40)
+    for filename in layouts:
+        print(f"{filename}: {os.path.getsize(filename) / 1e6:,.1f} MB")
+    print(f"Wrote {n_records:,} records, no intermediate files")
+    print("-" * 40)
+    print_report(stages, [positions, fields], time.time() - run_start)
+    return stages
@@ -0,0 +1,365 @@
+"""
+Content-addressed cache of the B-field stage outputs.
+
+Every B-field file is keyed by a sha256 over everything its values depend on:
+
+    simulation_objects, scan_setup and sampling sections of config.yml
+    the sensor offset and orientation
+    the processing settings of the stage (storage precision and full scale,
+    field kernel, field map, dedup)
+    the scan path segment table, when the path is a ScanPath
+    a code version, hashed from the source of the modules computing values
+
+A finished output is hardlinked with its .stats.npz and .scale.json sidecars
+into <cache_dir>/<key>/ and recorded in <cache_dir>/manifest.json. When a
+stage is rerun with the same key the cached files are linked back into
+data/, so an unchanged rerun takes seconds and shares the existing arrays
+instead of writing new ones. Hardlinks need the cache directory to be on
+the same filesystem as data/, otherwise files are copied.
+
+The manifest records the size and last use of every entry. Entries are
+evicted, least recently used first, when the cache grows beyond
+processing.cache_quota_gb. Evicting an entry only drops the cache's link,
+files in data/ are left alone.
+
+Writers never modify cached files: storage.OutputArray.create() and the
+sidecar writers replace a file instead of writing into it, which breaks the
+link to the cache.
+
+Run this module to list the cache:
+
+    python run_cache.py
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import field_stats
+import storage
+from config import FILES, PROCESSING, SAMPLING, SCAN_SETUP, SIMULATION_OBJECTS
+
+# modules whose source determines the values of the B-field files
+CODE_MODULES = (
+    "bfield_engine",
+    "dipole",
+    "field_map",
+    "parallel",
+    "scan_path",
+    "scan_program",
+    "segment_dedup",
+    "sensor_head",
+    "storage",
+)
+
+MANIFEST = "manifest.json"
+
+
+def code_version():
+    """Digest of the source of the modules listed in CODE_MODULES"""
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_MODULES:
+        with open(os.path.join(here, f"{name}.py"), "rb") as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()[:16]
+
+
+def stage_options(precision=None, use_field_map=False, dedup=False):
+    """Processing settings that change the values a stage writes.
+
+    Args:
+        precision (str): storage precision, defaults to
+            processing.storage_precision in config.yml
+        use_field_map (bool): values are interpolated from field_map.py
+        dedup (bool): coincident sensor lines are copied, see segment_dedup.py
+
+    Returns:
+        dict: settings to include in run_key()
+    """
+    if precision is None:
+        precision = PROCESSING["storage_precision"]
+    options = {
+        "storage_precision": precision,
+        "field_kernel": PROCESSING["field_kernel"],
+        "field_map": None,
+        "dedup_resolution_m": PROCESSING["dedup_resolution_m"] if dedup else None,
+    }
+    if storage.is_integer(precision):
+        options.update(
+            storage_full_scale=PROCESSING["storage_full_scale"],
+            storage_headroom=PROCESSING["storage_headroom"],
+            storage_probe_samples=PROCESSING["storage_probe_samples"],
+        )
+    if use_field_map:
+        options["field_map"] = {
+            key: PROCESSING[key]
+            for key in (
+                "field_map_spacing_m",
+                "field_map_margin_m",
+                "field_map_interpolation",
+            )
+        }
+    return options
+
+
+def run_key(
+    stage, points, offset=None, rotation=None, options=None, simulation_objects=None
+):
+    """Cache key of one B-field output.
+
+    Args:
+        stage (str): name of the stage writing the file
+        points: path the sensor follows, a ScanPath contributes its segments
+        offset: (3,) sensor offset, None for the bare path
+        rotation (Rotation): orientation of the sensor, None if aligned
+        options (dict): stage_options() of the run, plus anything else the
+            values depend on
+        simulation_objects (dict): simulation_objects section to hash,
+            defaults to the one in config.yml
+
+    Returns:
+        str: hex digest
+    """
+    if simulation_objects is None:
+        simulation_objects = SIMULATION_OBJECTS
+    description = {
+        "stage": stage,
+        "simulation_objects": simulation_objects,
+        "scan_setup": SCAN_SETUP,
+        "sampling": SAMPLING,
+        "sensor_offset": None if offset is None else np.asarray(offset).tolist(),
+        "sensor_orientation": None if rotation is None else rotation.as_quat().tolist(),
+        "options": options,
+        "code_version": code_version(),
+    }
+    digest = hashlib.sha256(json.dumps(description, sort_keys=True).encode())
+    segments = getattr(points, "segments", None)
+    if segments is not None:
+        digest.update(np.ascontiguousarray(segments).tobytes())
+    else:
+        digest.update(repr(np.shape(points)).encode())
+    return digest.hexdigest()
+
+
+def sensor_keys(points, offsets, rotations=None, options=None):
+    """run_key() of the output of every sensor of the head.
+
+    Args:
+        points: path the sensor head follows
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets
+        rotations (Rotation): optional per-sensor orientations
+        options (dict): stage_options() of the run
+
+    Returns:
+        list: hex digest per sensor
+    """
+    options = dict(options or {})
+    if storage.is_integer(options.get("storage_precision")):
+        # the sensors share one full scale, estimated over the whole head
+        options["head_offsets"] = np.asarray(offsets).tolist()
+    return [
+        run_key(
+            "sensor",
+            points,
+            offset,
+            None if rotations is None else rotations[i],
+            options,
+        )
+        for i, offset in enumerate(offsets)
+    ]
+
+
+def output_files(filename):
+    """A B-field file and those of its sidecars that exist"""
+    sidecars = [field_stats.stats_filename(filename), storage.scale_filename(filename)]
+    return [filename] + [f for f in sidecars if os.path.exists(f)]
+
+
+def _link(source, destination):
+    """Hardlinks source to destination, replacing it, or copies across
+    filesystems"""
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class RunCache:
+    """Cache directory of B-field outputs, keyed by run_key().
+
+    Args:
+        directory (str): cache directory, defaults to files.cache_dir in
+            config.yml
+        quota_bytes (int): size the cache is evicted down to, defaults to
+            processing.cache_quota_gb in config.yml
+    """
+
+    def __init__(self, directory=None, quota_bytes=None):
+        if directory is None:
+            directory = FILES["cache_dir"]
+        if quota_bytes is None:
+            quota_bytes = int(PROCESSING["cache_quota_gb"] * 1e9)
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_filename = os.path.join(directory, MANIFEST)
+        try:
+            with open(self.manifest_filename) as fh:
+                self.entries = json.load(fh)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def _save(self):
+        tmp = f"{self.manifest_filename}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump(self.entries, fh, indent=2)
+        os.replace(tmp, self.manifest_filename)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.directory, key)
+
+    @property
+    def total_bytes(self):
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def fetch(self, key, filename):
+        """Links the cached output of key, and its sidecars, to filename.
+
+        Returns:
+            bool: True on a cache hit
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        directory = os.path.dirname(filename)
+        cached = [os.path.join(self._entry_dir(key), name) for name in entry["files"]]
+        if not all(os.path.exists(f) for f in cached):
+            # removed behind the manifest's back
+            self.remove(key)
+            return False
+        for stale in output_files(filename):
+            # sidecars of a different earlier run
+            if os.path.basename(stale) not in entry["files"]:
+                os.remove(stale)
+        for source in cached:
+            _link(source, os.path.join(directory, os.path.basename(source)))
+        entry["last_used"] = time.time()
+        entry["hits"] = entry.get("hits", 0) + 1
+        self._save()
+        return True
+
+    def path(self, key, filename):
+        """Cached copy of filename under key, read in place without linking
+        it into data/.
+
+        Returns:
+            str or None: the cached file, None on a miss
+        """
+        entry = self.entries.get(key)
+        name = os.path.basename(filename)
+        if entry is None or name not in entry["files"]:
+            return None
+        cached = os.path.join(self._entry_dir(key), name)
+        return cached if os.path.exists(cached) else None
+
+    def store(self, key, filename, stage=None):
+        """Adds a finished output and its sidecars under key, then evicts
+        least recently used entries beyond the quota"""
+        entry_dir = self._entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+        files = output_files(filename)
+        for source in files:
+            _link(source, os.path.join(entry_dir, os.path.basename(source)))
+        now = time.time()
+        self.entries[key] = {
+            "stage": stage,
+            "filename": filename,
+            "files": [os.path.basename(f) for f in files],
+            "bytes": sum(os.path.getsize(f) for f in files),
+            "created": now,
+            "last_used": now,
+            "hits": 0,
+        }
+        self.evict(keep=(key,))
+        self._save()
+
+    def remove(self, key):
+        """Drops an entry and its files from the cache"""
+        shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+        self.entries.pop(key, None)
+        self._save()
+
+    def evict(self, keep=()):
+        """Removes least recently used entries until the cache fits its quota.
+
+        Args:
+            keep: keys that are never evicted
+
+        Returns:
+            list: evicted keys
+        """
+        evicted = []
+        by_age = sorted(self.entries, key=lambda k: self.entries[k]["last_used"])
+        for key in by_age:
+            if self.total_bytes <= self.quota_bytes:
+                break
+            if key in keep:
+                continue
+            self.remove(key)
+            evicted.append(key)
+        return evicted
+
+
+def fetch_outputs(cache, keys, filenames):
+    """Links every cached output into place.
+
+    Args:
+        cache (RunCache): cache to look in, None disables caching
+        keys: run_key() of each output
+        filenames: output .npy filenames
+
+    Returns:
+        list: indices of the outputs that still need computing
+    """
+    if cache is None:
+        return list(range(len(filenames)))
+    missing = []
+    for i, (key, filename) in enumerate(zip(keys, filenames)):
+        if cache.fetch(key, filename):
+            print(f"{filename}: reused from cache {key[:12]}")
+        else:
+            missing.append(i)
+    return missing
+
+
+def store_outputs(cache, keys, filenames, stage=None):
+    """Adds freshly computed outputs to the cache, if caching is enabled"""
+    if cache is None:
+        return
+    for key, filename in zip(keys, filenames):
+        cache.store(key, filename, stage)
+
+
+if __name__ == "__main__":
+    cache = RunCache()
+    print(
+        f"{cache.directory}: {len(cache.entries)} entries, "
+        f"{cache.total_bytes / 1e9:.2f} of {cache.quota_bytes / 1e9:.2f} GB"
+    )
+    for key, entry in sorted(
+        cache.entries.items(), key=lambda item: -item[1]["last_used"]
+    ):
+        last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"]))
+        print(
+            f"{key[:12]}  {entry['stage'] or '-':8s} {entry['bytes'] / 1e6:10,.1f} MB  "
+            f"{last_used}  {entry['hits']} hits  {entry['filename']}"
+        )
@@ -0,0 +1,568 @@
+"""
+Lazy scan path backed by a compact segment table.
+
+The constant velocity scan is only ~630 linear segments, so rather than
+materialising every sample (2 GB of float64 for the default config) the path
+is stored as a table of (start, end, n_samples, offset) rows.
+Positions are computed on demand by vectorised interpolation and are
+bit-identical to the np.linspace / np.full construction they replace.
+
+    path = build_constant_velocity_path()
+    path[0], path[1000:2000], len(path)
+    for start, stop, points in path.iter_chunks(1_000_000): ...
+
+Each segment also records its place in the scan structure: kind (Y sweep,
+Z step or X step), plane number, line number within the plane and direction.
+ScanPath.index() turns that into a sample-range index which is saved as a
+sidecar next to the outputs, so a single sweep can be pulled out with one
+slice:
+
+    start, stop = find_segment(index, plane=12, line=3)
+
+Segments are either sampled at constant velocity (np.linspace between start
+and end) or, when their accel field is set, follow a trapezoidal motion
+profile: accelerate at accel up to v_max, cruise, decelerate to rest, sampled
+every dt seconds. Short moves that never reach v_max are triangular. The
+profile positions are closed-form piecewise quadratics in time, evaluated
+per chunk, so any sample rate streams in constant memory.
+build_scan_path() picks the profile from motion_profile.mode in config.yml.
+"""
+
+import numpy as np
+
+import scan_program
+import storage
+from config import FILES, MOTION_PROFILE, SAMPLING, SCAN_SETUP
+
+AXES = ("x", "y", "z")
+
+SEGMENT_DTYPE = np.dtype(
+    [
+        ("start", "<f8", (3,)),
+        ("end", "<f8", (3,)),
+        ("n_samples", "<i8"),
+        ("offset", "<i8"),
+        ("kind", "i1"),
+        ("plane", "<i4"),
+        ("line", "<i4"),
+        ("direction", "i1"),
+        ("accel", "<f8"),
+        ("v_max", "<f8"),
+        ("dt", "<f8"),
+    ]
+)
+
+# values of the kind field, -1 marks segments of unknown kind
+Y_SWEEP, Z_STEP, X_STEP = 0, 1, 2
+SEGMENT_KINDS = {"y_sweep": Y_SWEEP, "z_step": Z_STEP, "x_step": X_STEP}
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("kind", "i1"),
+        ("plane", "<i4"),
+        ("line", "<i4"),
+        ("direction", "i1"),
+        ("start", "<i8"),
+        ("stop", "<i8"),
+    ]
+)
+
+
+def linspace_slice(start, stop, num, a, b):
+    """Elements [a, b) of np.linspace(start, stop, num), without building it.
+
+    Reproduces the arithmetic of np.linspace exactly so the result is
+    bit-identical to slicing the full array. start and stop may be scalars or
+    arrays broadcast against the sample index.
+
+    Args:
+        start: first value (scalar or array)
+        stop: last value (scalar or array)
+        num (int): number of samples in the full linspace
+        a (int): first index
+        b (int): one past the last index
+
+    Returns:
+        np.ndarray: the requested samples
+    """
+    k = np.arange(a, b, dtype=np.float64)
+    return _interpolate(np.asarray(start), np.asarray(stop), num, k)
+
+
+def _interpolate(start, stop, num, k):
+    """np.linspace arithmetic evaluated at (float) sample indices k"""
+    div = num - 1
+    if np.ndim(start) or np.ndim(stop):
+        k = k.reshape((-1,) + (1,) * max(np.ndim(start), np.ndim(stop)))
+    if div > 0:
+        y = k * ((stop - start) / div)
+        y = y + start
+        # np.linspace pins the endpoint to stop exactly
+        last = k == div
+        if np.any(last):
+            y = np.where(last, stop, y)
+        return y
+    return k * 0 + start
+
+
+def profile_timing(length, accel, v_max):
+    """Timing of rest-to-rest trapezoidal moves, vectorised over moves.
+
+    Args:
+        length: distance of each move in m
+        accel: acceleration and deceleration in m/s^2
+        v_max: velocity limit in m/s
+
+    Returns:
+        tuple: (peak velocity, acceleration time, total time) per move, the
+        peak stays below v_max for moves too short to reach it
+    """
+    length, accel, v_max = np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (length, accel, v_max))
+    )
+    v_peak = np.minimum(v_max, np.sqrt(accel * length))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t_accel = np.where(v_peak > 0, v_peak / accel, 0.0)
+        t_cruise = np.where(v_peak > 0, length / v_peak - t_accel, 0.0)
+    return v_peak, t_accel, 2 * t_accel + t_cruise
+
+
+def profile_fraction(t, length, accel, v_max):
+    """Fraction of a trapezoidal move covered after t seconds.
+
+    All arguments broadcast against each other, t is clipped to the move.
+
+    Returns:
+        np.ndarray: distance covered / length, from 0 to 1
+    """
+    v_peak, t_accel, total = profile_timing(length, accel, v_max)
+    t = np.clip(t, 0.0, total)
+    covered = np.where(
+        t < t_accel,
+        0.5 * accel * t * t,
+        np.where(
+            t <= total - t_accel,
+            0.5 * accel * t_accel * t_accel + v_peak * (t - t_accel),
+            length - 0.5 * accel * (total - t) ** 2,
+        ),
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(length > 0, covered / length, 0.0)
+
+
+def _profile_points(start, end, accel, v_max, dt, k):
+    """Positions of samples k of trapezoidal segments, start, end and the
+    profile broadcast against k"""
+    length = np.linalg.norm(end - start, axis=-1)
+    fraction = profile_fraction(k * dt, length, accel, v_max)
+    return start + (end - start) * fraction[..., np.newaxis]
+
+
+class ScanPath:
+    """Scan path defined by linear segments, evaluated lazily.
+
+    Behaves like a read-only (n_samples, 3) float64 array for len(),
+    integer indexing, slicing and np.asarray(), without holding the samples
+    in memory.
+
+    Args:
+        segments (np.ndarray): table with SEGMENT_DTYPE, offsets are
+            recomputed from n_samples
+    """
+
+    dtype = np.dtype(np.float64)
+    ndim = 2
+
+    def __init__(self, segments):
+        segments = _as_segment_table(segments)
+        if np.any(segments["n_samples"] < 1):
+            raise ValueError("every segment needs at least one sample")
+        counts = segments["n_samples"]
+        segments["offset"] = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        self.segments = segments
+        self.n_samples = int(counts.sum())
+
+    @property
+    def shape(self):
+        return (self.n_samples, 3)
+
+    @property
+    def nbytes(self):
+        """Size of the materialised path in bytes"""
+        return self.n_samples * 3 * self.dtype.itemsize
+
+    def __len__(self):
+        return self.n_samples
+
+    def __repr__(self):
+        return f"ScanPath({len(self.segments)} segments, {self.n_samples:,} samples)"
+
+    def __array__(self, dtype=None, copy=None):
+        points = self.positions(0, self.n_samples)
+        return points if dtype is None else points.astype(dtype)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key[0], key[1:]
+            return self._index_rows(rows)[(Ellipsis,) + cols]
+        return self._index_rows(key)
+
+    def _index_rows(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n_samples)
+            if step == 1:
+                return self.positions(start, max(start, stop))
+            return self.take(np.arange(start, stop, step))
+        if np.ndim(key) == 0:
+            i = int(key)
+            if i < 0:
+                i += self.n_samples
+            if not 0 <= i < self.n_samples:
+                raise IndexError(f"index {key} out of range for {self.n_samples}")
+            return self.take(np.array([i]))[0]
+        return self.take(np.asarray(key))
+
+    def segment_of(self, indices):
+        """Segment number containing each sample index"""
+        return np.searchsorted(self.segments["offset"], indices, side="right") - 1
+
+    def take(self, indices):
+        """Positions of arbitrary sample indices.
+
+        Args:
+            indices (np.ndarray): sample numbers, negative values count from
+                the end
+
+        Returns:
+            np.ndarray: (len(indices), 3) positions
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        indices = np.where(indices < 0, indices + self.n_samples, indices)
+        if np.any((indices < 0) | (indices >= self.n_samples)):
+            raise IndexError("index out of range")
+        seg = self.segment_of(indices)
+        table = self.segments[seg]
+        k = (indices - table["offset"]).astype(np.float64)[:, np.newaxis]
+        div = (table["n_samples"] - 1)[:, np.newaxis]
+        start = table["start"]
+        end = table["end"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            points = k * ((end - start) / div) + start
+        # endpoints are pinned exactly, single sample segments sit at start
+        points = np.where(k == div, end, points)
+        points = np.where(div == 0, start, points)
+        profiled = table["accel"] > 0
+        if np.any(profiled):
+            rows = table[profiled]
+            points[profiled] = _profile_points(
+                rows["start"],
+                rows["end"],
+                rows["accel"],
+                rows["v_max"],
+                rows["dt"],
+                k[profiled, 0],
+            )
+        return points
+
+    def positions(self, start, stop):
+        """Positions of samples [start, stop) computed segment by segment.
+
+        Args:
+            start (int): first sample
+            stop (int): one past the last sample
+
+        Returns:
+            np.ndarray: (stop - start, 3) positions
+        """
+        out = np.empty((stop - start, 3), dtype=np.float64)
+        if stop <= start:
+            return out
+        first = self.segment_of(start)
+        last = self.segment_of(stop - 1)
+        for seg in self.segments[first : last + 1]:
+            a = max(start, seg["offset"]) - seg["offset"]
+            b = min(stop, seg["offset"] + seg["n_samples"]) - seg["offset"]
+            row = seg["offset"] + a - start
+            k = np.arange(a, b, dtype=np.float64)
+            if seg["accel"] > 0:
+                out[row : row + b - a] = _profile_points(
+                    seg["start"], seg["end"], seg["accel"], seg["v_max"], seg["dt"], k
+                )
+            else:
+                out[row : row + b - a] = _interpolate(
+                    seg["start"], seg["end"], int(seg["n_samples"]), k
+                )
+        return out
+
+    def durations(self):
+        """Motion time of every segment in s: the profile time of trapezoidal
+        segments, n_samples * dt of constant velocity ones (0 if unknown)"""
+        segments = self.segments
+        length = np.linalg.norm(segments["end"] - segments["start"], axis=1)
+        timing = profile_timing(length, segments["accel"], segments["v_max"])
+        profiled = segments["accel"] > 0
+        return np.where(profiled, timing[2], segments["n_samples"] * segments["dt"])
+
+    @property
+    def duration(self):
+        """Total motion time of the path in s"""
+        return float(self.durations().sum())
+
+    def iter_chunks(self, chunk_samples, start=0, stop=None):
+        """Yields (start, stop, positions) for consecutive chunks of samples.
+
+        Args:
+            chunk_samples (int): maximum samples per chunk
+            start (int): first sample
+            stop (int): one past the last sample, defaults to the path length
+        """
+        if stop is None:
+            stop = self.n_samples
+        for a in range(start, stop, chunk_samples):
+            b = min(a + chunk_samples, stop)
+            yield a, b, self.positions(a, b)
+
+    def index(self, n_samples=None):
+        """Scan-structure index of the path.
+
+        Args:
+            n_samples (int): only index samples [0, n_samples), e.g. the part
+                of the path written to a muxed file
+
+        Returns:
+            np.ndarray: INDEX_DTYPE row per segment with its sample range
+        """
+        if n_samples is None:
+            n_samples = self.n_samples
+        segments = self.segments[self.segments["offset"] < n_samples]
+        index = np.zeros(len(segments), dtype=INDEX_DTYPE)
+        for name in ["kind", "plane", "line", "direction"]:
+            index[name] = segments[name]
+        index["start"] = segments["offset"]
+        index["stop"] = np.minimum(
+            segments["offset"] + segments["n_samples"], n_samples
+        )
+        return index
+
+    def save(self, filename):
+        """Saves the segment table as a small .npy file"""
+        np.save(filename, self.segments)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a segment table saved by ScanPath.save()"""
+        return cls(np.load(filename))
+
+
+def _as_segment_table(segments):
+    """Converts rows or an older segment table to SEGMENT_DTYPE, fields
+    missing from older tables are left unknown"""
+    segments = np.asarray(segments)
+    if segments.dtype == SEGMENT_DTYPE:
+        return segments.copy()
+    if segments.dtype.names is None:
+        return np.array(segments.tolist(), dtype=SEGMENT_DTYPE)
+    table = np.zeros(len(segments), dtype=SEGMENT_DTYPE)
+    table["kind"] = -1
+    for name in segments.dtype.names:
+        table[name] = segments[name]
+    return table
+
+
+def save_index(index, filename):
+    """Saves a scan-structure index sidecar"""
+    np.save(filename, index)
+
+
+def load_index(filename):
+    """Loads a scan-structure index sidecar"""
+    return np.load(filename)
+
+
+def index_filename(filename):
+    """Index sidecar filename of a data file, e.g. binary_data.bin.index.npy"""
+    return f"{filename}.index.npy"
+
+
+def find_segment(index, plane, line, kind="y_sweep"):
+    """Sample range of one sweep or step.
+
+    Args:
+        index (np.ndarray): scan-structure index with INDEX_DTYPE
+        plane (int): X plane number, from 0
+        line (int): sweep or step number within the plane, from 0
+        kind (str): "y_sweep", "z_step" or "x_step" (which has line -1)
+
+    Returns:
+        tuple: (start, stop) sample range
+    """
+    match = np.flatnonzero(
+        (index["kind"] == SEGMENT_KINDS[kind])
+        & (index["plane"] == plane)
+        & (index["line"] == line)
+    )
+    if len(match) == 0:
+        raise KeyError(f"no {kind} with plane {plane} and line {line} in index")
+    row = index[match[0]]
+    return int(row["start"]), int(row["stop"])
+
+
+def build_constant_velocity_path(scan_setup=None, rate_hz=None):
+    """
+    Builds the segment table of the constant velocity raster scan: back and
+    forth Y sweeps joined by Z steps within each X plane, X steps between
+    planes. X steps carry the number of the plane they leave and line -1.
+    Every move takes its scan_setup.durations_s time. A scan_setup.program
+    replaces the raster scan, see scan_program.py.
+
+    Args:
+        scan_setup (dict): scan_setup section of config.yml
+        rate_hz (float): sample rate in samples/s
+
+    Returns:
+        ScanPath: the lazy path
+    """
+    if scan_setup is None:
+        scan_setup = SCAN_SETUP
+    if rate_hz is None:
+        rate_hz = SAMPLING["rate_hz"]
+    segments = _raster_segments(scan_setup, rate_hz)
+    return ScanPath(segments)
+
+
+def build_trapezoidal_path(scan_setup=None, motion_profile=None, rate_hz=None):
+    """
+    Builds the raster scan of build_constant_velocity_path() with every move
+    following a trapezoidal motion profile instead of a fixed duration.
+
+    Each move is limited by motion_profile.acceleration_m_per_s2 and
+    max_velocity_m_per_s of the axes it moves along (for a diagonal move the
+    tightest limit scaled onto the move direction) and sampled every
+    1 / rate_hz seconds, so the sample count follows from the physics.
+
+    Args:
+        scan_setup (dict): scan_setup section of config.yml
+        motion_profile (dict): motion_profile section of config.yml
+        rate_hz (float): sample rate in samples/s
+
+    Returns:
+        ScanPath: the lazy path
+    """
+    if scan_setup is None:
+        scan_setup = SCAN_SETUP
+    if motion_profile is None:
+        motion_profile = MOTION_PROFILE
+    if rate_hz is None:
+        rate_hz = SAMPLING["rate_hz"]
+    segments = _raster_segments(scan_setup)
+    apply_motion_profile(segments, motion_profile, rate_hz)
+    return ScanPath(segments)
+
+
+def apply_motion_profile(segments, motion_profile, rate_hz):
+    """Sets the trapezoidal profile and sample count of every segment.
+
+    Args:
+        segments (np.ndarray): SEGMENT_DTYPE table, modified in place
+        motion_profile (dict): motion_profile section of config.yml
+        rate_hz (float): sample rate in samples/s
+    """
+    accel = np.array([motion_profile["acceleration_m_per_s2"][a] for a in AXES])
+    v_max = np.array([motion_profile["max_velocity_m_per_s"][a] for a in AXES])
+    move = segments["end"] - segments["start"]
+    length = np.linalg.norm(move, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # limit along the move of each axis' limit, inf for axes not moving
+        share = np.abs(move) / length[:, np.newaxis]
+        segments["accel"] = np.nan_to_num(
+            np.min(np.where(share > 0, accel / share, np.inf), axis=1), posinf=0.0
+        )
+        segments["v_max"] = np.nan_to_num(
+            np.min(np.where(share > 0, v_max / share, np.inf), axis=1), posinf=0.0
+        )
+    total = profile_timing(length, segments["accel"], segments["v_max"])[2]
+    segments["dt"] = 1 / rate_hz
+    # samples at t = 0, dt, ... up to the end of the move
+    segments["n_samples"] = np.floor(total * rate_hz + 1e-9).astype(np.int64) + 1
+
+
+def build_scan_path(scan_setup=None, motion_profile=None, rate_hz=None):
+    """The scan path of config.yml, with the motion of motion_profile.mode:
+    constant_velocity (the default) or trapezoidal"""
+    if motion_profile is None:
+        motion_profile = MOTION_PROFILE
+    mode = motion_profile.get("mode", "constant_velocity")
+    if mode == "constant_velocity":
+        return build_constant_velocity_path(scan_setup, rate_hz)
+    if mode == "trapezoidal":
+        return build_trapezoidal_path(scan_setup, motion_profile, rate_hz)
+    raise ValueError(
+        f"motion mode must be constant_velocity or trapezoidal, not {mode}"
+    )
+
+
+def configured_duration(path, scan_setup=None):
+    """Duration of the path according to scan_setup.durations_s"""
+    if scan_setup is None:
+        scan_setup = SCAN_SETUP
+    durations = scan_setup["durations_s"]
+    kinds = path.segments["kind"]
+    return float(
+        np.count_nonzero(kinds == Y_SWEEP) * durations["y_scan"]
+        + np.count_nonzero(kinds == Z_STEP) * durations["z_scan"]
+        + np.count_nonzero(kinds == X_STEP) * durations["x_scan"]
+    )
+
+
+def print_timing(path, scan_setup=None):
+    """Prints the true duration and sample count of a path against the
+    scan_setup.durations_s it was configured with"""
+    configured = configured_duration(path, scan_setup)
+    print(
+        f"Scan takes {path.duration:,.1f} s ({configured:,.1f} s configured "
+        f"in durations_s), {len(path):,} samples in {len(path.segments)} segments"
+    )
+    kinds = path.segments["kind"]
+    durations = path.durations()
+    for name, kind in SEGMENT_KINDS.items():
+        if np.any(kinds == kind):
+            times = durations[kinds == kind]
+            print(f"  {name}: {times.min():.2f} - {times.max():.2f} s per move")
+
+
+def _raster_segments(scan_setup, rate_hz=None):
+    """Segment table of scan_setup.program, or of the default raster scan if
+    the config has none, see scan_program.py. Without rate_hz the sample
+    counts are placeholders, e.g. for apply_motion_profile() to set."""
+    program = scan_setup.get("program")
+    if program is None:
+        program = scan_program.raster_program(scan_setup)
+    return scan_program.compile_program(
+        program,
+        scan_setup["durations_s"],
+        rate_hz,
+        extent=scan_program.scan_extent(scan_setup),
+    )
+
+
+def load_scan_path(segments_filename=None, recorded_filename=None):
+    """Opens the recorded scan path without reading it into memory.
+
+    Prefers the compact segment table; falls back to a memory-mapped legacy
+    recorded_scan_path.npy.
+
+    Args:
+        segments_filename (str): segment table written by ScanPath.save()
+        recorded_filename (str): full (n, 3) path .npy file
+
+    Returns:
+        ScanPath, np.memmap or storage.StoredArray: (n, 3) array-like path
+    """
+    if segments_filename is None:
+        segments_filename = FILES["scan_path_segments"]
+    if recorded_filename is None:
+        recorded_filename = FILES["recorded_scan_path"]
+    try:
+        return ScanPath.load(segments_filename)
+    except FileNotFoundError:
+        return storage.open_array(recorded_filename)
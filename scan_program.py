@@ -0,0 +1,264 @@
+"""
+Scan programs: the scan described as nested blocks of moves in config.yml,
+compiled to a scan_path segment table.
+
+A program is a list of steps, each one of
+
+    {move: {y: 0.3}, kind: y_sweep}     relative move, sampled
+    {goto: {z: 0.0}}                    reposition without sampling
+    {repeat: 10, body: [...]}           block run 10 times
+
+A move may give duration_s, otherwise it takes the scan_setup.durations_s
+entry of its kind (y_sweep: y_scan, z_step: z_scan, x_step: x_scan). A
+repeat block may also have
+
+    counter: plane | line     record the repetition number in the segments
+    serpentine: [y]           reverse moves along these axes on odd passes
+    between: [...]            steps run between repetitions, not after the last
+
+The default raster scan of config.yml is
+
+    program:
+      - repeat: *x_planes
+        counter: plane
+        body:
+          - repeat: *lines
+            counter: line
+            serpentine: [y]
+            body:
+              - {move: {y: *max_y}, kind: y_sweep}
+              - {move: {z: *step_z}, kind: z_step}
+          - {goto: {y: 0.0, z: 0.0}}
+        between:
+          - {move: {x: *step_x}, kind: x_step}
+
+The serpentine flips moves on odd passes of its own block, so every plane
+starts its first sweep in the positive direction; the goto at the end of a
+plane returns y as well as z to the start, which also brings the head back
+after an odd number of lines. compile_program() rejects programs that leave
+the scan_setup.dimensions_m volume or have moves shorter than one sample.
+
+Repeats are expanded with np.tile and the waypoints are a running sum of the
+moves, restarted at every goto, so compiling does no per-move Python work.
+Configs without a program get raster_program() built from scan_setup.
+"""
+
+import numpy as np
+
+import scan_path
+
+AXES = {"x": 0, "y": 1, "z": 2}
+
+# positions this far (in m) beyond the scan volume are rounding, not errors
+EXTENT_TOLERANCE = 1e-9
+
+# durations_s entry used by moves of each kind
+KIND_DURATIONS = {"y_sweep": "y_scan", "z_step": "z_scan", "x_step": "x_scan"}
+
+MOVE_DTYPE = np.dtype(
+    [
+        ("delta", "<f8", (3,)),
+        ("goto", "<f8", (3,)),  # NaN for axes a goto leaves alone
+        ("is_goto", "?"),
+        ("kind", "i1"),
+        ("plane", "<i4"),
+        ("line", "<i4"),
+        ("duration", "<f8"),
+    ]
+)
+
+
+def raster_program(scan_setup):
+    """The back and forth raster scan of scan_setup as a program"""
+    return [
+        {
+            "repeat": scan_setup["repetitions"]["x_axis"],
+            "counter": "plane",
+            "body": [
+                {
+                    "repeat": scan_setup["repetitions"]["z_steps_per_plane"],
+                    "counter": "line",
+                    "serpentine": ["y"],
+                    "body": [
+                        {
+                            "move": {"y": scan_setup["dimensions_m"]["max_y"]},
+                            "kind": "y_sweep",
+                        },
+                        {
+                            "move": {"z": scan_setup["step_sizes_m"]["z"]},
+                            "kind": "z_step",
+                        },
+                    ],
+                },
+                {"goto": {"y": 0.0, "z": 0.0}},
+            ],
+            "between": [
+                {"move": {"x": scan_setup["step_sizes_m"]["x"]}, "kind": "x_step"}
+            ],
+        }
+    ]
+
+
+def _vector(axes):
+    vector = np.full(3, np.nan)
+    for axis, value in axes.items():
+        vector[AXES[axis]] = value
+    return vector
+
+
+def _step(step, durations):
+    """Move table of a single move or goto"""
+    row = np.zeros(1, dtype=MOVE_DTYPE)
+    row["plane"] = row["line"] = -1
+    row["goto"] = np.nan
+    if "goto" in step:
+        row["is_goto"] = True
+        row["goto"] = _vector(step["goto"])
+        row["kind"] = -1
+        return row
+    kind = step.get("kind")
+    row["delta"] = np.nan_to_num(_vector(step["move"]))
+    row["kind"] = scan_path.SEGMENT_KINDS.get(kind, -1)
+    if "duration_s" in step:
+        row["duration"] = step["duration_s"]
+    elif kind in KIND_DURATIONS:
+        row["duration"] = durations[KIND_DURATIONS[kind]]
+    else:
+        raise ValueError(f"move {step} needs a duration_s or a known kind")
+    return row
+
+
+def _block(steps, durations):
+    """Move table of a list of steps"""
+    tables = [_compile(step, durations) for step in steps]
+    return np.concatenate(tables) if tables else np.zeros(0, dtype=MOVE_DTYPE)
+
+
+def _compile(step, durations):
+    if "repeat" not in step:
+        return _step(step, durations)
+    n = int(step["repeat"])
+    body = _block(step["body"], durations)
+    between = _block(step.get("between", []), durations)
+    unit = np.concatenate([body, between])
+    table = np.tile(unit, n)
+    if len(between):
+        table = table[: len(table) - len(between)]
+    passes = np.repeat(np.arange(n), len(unit))[: len(table)]
+    counter = step.get("counter")
+    if counter is not None:
+        if counter not in ("plane", "line"):
+            raise ValueError(f"counter must be plane or line, not {counter}")
+        unset = table[counter] == -1
+        table[counter][unset] = passes[unset]
+    for axis in step.get("serpentine", []):
+        table["delta"][:, AXES[axis]] *= np.where(passes % 2, -1.0, 1.0)
+    return table
+
+
+def compile_moves(program, durations):
+    """Expands a program into its table of moves and gotos.
+
+    Args:
+        program (list): steps, see the module docstring
+        durations (dict): scan_setup.durations_s
+
+    Returns:
+        np.ndarray: MOVE_DTYPE table in execution order
+    """
+    return _block(program, durations)
+
+
+def waypoints(moves, start=None):
+    """Position after every move or goto.
+
+    The running sum is taken axis by axis and restarted at every goto of
+    that axis, adding the moves in order so the positions are the same
+    floats as stepping through the moves one by one.
+
+    Args:
+        moves (np.ndarray): MOVE_DTYPE table
+        start: (3,) position before the first move, the origin by default
+
+    Returns:
+        np.ndarray: (len(moves) + 1, 3) positions, starting with start
+    """
+    if start is None:
+        start = np.zeros(3)
+    positions = np.empty((len(moves) + 1, 3))
+    for axis in range(3):
+        goto = moves["goto"][:, axis]
+        # blocks of positions starting at the start and after every goto
+        starts = np.concatenate(([0], np.flatnonzero(~np.isnan(goto)) + 1))
+        stops = np.append(starts[1:], len(moves) + 1)
+        for a, b in zip(starts, stops):
+            value = start[axis] if a == 0 else goto[a - 1]
+            deltas = moves["delta"][a : b - 1, axis]
+            positions[a:b, axis] = np.cumsum(np.concatenate(([value], deltas)))
+    return positions
+
+
+def scan_extent(scan_setup):
+    """(3,) size of the scan volume of scan_setup.dimensions_m in m"""
+    dimensions = scan_setup["dimensions_m"]
+    return np.array([dimensions[f"max_{axis}"] for axis in AXES])
+
+
+def compile_program(program, durations, rate_hz, start=None, extent=None):
+    """Compiles a program to a scan_path segment table.
+
+    Args:
+        program (list): steps, see the module docstring
+        durations (dict): scan_setup.durations_s
+        rate_hz (float): sample rate in samples/s, None for the geometry
+            only, with one placeholder sample per move
+        start: (3,) position before the first move
+        extent: (3,) size of the scan volume, see scan_extent(); every
+            position must lie between start and start + extent
+
+    Returns:
+        np.ndarray: scan_path.SEGMENT_DTYPE table of the sampled moves, with
+        int(rate_hz * duration) samples each
+
+    Raises:
+        ValueError: if a position leaves the scan volume or a move is
+            shorter than one sample
+    """
+    moves = compile_moves(program, durations)
+    positions = waypoints(moves, start)
+    if extent is not None:
+        origin = np.zeros(3) if start is None else np.asarray(start)
+        relative = positions - origin
+        outside = np.any(
+            (relative < -EXTENT_TOLERANCE) | (relative > extent + EXTENT_TOLERANCE),
+            axis=1,
+        )
+        if np.any(outside):
+            # positions[0] is the start, inside by definition
+            i = int(np.argmax(outside))
+            raise ValueError(
+                f"step {i - 1} of the scan program reaches {relative[i]}, outside "
+                f"the scan volume {extent} of scan_setup.dimensions_m"
+            )
+    sampled = np.flatnonzero(~moves["is_goto"])
+    segments = np.zeros(len(sampled), dtype=scan_path.SEGMENT_DTYPE)
+    segments["start"] = positions[sampled]
+    segments["end"] = positions[sampled + 1]
+    for name in ("kind", "plane", "line"):
+        segments[name] = moves[name][sampled]
+    segments["direction"] = np.sign(np.sum(segments["end"] - segments["start"], axis=1))
+    if rate_hz is None:
+        segments["n_samples"] = 1
+        return segments
+    segments["n_samples"] = (rate_hz * moves["duration"][sampled]).astype(np.int64)
+    empty = np.flatnonzero(segments["n_samples"] < 1)
+    if len(empty):
+        g = empty[0]
+        raise ValueError(
+            f"{len(empty)} moves of the scan program are shorter than one sample "
+            f"at {rate_hz} Hz, the first is move {g} of "
+            f"{moves['duration'][sampled[g]]} s; lengthen them or merge them "
+            "into a neighbouring move"
+        )
+    segments["dt"] = 1 / rate_hz
+    return segments
@@ -0,0 +1,332 @@
+"""
+Deduplication of coincident sensor lines across the sensor head.
+
+Every sensor traces each linear segment of the scan path shifted by its
+offset. With the default 5 mm sensor pitch along z and 30 mm Z steps, the
+top sensors of one Y sweep run along exactly the same line as the bottom
+sensors of the next sweep, in the opposite direction. Those samples are the
+same field values, in reverse order.
+
+SegmentDedup canonicalises every (segment, sensor) pair by its offset start
+and end point, rounded to a resolution, and its sample count, and keeps the
+first pair seen for each line. compute_sensor_head_dedup() only evaluates the
+source for those and fills every duplicate by copying, or reversing, the
+samples of its first occurrence. Sensors with different orientations never
+share samples.
+
+The copied samples are positioned on the first occurrence's line, whose
+coordinates can differ from the duplicate's by up to the resolution (an ulp
+or so for the configured offsets). Away from the source that changes the
+field by a relative 1e-12 or so, but on a sphere surface it can flip a
+sample between inside and outside, so lines that come within the resolution
+of a surface of the source are never shared. Dedup is off by default
+(processing.dedup_segments), its outputs are not bit-identical to a full
+evaluation. Segments with a trapezoidal motion profile only share samples
+with lines run in the same direction under the same profile.
+"""
+
+import time
+
+import numpy as np
+
+import bfield_engine
+import checkpoint
+import field_map
+import field_stats
+import sensor_head
+from config import PROCESSING
+
+
+class SegmentDedup:
+    """First occurrence of the line every sensor follows along every segment.
+
+    Args:
+        segments (np.ndarray): scan_path.SEGMENT_DTYPE table of the path
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets
+        rotations (Rotation): optional per-sensor orientations
+        resolution (float): coordinates closer than this (in m) are treated
+            as equal, defaults to processing.dedup_resolution_m in config.yml
+        source: magpylib source (or field map) the lines are evaluated on,
+            lines within resolution of one of its sphere surfaces are not
+            shared
+
+    Attributes:
+        segment (np.ndarray): (n_segments, n_sensors) segment of the first
+            occurrence of each line
+        sensor (np.ndarray): (n_segments, n_sensors) sensor of the first
+            occurrence
+        reversed (np.ndarray): (n_segments, n_sensors) True where the line is
+            run in the opposite direction to its first occurrence
+        unique (np.ndarray): (n_segments, n_sensors) True for the first
+            occurrences, which are evaluated
+    """
+
+    def __init__(self, segments, offsets, rotations=None, resolution=None, source=None):
+        if resolution is None:
+            resolution = PROCESSING["dedup_resolution_m"]
+        n_segments, n_sensors = len(segments), len(offsets)
+        surfaces = [] if source is None else field_map._sphere_surfaces(source)
+        on_surface = _near_surfaces(
+            segments["start"][:, np.newaxis] + offsets,
+            segments["end"][:, np.newaxis] + offsets,
+            surfaces,
+            resolution,
+        )
+        starts = np.rint((segments["start"][:, np.newaxis] + offsets) / resolution)
+        ends = np.rint((segments["end"][:, np.newaxis] + offsets) / resolution)
+        starts, ends = starts.astype(np.int64), ends.astype(np.int64)
+        # a trapezoidal profile run backwards is not sampled at the same
+        # points, those lines only match in the same direction
+        profiled = segments["accel"] > 0
+        profiles = [
+            tuple(p) for p in zip(segments["accel"], segments["v_max"], segments["dt"])
+        ]
+        if rotations is None:
+            orientations = [()] * n_sensors
+        else:
+            orientations = [tuple(q) for q in np.round(rotations.as_quat(), 12)]
+
+        self.segment = np.empty((n_segments, n_sensors), dtype=np.int64)
+        self.sensor = np.empty((n_segments, n_sensors), dtype=np.int64)
+        self.reversed = np.zeros((n_segments, n_sensors), dtype=bool)
+        first = {}
+        for g in range(n_segments):
+            n = int(segments["n_samples"][g])
+            for s in range(n_sensors):
+                a, b = tuple(starts[g, s]), tuple(ends[g, s])
+                backwards = b < a and not profiled[g]
+                line = (b, a) if backwards else (a, b)
+                key = line + (n, orientations[s], profiles[g])
+                if on_surface[g, s]:
+                    # samples either side of the surface must not be shared
+                    key += (g, s)
+                g0, s0, backwards0 = first.setdefault(key, (g, s, backwards))
+                self.segment[g, s] = g0
+                self.sensor[g, s] = s0
+                self.reversed[g, s] = backwards != backwards0 and a != b
+        self.unique = (self.segment == np.arange(n_segments)[:, np.newaxis]) & (
+            self.sensor == np.arange(n_sensors)
+        )
+        self.n_samples = segments["n_samples"]
+
+    @property
+    def ratio(self):
+        """Sensor samples per evaluated sensor sample"""
+        total = self.n_samples.sum() * self.unique.shape[1]
+        return total / (self.n_samples[:, np.newaxis] * self.unique).sum()
+
+
+def _near_surfaces(starts, ends, surfaces, reach):
+    """True for the lines from starts to ends that come within reach of the
+    surface of one of the (centre, radius) spheres"""
+    near = np.zeros(starts.shape[:-1], dtype=bool)
+    direction = ends - starts
+    length2 = (direction**2).sum(axis=-1)
+    for centre, radius in surfaces:
+        to_centre = np.asarray(centre, dtype=float) - starts
+        along = (to_centre * direction).sum(axis=-1)
+        t = np.clip(
+            np.divide(along, length2, out=np.zeros_like(along), where=length2 > 0), 0, 1
+        )
+        closest = np.sqrt(
+            ((to_centre - t[..., np.newaxis] * direction) ** 2).sum(axis=-1)
+        )
+        farthest = np.sqrt(
+            np.maximum(
+                (to_centre**2).sum(axis=-1), ((to_centre - direction) ** 2).sum(axis=-1)
+            )
+        )
+        near |= (closest <= radius + reach) & (farthest >= radius - reach)
+    return near
+
+
+def _as_index(sensors):
+    """A slice for a contiguous run of sensors, which is cheaper to index
+    with, otherwise the sensor numbers"""
+    if len(sensors) and sensors[-1] - sensors[0] == len(sensors) - 1:
+        return slice(int(sensors[0]), int(sensors[-1]) + 1)
+    return sensors
+
+
+def _rows(outputs, B, chunk_start, sensor, start, stop):
+    """Samples [start, stop) of a sensor, from its output file before
+    chunk_start and from the chunk being assembled after it"""
+    split = min(max(start, chunk_start), stop)
+    parts = []
+    if split > start:
+        parts.append(outputs[sensor].read(start, split))
+    if stop > split:
+        parts.append(B[split - chunk_start : stop - chunk_start, sensor])
+    return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+
+def evaluate_chunk(
+    source, points, positions, start, offsets, outputs, dedup, matrices=None
+):
+    """B-field of every sensor along a chunk of the path, evaluating only the
+    first occurrence of each line.
+
+    Duplicates are copied from the chunk itself or read back from outputs,
+    which must hold every sample before start.
+
+    Args:
+        source: magpylib source (or collection) providing getB()
+        points (scan_path.ScanPath): the path
+        positions (np.ndarray): (n, 3) positions of samples [start, start + n)
+        start (int): first sample of the chunk
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets
+        outputs (list): storage.OutputArray of each sensor
+        dedup (SegmentDedup): plan of the path and sensor head
+        matrices (np.ndarray): optional (n_sensors, 3, 3) sensor orientations
+
+    Returns:
+        tuple: (n, n_sensors, 3) B-field, the number of sensor samples
+        evaluated and the seconds spent evaluating them
+    """
+    stop = start + len(positions)
+    n_sensors = len(offsets)
+    segments = points.segments
+    B = np.empty((stop - start, n_sensors, 3))
+    parts = []
+    for g in range(points.segment_of(start), points.segment_of(stop - 1) + 1):
+        a = max(start, segments["offset"][g])
+        b = min(stop, segments["offset"][g] + segments["n_samples"][g])
+        sensors = np.flatnonzero(dedup.unique[g])
+        parts.append((g, a, b, _as_index(sensors), len(sensors)))
+
+    # first occurrences of this chunk in a single getB() call
+    evaluate_start = time.time()
+    observers = np.empty((stop - start) * n_sensors * 3)
+    i = 0
+    for g, a, b, sensors, count in parts:
+        block = observers[i : i + (b - a) * count * 3]
+        np.add(
+            positions[a - start : b - start, np.newaxis],
+            offsets[sensors],
+            out=block.reshape(b - a, count, 3),
+        )
+        i += len(block)
+    observers = observers[:i].reshape(-1, 3)
+    values = source.getB(observers) if len(observers) else observers
+    i = 0
+    for g, a, b, sensors, count in parts:
+        block = values[i : i + (b - a) * count].reshape(b - a, count, 3)
+        i += (b - a) * count
+        if matrices is not None:
+            block = np.einsum("sji,nsj->nsi", matrices[sensors], block)
+        B[a - start : b - start, sensors] = block
+    evaluate_time = time.time() - evaluate_start
+
+    # duplicates copy (or reverse) their first occurrence
+    for g, a, b, sensors, count in parts:
+        for s in np.flatnonzero(~dedup.unique[g]):
+            g0, s0 = dedup.segment[g, s], dedup.sensor[g, s]
+            k0 = a - segments["offset"][g]
+            k1 = b - segments["offset"][g]
+            offset0 = segments["offset"][g0]
+            if dedup.reversed[g, s]:
+                n = segments["n_samples"][g]
+                rows = _rows(outputs, B, start, s0, offset0 + n - k1, offset0 + n - k0)
+                B[a - start : b - start, s] = rows[::-1]
+            else:
+                rows = _rows(outputs, B, start, s0, offset0 + k0, offset0 + k1)
+                B[a - start : b - start, s] = rows
+    return B, len(values), evaluate_time
+
+
+def compute_sensor_head_dedup(
+    source,
+    points,
+    filenames,
+    offsets,
+    rotations=None,
+    chunk_samples=None,
+    precision=None,
+    dedup=None,
+    journal_key=None,
+):
+    """Computes the B-field of all sensors, evaluating each line only once.
+
+    Takes the arguments of sensor_head.compute_sensor_head_chunked(), points
+    must be a scan_path.ScanPath.
+
+    Args:
+        dedup (SegmentDedup): precomputed plan, built from points if None
+        journal_key: identity of the run to journal progress under, see
+            sensor_head.compute_sensor_head_chunked()
+
+    Returns:
+        dict: samples computed (those of a resumed run only), evaluated
+        samples, dedup ratio, evaluation time and the estimated evaluation
+        time saved
+    """
+    if chunk_samples is None:
+        chunk_samples = PROCESSING["chunk_samples"]
+    if dedup is None:
+        dedup = SegmentDedup(points.segments, offsets, rotations, source=source)
+    n_sensors = len(offsets)
+    if len(filenames) != n_sensors:
+        raise ValueError("one output filename is needed per sensor")
+    matrices = None if rotations is None else rotations.as_matrix()
+    n_samples = len(points)
+    path_chunk = max(chunk_samples // n_sensors, 1)
+    if journal_key is not None:
+        journal_key = {"run": journal_key, "path_chunk": path_chunk, "dedup": True}
+    outputs, journal = checkpoint.open_outputs(
+        filenames,
+        lambda: sensor_head.create_outputs(
+            source, points, filenames, offsets, rotations, precision
+        ),
+        journal_key,
+    )
+    stats = [field_stats.FieldStats(n_samples) for filename in filenames]
+    computed, evaluated, evaluate_time = 0, 0, 0.0
+
+    for start, stop in bfield_engine.chunk_ranges(n_samples, path_chunk):
+        if journal is not None and journal.is_done(start, stop):
+            checkpoint.restore_stats(stats, outputs, start, stop)
+            continue
+        computed += (stop - start) * n_sensors
+        B, n_evaluated, seconds = evaluate_chunk(
+            source,
+            points,
+            points.positions(start, stop),
+            start,
+            offsets,
+            outputs,
+            dedup,
+            matrices,
+        )
+        evaluated += n_evaluated
+        evaluate_time += seconds
+        for sensor, output in enumerate(outputs):
+            stats[sensor].update(start, output.write(start, B[:, sensor]))
+        if journal is not None:
+            journal.record(start, stop, outputs)
+    for output in outputs:
+        output.close()
+    for filename, sensor_stats in zip(filenames, stats):
+        sensor_stats.save(filename)
+    if journal is not None:
+        journal.finish()
+
+    rate = evaluated / evaluate_time if evaluate_time > 0 else float("inf")
+    return {
+        "samples": computed,
+        "evaluated": evaluated,
+        "ratio": computed / evaluated if evaluated else float("inf"),
+        "evaluate_s": evaluate_time,
+        "saved_s": (computed - evaluated) / rate,
+    }
+
+
+def print_report(report):
+    """Prints the dedup report returned by compute_sensor_head_dedup()"""
+    print(
+        f"evaluated {report['evaluated']:,} of {report['samples']:,} sensor samples, "
+        f"dedup ratio {report['ratio']:.3f}"
+    )
+    print(
+        f"source evaluation {report['evaluate_s']:.2f} s, "
+        f"~{report['saved_s']:.2f} s saved by copying duplicates"
+    )
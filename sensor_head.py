@@ -0,0 +1,207 @@
+"""
+Batched B-field evaluation of every sensor in a rigid sensor head.
+
+Each sensor sits at a fixed 3D offset from the scan path and may be rotated
+relative to the scan axes. Per chunk of the path all sensor positions are
+built by broadcasting the (n, 1, 3) path points against the (1, n_sensors, 3)
+offsets and evaluated with a single getB() call, so the path is read once and
+no per-sensor copy of it is ever made.
+
+Offsets in config.yml are either a scalar (an offset along z, as used by the
+default 8 sensor array) or a full [x, y, z] vector. Optional per-sensor
+orientations are given as rotation vectors in degrees:
+
+    system_parameters:
+      sensor_offsets: [0.0, [0.005, 0, 0.005]]
+      sensor_orientations_deg: [[0, 0, 0], [0, 0, 90]]
+"""
+
+import os
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+import bfield_engine
+import checkpoint
+import field_stats
+import storage
+from config import PROCESSING, SYSTEM_PARAMETERS
+
+
+def sensor_offsets(system_parameters=None):
+    """Offsets of each sensor from the scan path.
+
+    Args:
+        system_parameters (dict): system_parameters section of config.yml
+
+    Returns:
+        np.ndarray: (n_sensors, 3) offsets in m
+    """
+    if system_parameters is None:
+        system_parameters = SYSTEM_PARAMETERS
+    offsets = []
+    for offset in system_parameters["sensor_offsets"]:
+        if np.ndim(offset) == 0:
+            offset = [0, 0, offset]
+        if len(offset) != 3:
+            raise ValueError(f"sensor offset {offset} must be a scalar or [x, y, z]")
+        offsets.append(offset)
+    return np.array(offsets, dtype=np.float64)
+
+
+def sensor_rotations(system_parameters=None):
+    """Orientation of each sensor relative to the scan axes.
+
+    Args:
+        system_parameters (dict): system_parameters section of config.yml
+
+    Returns:
+        scipy.spatial.transform.Rotation or None: one rotation per sensor,
+        None when every sensor is aligned with the scan axes
+    """
+    if system_parameters is None:
+        system_parameters = SYSTEM_PARAMETERS
+    rotvecs = system_parameters.get("sensor_orientations_deg")
+    if rotvecs is None:
+        return None
+    if len(rotvecs) != len(system_parameters["sensor_offsets"]):
+        raise ValueError("sensor_orientations_deg needs one entry per sensor offset")
+    rotvecs = np.array(rotvecs, dtype=np.float64)
+    if not rotvecs.any():
+        return None
+    return R.from_rotvec(rotvecs, degrees=True)
+
+
+def sensor_filename(output_dir, offset):
+    """Output .npy filename for the sensor at offset.
+
+    Sensors offset only along z keep the B-field_zoff_<mm>.npy name.
+
+    Args:
+        output_dir (str): directory of the B-field files
+        offset (np.ndarray): (3,) sensor offset in m
+
+    Returns:
+        str: filename
+    """
+    x_tag, y_tag, z_tag = (int(value * 1000) for value in offset)
+    if offset[0] == 0 and offset[1] == 0:
+        return f"{output_dir}/B-field_zoff_{z_tag}.npy"
+    return f"{output_dir}/B-field_off_{x_tag}_{y_tag}_{z_tag}.npy"
+
+
+def compute_sensor_head(source, points, offsets, rotations=None):
+    """B-field seen by every sensor of the head along a chunk of the path.
+
+    Args:
+        source: magpylib source (or collection) providing getB()
+        points (np.ndarray): (n, 3) path positions
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets
+        rotations (Rotation): optional per-sensor orientations, the field is
+            returned in each sensor's own frame
+
+    Returns:
+        np.ndarray: (n, n_sensors, 3) B-field
+    """
+    observers = points[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+    B = source.getB(observers.reshape(-1, 3)).reshape(observers.shape)
+    if rotations is not None:
+        # rotate from scan axes into each sensor frame: B_local = R^T B
+        B = np.einsum("sji,nsj->nsi", rotations.as_matrix(), B)
+    return B
+
+
+def create_outputs(source, points, filenames, offsets, rotations=None, precision=None):
+    """Creates the output file of every sensor in the storage precision.
+
+    Integer precisions get a full scale per sensor and component, estimated
+    from a probe of the path.
+
+    Returns:
+        list: storage.OutputArray per sensor
+    """
+    full_scales = [None] * len(filenames)
+    if storage.is_integer(precision):
+        full_scale = storage.estimate_full_scale(
+            lambda chunk: compute_sensor_head(source, chunk, offsets, rotations),
+            points,
+        )
+        full_scales = np.broadcast_to(full_scale, (len(filenames), 3))
+    return [
+        storage.OutputArray.create(filename, len(points), precision, full_scale)
+        for filename, full_scale in zip(filenames, full_scales)
+    ]
+
+
+def compute_sensor_head_chunked(
+    source,
+    points,
+    filenames,
+    offsets,
+    rotations=None,
+    chunk_samples=None,
+    precision=None,
+    journal_key=None,
+):
+    """Computes the B-field of all sensors in one pass over the path.
+
+    Args:
+        source: magpylib source (or collection) providing getB()
+        points: (n, 3) array-like path supporting len() and slicing, e.g. a
+            scan_path.ScanPath
+        filenames (list): one output .npy filename per sensor
+        offsets (np.ndarray): (n_sensors, 3) sensor offsets
+        rotations (Rotation): optional per-sensor orientations
+        chunk_samples (int): observer positions per getB() call, defaults to
+            processing.chunk_samples in config.yml. The path is walked in
+            chunks of chunk_samples // n_sensors samples.
+        precision (str): storage precision of the outputs, defaults to
+            processing.storage_precision in config.yml, see storage.py
+        journal_key: JSON-able identity of the run, progress is journaled
+            under it and an interrupted run of the same key resumed, see
+            checkpoint.py. None keeps no journal.
+
+    Returns:
+        int: number of samples written per sensor
+    """
+    if chunk_samples is None:
+        chunk_samples = PROCESSING["chunk_samples"]
+    n_sensors = len(offsets)
+    if len(filenames) != n_sensors:
+        raise ValueError("one output filename is needed per sensor")
+    n_samples = len(points)
+    path_chunk = max(chunk_samples // n_sensors, 1)
+    if journal_key is not None:
+        journal_key = {"run": journal_key, "path_chunk": path_chunk}
+    outputs, journal = checkpoint.open_outputs(
+        filenames,
+        lambda: create_outputs(
+            source, points, filenames, offsets, rotations, precision
+        ),
+        journal_key,
+    )
+    stats = [field_stats.FieldStats(n_samples) for filename in filenames]
+    for start, stop in bfield_engine.chunk_ranges(n_samples, path_chunk):
+        if journal is not None and journal.is_done(start, stop):
+            checkpoint.restore_stats(stats, outputs, start, stop)
+            continue
+        B = compute_sensor_head(
+            source, np.asarray(points[start:stop]), offsets, rotations
+        )
+        for sensor, output in enumerate(outputs):
+            stats[sensor].update(start, output.write(start, B[:, sensor]))
+        if journal is not None:
+            journal.record(start, stop, outputs)
+    for output in outputs:
+        output.close()
+    for filename, sensor_stats in zip(filenames, stats):
+        sensor_stats.save(filename)
+    if journal is not None:
+        journal.finish()
+    return n_samples
+
+
+def output_filenames(offsets, output_dir):
+    """Output filenames for every sensor, creating output_dir if needed"""
+    os.makedirs(output_dir, exist_ok=True)
+    return [sensor_filename(output_dir, offset) for offset in offsets]
@@ -4,6 +4,7 @@ import numpy as np
 import magpylib as magpy
 
 from config import SIMULATION_OBJECTS
+from field_volume import FieldVolume
 
 
 def create():
@@ -85,35 +86,29 @@ def create_streamplot(P1, P2, B, plane="xy"):
 
 if __name__ == "__main__":
 
-    # Create an observer grid in the xz-symmetry plane
-    ts = np.linspace(-5, 5, 40)
-    grid_xz = np.array([[(x, 0, z) for x in ts] for z in ts])
-    Xxz, _, Zxz = np.moveaxis(grid_xz, 2, 0)
-
-    # Create an observer grid in the xy-symmetry plane
-    ts = np.linspace(-5, 5, 40)
-    grid_xy = np.array([[(x, y, 0) for x in ts] for y in ts])
-    Xxy, Yxy, _ = np.moveaxis(grid_xy, 2, 0)
-
-    # Create an observer grid in the yz-symmetry plane
-    ts = np.linspace(-5, 5, 40)
-    grid_yz = np.array([[(0, y, z) for y in ts] for z in ts])
-    _, Yyz, Zyz = np.moveaxis(grid_yz, 2, 0)
-
-    # Create an observer grid in the xyz volume
-    ts = np.linspace(-5, 5, 40)
-    grid_xyz = np.array([[[(x, y, z) for x in ts] for y in ts] for z in ts])
-
-    Bxz = compute_b_field(grid_xz)
-    Bxy = compute_b_field(grid_xy)
-    Byz = compute_b_field(grid_yz)
-
-    Bxyz = compute_b_field(grid_xyz)
+    # The xyz volume is evaluated lazily, tile by tile, only the tiles cut by
+    # the symmetry planes are computed for the streamplots
+    ts = np.linspace(-5, 5, 41)
+    volume = FieldVolume.from_bounds(create(), (-5, -5, -5), (5, 5, 5), len(ts))
+    P1, P2 = np.meshgrid(ts, ts)
+    centre = len(ts) // 2  # ts[centre] == 0
+
+    # Observer grids in the xz, xy and yz symmetry planes, rows along the
+    # second axis as the streamplot expects
+    Xxz, Zxz = P1, P2
+    Xxy, Yxy = P1, P2
+    Yyz, Zyz = P1, P2
+    Bxz = volume[:, centre, :].swapaxes(0, 1)
+    Bxy = volume[:, :, centre].swapaxes(0, 1)
+    Byz = volume[centre, :, :].swapaxes(0, 1)
 
     create_streamplot(Xxz, Zxz, Bxz, plane="xz")
     create_streamplot(Xxy, Yxy, Bxy, plane="xy")
     create_streamplot(Yyz, Zyz, Byz, plane="yz")
     plt.show()
+
+    # The maximum and the histogram need every tile of the volume
+    Bxyz = np.asarray(volume)
     print(f"Shape of Bxyz {Bxyz.shape}")
     magnitudes = np.linalg.norm(Bxyz, axis=3)
     max_magnitude = magnitudes.max()
@@ -0,0 +1,353 @@
+"""
+Storage precision of the intermediate (n, 3) .npy files.
+
+The B-field files and the recorded scan path can be stored as
+
+    float64  lossless, the default
+    float32  half the size, ~7 significant digits
+    int16    a quarter of the size, counts of a recorded scale factor
+    int32    half the size, counts of a recorded scale factor
+
+Integer files hold round(value / scale), with one scale per component
+recorded in a sidecar <root>.scale.json next to the .npy file. The scale maps
+a full-scale magnitude onto the integer limit; for B-field files the full
+scale is either configured (processing.storage_full_scale) or estimated per
+sensor and component from a strided probe of the path with
+processing.storage_headroom margin. The components of a sensor can differ
+by orders of magnitude, and the muxer scales each to the full ADC range, so a
+shared full scale would cost the small ones most of their resolution. Values
+beyond the full scale are clipped and counted.
+
+Every reduced-precision file also records the largest difference per
+component between the stored and the float64 values it was written from,
+i.e. the quantisation error against a float64 run. write_muxed_data.py
+reports it in ADC counts.
+
+open_array() opens any of them read-only and returns float64 values when
+sliced, so readers do not need to know how a file was stored.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from config import PROCESSING
+
+PRECISIONS = {
+    "float64": np.float64,
+    "float32": np.float32,
+    "int16": np.int16,
+    "int32": np.int32,
+}
+
+
+def scale_filename(filename):
+    """Sidecar filename holding the scale of an integer .npy file"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}.scale.json"
+
+
+def storage_dtype(precision=None):
+    """numpy dtype of a storage precision name, defaults to
+    processing.storage_precision in config.yml"""
+    if precision is None:
+        precision = PROCESSING["storage_precision"]
+    try:
+        return np.dtype(PRECISIONS[precision])
+    except KeyError:
+        raise ValueError(
+            f"storage precision must be one of {', '.join(PRECISIONS)}, not {precision}"
+        ) from None
+
+
+def is_integer(precision=None):
+    """True if values are stored as scaled integer counts"""
+    return storage_dtype(precision).kind == "i"
+
+
+class QuantisationError:
+    """Largest error per component introduced by storing values in reduced
+    precision, kept as lists so it can be saved as JSON"""
+
+    def __init__(self):
+        self.max_error = [0.0] * 3
+        self.max_value = [0.0] * 3
+        self.clipped = 0
+
+    def update(self, values, stored, clipped=0):
+        """Accounts for (n, 3) float64 values and their stored (dequantised)
+        copy"""
+        if len(values) == 0:
+            return
+        error = np.abs(stored - values).max(axis=0)
+        self.max_error = np.maximum(self.max_error, error).tolist()
+        self.max_value = np.maximum(self.max_value, np.abs(values).max(axis=0)).tolist()
+        self.clipped += int(clipped)
+
+    def merge(self, other):
+        """Combines errors gathered over another part of the same array"""
+        self.max_error = np.maximum(self.max_error, other.max_error).tolist()
+        self.max_value = np.maximum(self.max_value, other.max_value).tolist()
+        self.clipped += other.clipped
+
+
+def read_info(filename):
+    """Storage details recorded for a .npy file.
+
+    Returns:
+        dict or None: precision, scale and quantisation error, None for
+        files without a sidecar (float64 or written before this existed).
+        Files written before the scale was kept per component hold a single
+        scale and error.
+    """
+    try:
+        with open(scale_filename(filename)) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def component_scale(scale):
+    """(3,) scale of every component from a recorded scale, which is a
+    single value in older sidecars"""
+    return np.broadcast_to(np.asarray(scale, dtype=np.float64), (3,))
+
+
+def write_info(filename, scale, error=None):
+    """Records the (3,) scale (None for float files) and quantisation error
+    of a .npy file in its sidecar"""
+    raw = np.load(filename, mmap_mode="r")
+    if scale is not None:
+        scale = component_scale(scale).tolist()
+    info = {"precision": raw.dtype.name, "scale": scale}
+    del raw
+    if error is not None:
+        info.update(
+            max_quantisation_error=error.max_error,
+            max_abs_value=error.max_value,
+            clipped=error.clipped,
+        )
+    # replaced rather than rewritten, it may be linked into the run cache
+    tmp = f"{scale_filename(filename)}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(info, fh, indent=2)
+    os.replace(tmp, scale_filename(filename))
+
+
+class StoredArray:
+    """Read-only float64 view of an integer .npy file and its scale.
+
+    Slicing returns np.ndarray values in the original units, like slicing a
+    float64 memmap of the same data would.
+
+    Args:
+        filename (str): int16 or int32 .npy file
+        scale: value of one count of each component, (3,) or a scalar
+    """
+
+    dtype = np.dtype(np.float64)
+
+    def __init__(self, filename, scale):
+        self.filename = filename
+        self.scale = component_scale(scale)
+        self.raw = np.load(filename, mmap_mode="r")
+        # the scale of every element, indexed like the values
+        self._scales = np.broadcast_to(self.scale, self.raw.shape)
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    @property
+    def ndim(self):
+        return self.raw.ndim
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        return self.raw[key] * self._scales[key]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.raw * self.scale
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+
+def open_array(filename):
+    """Opens an intermediate .npy file of any storage precision read-only.
+
+    Args:
+        filename (str): (n, 3) .npy file
+
+    Returns:
+        np.memmap or StoredArray: float files are memory-mapped as they are,
+        integer files are wrapped with their recorded scale
+    """
+    raw = np.load(filename, mmap_mode="r")
+    if raw.dtype.kind != "i":
+        return raw
+    info = read_info(filename)
+    if info is None or info.get("scale") is None:
+        raise ValueError(f"{filename} stores integers but has no scale sidecar")
+    return StoredArray(filename, info["scale"])
+
+
+def estimate_full_scale(field, points, n_probe=None, headroom=None):
+    """Magnitude each component of an integer file should be able to hold.
+
+    The field is evaluated on n_probe samples spread evenly along the path.
+
+    Args:
+        field: callable mapping (m, 3) positions to (m, ..., 3) field values,
+            e.g. (m, n_sensors, 3) for a sensor head
+        points: (n, 3) array-like path supporting fancy indexing
+        n_probe (int): samples evaluated, defaults to
+            processing.storage_probe_samples in config.yml
+        headroom (float): factor applied to the largest magnitude seen,
+            defaults to processing.storage_headroom in config.yml
+
+    Returns:
+        np.ndarray or float: (..., 3) full-scale magnitude of every
+        component, the configured processing.storage_full_scale of all of
+        them if set
+    """
+    if PROCESSING["storage_full_scale"] is not None:
+        return float(PROCESSING["storage_full_scale"])
+    if n_probe is None:
+        n_probe = PROCESSING["storage_probe_samples"]
+    if headroom is None:
+        headroom = PROCESSING["storage_headroom"]
+    probe = np.unique(np.linspace(0, len(points) - 1, n_probe).astype(np.int64))
+    peak = np.abs(field(np.asarray(points[probe]))).max(axis=0)
+    return np.where(peak > 0, headroom * peak, 1.0)
+
+
+class OutputArray:
+    """Preallocated (n, 3) .npy output written in a storage precision.
+
+    Use create() to make a new file and open() to write into one created
+    elsewhere, e.g. by a worker process.
+
+    Args:
+        filename (str): .npy file
+        raw (np.memmap): writable map of the stored values
+        scale: value of one count of each component, None for float files
+    """
+
+    def __init__(self, filename, raw, scale=None):
+        self.filename = filename
+        self.raw = raw
+        self.scale = None if scale is None else component_scale(scale)
+        self.error = QuantisationError()
+        if raw.dtype.kind == "i":
+            self.limit = np.iinfo(raw.dtype).max
+            if scale is None:
+                raise ValueError("integer storage needs a scale")
+
+    @classmethod
+    def create(cls, filename, n_samples, precision=None, full_scale=None):
+        """Creates filename and its scale sidecar.
+
+        Args:
+            filename (str): .npy file to create
+            n_samples (int): number of rows
+            precision (str): storage precision, defaults to
+                processing.storage_precision in config.yml
+            full_scale: magnitude mapped onto the integer limit, (3,) one
+                per component or a scalar, required for integer precisions
+
+        Returns:
+            OutputArray: the writable output
+        """
+        dtype = storage_dtype(precision)
+        scale = None
+        if dtype.kind == "i":
+            if full_scale is None:
+                raise ValueError(f"{dtype.name} storage needs a full scale")
+            scale = component_scale(full_scale) / np.iinfo(dtype).max
+        if os.path.exists(filename):
+            # a new file, never written through a link into the run cache
+            os.remove(filename)
+        raw = np.lib.format.open_memmap(
+            filename, mode="w+", dtype=dtype, shape=(n_samples, 3)
+        )
+        output = cls(filename, raw, scale)
+        if dtype != np.float64:
+            write_info(filename, scale)
+        elif os.path.exists(scale_filename(filename)):
+            os.remove(scale_filename(filename))
+        return output
+
+    @classmethod
+    def open(cls, filename):
+        """Opens an existing output for writing, with its recorded scale"""
+        raw = np.load(filename, mmap_mode="r+")
+        info = read_info(filename) if raw.dtype.kind == "i" else None
+        return cls(filename, raw, info["scale"] if info else None)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def write(self, start, values):
+        """Stores float64 values into rows [start, start + len(values)).
+
+        Returns:
+            np.ndarray: the values as they will be read back
+        """
+        stop = start + len(values)
+        if self.scale is None:
+            self.raw[start:stop] = values
+            stored = self.raw[start:stop]
+            if self.raw.dtype != np.float64:
+                stored = stored.astype(np.float64)
+                self.error.update(values, stored)
+            return stored
+        counts = np.rint(values / self.scale)
+        clipped = np.count_nonzero(np.abs(counts) > self.limit)
+        np.clip(counts, -self.limit, self.limit, out=counts)
+        self.raw[start:stop] = counts
+        stored = counts * self.scale
+        self.error.update(values, stored, clipped)
+        return stored
+
+    def read(self, start, stop):
+        """Rows [start, stop) as float64 values, as they will be read back"""
+        values = self.raw[start:stop]
+        if self.scale is None:
+            return np.asarray(values, dtype=np.float64)
+        return values * self.scale
+
+    def flush(self):
+        """Writes pending changes to disk"""
+        self.raw.flush()
+
+    def close(self, error=None):
+        """Flushes the data and records the quantisation error.
+
+        Args:
+            error (QuantisationError): error of the whole file when it was
+                written by several OutputArrays, defaults to this one's
+        """
+        self.raw.flush()
+        self.raw = None
+        if error is None:
+            error = self.error
+        if os.path.exists(scale_filename(self.filename)):
+            write_info(self.filename, self.scale, error)
+
+
+def print_summary(filenames):
+    """Prints the storage precision, size and quantisation error of files"""
+    for filename in filenames:
+        info = read_info(filename) or {"precision": "float64"}
+        size = os.path.getsize(filename)
+        line = f"{filename}: {info['precision']}, {size / 1e6:,.1f} MB"
+        if "max_quantisation_error" in info:
+            errors = np.broadcast_to(info["max_quantisation_error"], (3,))
+            line += ", max quantisation error " + " ".join(
+                f"{axis} {error:.3g}" for axis, error in zip("xyz", errors)
+            )
+            if info["clipped"]:
+                line += f", {info['clipped']:,} values CLIPPED"
+        print(line)
@@ -1,3 +1,5 @@
+import time
+
 import tokamak_sim_setup
 import numpy as np
 import magpylib as magpy
@@ -17,45 +19,31 @@ B_field_new = tokamak.getB(sensor)
 print(f"Magnetic field at new position {sensor.position} m: B = {B_field_new} T")
 print(f"Field magnitude: {np.linalg.norm(B_field_new):.2f} T")
 
-sensor.position = (-2, -2, -2)
-# Do it in a loop
-results = {}
+# scan a cartesian grid in batched getB() calls
 grid_density = 10  # grid_density**3 = x * y * z points
+axis = np.linspace(-2, 2, grid_density)
+print(f"\n--- Scanning a {grid_density}^3 cartesian grid ---")
+start = time.time()
+scan = tokamak_sim_setup.scan_grid(tokamak, axis, axis, axis)
+print(f"{scan.magnitude.size:,} points in {time.time() - start:.2f} s")
+print(f"B at {scan.points[0, 0, 0]} m: {scan.B[0, 0, 0]} T")
+print(f"max |B| {scan.magnitude.max():.3f} T")
+
+# cylindrical (R, phi, Z) grid through the coils
+r = np.linspace(1.2, 2.8, grid_density)
+phi = np.linspace(0, 360, 4 * grid_density, endpoint=False)
+z = np.linspace(-0.3, 0.3, grid_density)
+print(f"\n--- Scanning a {len(r)}x{len(phi)}x{len(z)} (R, phi, Z) grid ---")
+start = time.time()
+scan = tokamak_sim_setup.scan_grid(tokamak, r, phi, z, cylindrical=True)
+print(f"{scan.magnitude.size:,} points in {time.time() - start:.2f} s")
+B_cyl = tokamak_sim_setup.cylindrical_components(scan.points, scan.B)
+mid_r, mid_z = len(r) // 2, len(z) // 2
+print(f"B_phi around the torus at R={r[mid_r]:.2f} m, Z={z[mid_z]:.2f} m:")
+print(B_cyl[mid_r, :, mid_z, 1])
 
-
-fig = magpy.show(tokamak, sensor, backend="plotly")
-
-for x in np.linspace(-2, 2, grid_density):
-    print(f"x={x}")
-    sensor.position = (x / grid_density, sensor.position[1], sensor.position[2])
-    for y in np.linspace(-2, 2, grid_density):
-        sensor.position = (sensor.position[0], y / grid_density, sensor.position[2])
-        for z in np.linspace(-2, 2, grid_density):
-            # move sensor and re-measure
-            # print("\n--- Moving sensor to a new position ---")
-            sensor.position = (
-                sensor.position[0],
-                sensor.position[1],
-                z / grid_density,
-            )  # Move it slightly off-center
-            sensor.position = (
-                sensor.position[0],
-                sensor.position[1],
-                sensor.position[2] + z / grid_density,
-            )  # Move it slightly off-center
-            B_field_new = tokamak.getB(sensor)
-            results[tuple([x, y, z])] = B_field_new
-            # print(f"Magnetic field at new position {sensor.position} m: B = {B_field_new} T")
-            # print(f"Field magnitude: {np.linalg.norm(B_field_new):.2f} T")
-            print(sensor.position)
 # visualize the simulation ⚛️
 # display the collection of magnets and the sensor's location
 fig = magpy.show(tokamak, sensor, backend="plotly")
 
-magnitude_results = []
-for x in results.values():
-    magnitude_results.append(np.sqrt(x.dot(x)))
-
-fig = magpy.show(tokamak, sensor, backend="plotly")
-
 # TODO: how to display sensor movement?
@@ -1,13 +1,26 @@
 """
 Writes simulation data to a file format that matches the ACQ400 data format.
 
-Simulation data is scaled here to use the full dynamic range available to 
+Simulation data is scaled here to use the full dynamic range available to
 the AI module selected.
+
+The muxer memory-maps its inputs and streams records to disk in blocks, both
+the with_position_ and no_position_ layouts are written in the same pass.
 """
 
+import argparse
+import os
+import time
+
 import numpy as np
-from config import FILES, SAMPLING, SCAN_SETUP, SYSTEM_PARAMETERS
+from config import FILES, PROCESSING, SAMPLING, SCAN_SETUP, SYSTEM_PARAMETERS
+import bfield_engine
+import checkpoint
 import data_writer
+import field_stats
+import run_cache
+import scan_path
+import storage
 
 
 def calculate_n_samples(n_yscans, n_xscans=0, n_zscans=0, sample_rate=10000):
@@ -31,12 +44,10 @@ def _n_samples_to_elapsed_usec(sample_rate, n_samples):
     return useconds
 
 
-def _find_optimum_gain(arr):
-    """Finds optimum gain for array data by using maximum value of array
-    and dynamic range of selected ADC"""
+def _gain_from_range(m, n):
+    """Optimum gain for data with maximum m and minimum n given the
+    dynamic range of selected ADC"""
     dynamic_range_bits = SAMPLING["dynamic_range_bits"]
-    m = arr.max()
-    n = arr.min()
     dynamic_range = 2**dynamic_range_bits
     pos_range = dynamic_range // 2
     neg_range = -1 * dynamic_range // 2
@@ -48,106 +59,412 @@ def _find_optimum_gain(arr):
         return gain2
 
 
+def _find_optimum_gain(arr):
+    """Finds optimum gain for array data by using maximum value of array
+    and dynamic range of selected ADC"""
+    return _gain_from_range(arr.max(), arr.min())
+
+
+def _sensor_gains(mins, maxs):
+    """Gains of the X, Y, Z and T channels of one sensor from its B-field
+    component ranges. T duplicates X."""
+    gains = [_gain_from_range(maxs[i], mins[i]) for i in range(3)]
+    return gains + [gains[0]]
+
+
 def _convert_m_to_ticks(a):
-    # plucked this conversion factor out of thin air
-    return a * 10000
+    return a * data_writer.TICKS_PER_M
+
+
+def _fill_records(result, selections, gains, positions, a, b, n_samples, elapsed_usec):
+    """Fills result with records [a, b) of an n_samples long acquisition.
+
+    Args:
+        result (np.ndarray): structured array of b - a records
+        selections (list): (b - a, 3) B-field block per sensor
+        gains (list): 4 channel gains per sensor
+        positions (np.ndarray): (b - a, 3) scan path block in m
+        a (int): first record
+        b (int): one past the last record
+        n_samples (int): total number of records in the acquisition
+        elapsed_usec (float): acquisition time of the last record
+    """
+    for sensor_number, (selection, gain) in enumerate(zip(selections, gains), 1):
+        result[f"S{sensor_number}X"] = selection[:, 0] * gain[0]
+        result[f"S{sensor_number}Y"] = selection[:, 1] * gain[1]
+        result[f"S{sensor_number}Z"] = selection[:, 2] * gain[2]
+        result[f"S{sensor_number}T"] = selection[:, 0] * gain[3]
+
+    # Check if all required fields exist in the result array's dtype
+    if all(field in result.dtype.names for field in ["XPOS", "YPOS", "ZPOS"]):
+        result["XPOS"] = _convert_m_to_ticks(positions[:, 0])
+        result["YPOS"] = _convert_m_to_ticks(positions[:, 1])
+        result["ZPOS"] = _convert_m_to_ticks(positions[:, 2])
+
+    # slices of np.linspace(0, n_samples, n_samples) etc, identical to
+    # computing the whole acquisition at once
+    result["CNT"] = scan_path.linspace_slice(0, n_samples, n_samples, a, b)
+    result["USEC"] = scan_path.linspace_slice(0, elapsed_usec, n_samples, a, b)
+
+    # USR value: 3 words of padding to round out the sample to 96 bytes
+    # Default values 0x2222,0x3333,0x5555, helpful to check alignment
+    # It’s also possible to inject other values here.
+
+    result["USR1"] = 0x2222
+    result["USR2"] = 0x3333
+    result["USR3"] = 0x5555
+
+
+def mux_records(dtype, selections, gains, positions, a, b, n_samples):
+    """Records [a, b) of an n_samples long acquisition, see _fill_records().
+
+    Args:
+        dtype (np.dtype): record layout, see output_layouts()
+        selections (list): (b - a, 3) B-field block per sensor
+        gains (list): 4 channel gains per sensor
+        positions (np.ndarray): (b - a, 3) scan path block in m
+        a (int): first record
+        b (int): one past the last record
+        n_samples (int): total number of records in the acquisition
+
+    Returns:
+        np.ndarray: b - a records
+    """
+    result = np.empty(b - a, dtype=dtype)
+    elapsed_usec = _n_samples_to_elapsed_usec(10000, n_samples)
+    _fill_records(result, selections, gains, positions, a, b, n_samples, elapsed_usec)
+    return result
+
+
+def _storage_counts(filename, a, gain):
+    """Largest quantisation error of an integer input in ADC counts of its
+    X, Y and Z channels: the error recorded while writing it, or half a
+    count of its scale for files that do not record one"""
+    info = storage.read_info(filename) or {}
+    error = info.get("max_quantisation_error")
+    if error is None:
+        error = a.scale / 2
+    return np.broadcast_to(error, (3,)) * np.abs(gain[:3])
+
+
+def range_gains(mins, maxs):
+    """Gains of every sensor from its (n_sensors, 3) B-field component
+    minimums and maximums over the records"""
+    return [_sensor_gains(lo, hi) for lo, hi in zip(mins, maxs)]
 
 
 def create_full_data_array(
-    input_files_list, scan_path_filename, n_samples, generated_dtype
+    input_files_list, sampled_points, n_samples, generated_dtype
 ):
     """Creates data array ready to be written to binary file format.
 
     This includes the positions (if selected), sample counts and SPAD values.
+    The whole result is held in memory, use write_muxed_files() to stream
+    large acquisitions to disk.
 
     Args:
-        input_files_list (list): stuff
-        scan_path_filename (str): path
+        input_files_list (list): B-field .npy file per sensor
+        sampled_points: (n, 3) scan path, e.g. a scan_path.ScanPath, or the
+            filename of a recorded_scan_path.npy
         n_samples (int): number of samples
         generated_dtype (str): numpy dtype defining data format
     """
-
-    scan_path = np.load(scan_path_filename)
-    scan_path_selection = scan_path[0:n_samples, :]
+    if isinstance(sampled_points, str):
+        sampled_points = storage.open_array(sampled_points)
+    scan_path_selection = np.asarray(sampled_points[0:n_samples, :])
     elapsed_usec = _n_samples_to_elapsed_usec(10000, n_samples)
-    print(scan_path_selection.shape)
 
     result = np.zeros(n_samples, dtype=generated_dtype)
     print(f"shape of result is {result.shape} and dtype is {result.dtype}")
-    sensor_number = 1
+    selections = []
+    gains = []
     for filename in input_files_list:
-        a = np.load(filename)
-        print(a.shape)
-        selection = a[0:n_samples, :]
-        print(selection.shape)
-
-        gain0 = _find_optimum_gain(selection[:, 0])
-        gain1 = _find_optimum_gain(selection[:, 1])
-        gain2 = _find_optimum_gain(selection[:, 2])
-        gain3 = _find_optimum_gain(selection[:, 0])
-        result[f"S{sensor_number}X"] = selection[:, 0] * gain0
-        result[f"S{sensor_number}Y"] = selection[:, 1] * gain1
-        result[f"S{sensor_number}Z"] = selection[:, 2] * gain2
-        result[f"S{sensor_number}T"] = selection[:, 0] * gain3
-        sensor_number += 1
+        selection = np.asarray(storage.open_array(filename)[0:n_samples, :])
+        selections.append(selection)
+        gains.append(_sensor_gains(selection.min(axis=0), selection.max(axis=0)))
 
-    # Check if all required fields exist in the result array's dtype
-    if all(field in result.dtype.names for field in ["XPOS", "YPOS", "ZPOS"]):
-        result["XPOS"] = _convert_m_to_ticks(scan_path_selection[:, 0])
-        print(scan_path_selection[:, 0])
-        print(scan_path_selection[:, 0].shape)
+    _fill_records(
+        result,
+        selections,
+        gains,
+        scan_path_selection,
+        0,
+        n_samples,
+        n_samples,
+        elapsed_usec,
+    )
+    return result
 
-        result["YPOS"] = _convert_m_to_ticks(scan_path_selection[:, 1])
-        print(scan_path_selection[:, 1])
-        print(scan_path_selection[:, 1].shape)
 
-        result["ZPOS"] = _convert_m_to_ticks(scan_path_selection[:, 2])
-        print(scan_path_selection[:, 2])
-        print(scan_path_selection[:, 2].shape)
+def configured_records():
+    """Number of records muxed for the scan_counts of config.yml"""
+    return calculate_n_samples(
+        n_yscans=SCAN_SETUP["scan_counts"]["y"],
+        n_xscans=SCAN_SETUP["scan_counts"]["x"],
+        n_zscans=SCAN_SETUP["scan_counts"]["z"],
+        sample_rate=SAMPLING["rate_hz"],
+    )
 
-    result["CNT"] = np.linspace(0, n_samples, n_samples)
-    result["USEC"] = np.linspace(0, elapsed_usec, n_samples)
 
-    # USR value: 3 words of padding to round out the sample to 96 bytes
-    # Default values 0x2222,0x3333,0x5555, helpful to check alignment
-    # It’s also possible to inject other values here.
+def output_layouts(output_dir=None, n_sensors=None):
+    """Muxed output files and their record dtypes, with and without the
+    scan positions.
+
+    Args:
+        output_dir (str): directory of the files, defaults to
+            files.output_dir in config.yml
+        n_sensors (int): sensors per record, defaults to
+            system_parameters.sensor_count in config.yml
+
+    Returns:
+        dict: output filename -> structured dtype of its records
+    """
+    if output_dir is None:
+        output_dir = FILES["output_dir"]
+    if n_sensors is None:
+        n_sensors = SYSTEM_PARAMETERS["sensor_count"]
+    return {
+        f"{output_dir}/with_position_{FILES['output_muxed_result']}": np.dtype(
+            data_writer.n_sensors_dtype_generator(n_sensors)
+        ),
+        f"{output_dir}/no_position_{FILES['output_muxed_result']}": np.dtype(
+            data_writer.n_sensors_dtype_generator(n_sensors, position_included=False)
+        ),
+    }
+
+
+def save_indexes(sampled_points, n_samples, filenames):
+    """Writes the scan-structure index of the records next to every muxed
+    file, for seeking by plane and line"""
+    if not isinstance(sampled_points, scan_path.ScanPath):
+        return
+    index = sampled_points.index(n_samples)
+    for filename in filenames:
+        scan_path.save_index(index, scan_path.index_filename(filename))
+
+
+def input_gains(input_files_list, n_samples, inputs=None):
+    """Gains of every input over its first n_samples rows, chosen from the
+    statistics sidecars without reading the data (legacy inputs get one
+    statistics pass)"""
+    if inputs is None:
+        inputs = [storage.open_array(filename) for filename in input_files_list]
+    return [
+        _sensor_gains(
+            *field_stats.load_or_compute(filename, a).prefix_range(n_samples, a)
+        )
+        for filename, a in zip(input_files_list, inputs)
+    ]
+
+
+def write_muxed_files(
+    input_files_list,
+    sampled_points,
+    n_samples,
+    output_dtypes,
+    block_samples=None,
+    journal_key=None,
+    gains=None,
+):
+    """Streams muxed ACQ400 records of every output layout to disk together.
+
+    The B-field inputs are memory-mapped and walked once in record-aligned
+    blocks, so memory is bounded by the block size rather than the
+    acquisition length. Gains are chosen from the statistics sidecar of each
+    input without reading the data (legacy inputs get one statistics pass).
+
+    Args:
+        input_files_list (list): B-field .npy file per sensor
+        sampled_points: (n, 3) scan path, e.g. a scan_path.ScanPath, or the
+            filename of a recorded_scan_path.npy
+        n_samples (int): number of records to write
+        output_dtypes (dict): output filename -> structured dtype of its
+            records, e.g. with and without position
+        block_samples (int): records per block, defaults to
+            processing.mux_block_samples in config.yml
+        journal_key: JSON-able identity of the run, the records written are
+            journaled under it and an interrupted run of the same key
+            resumed after its last complete block, see checkpoint.py
+        gains (list): 4 channel gains per input, see input_gains() for the
+            default
+
+    Returns:
+        dict: bytes moved and time spent reading, muxing and writing
+    """
+    if block_samples is None:
+        block_samples = PROCESSING["mux_block_samples"]
+    if isinstance(sampled_points, str):
+        sampled_points = storage.open_array(sampled_points)
+    # inputs of any storage precision read back as float64, see storage.py
+    inputs = [storage.open_array(filename) for filename in input_files_list]
+    for filename, a in zip(input_files_list, inputs):
+        if len(a) < n_samples:
+            raise ValueError(f"{filename} holds {len(a)} samples, {n_samples} needed")
+    elapsed_usec = _n_samples_to_elapsed_usec(10000, n_samples)
+    # bytes of one row of every input as stored on disk
+    row_bytes = sum(3 * getattr(a, "raw", a).itemsize for a in inputs)
+
+    stats = {"gain_s": 0.0, "read_s": 0.0, "mux_s": 0.0, "write_s": 0.0}
+    stats.update(read_bytes=0, write_bytes=0)
+
+    t = time.time()
+    if gains is None:
+        gains = input_gains(input_files_list, n_samples, inputs)
+    stats["gain_s"] = time.time() - t
+    for filename, a, gain in zip(input_files_list, inputs, gains):
+        print(f"{filename} gains {gain}")
+        if isinstance(a, storage.StoredArray):
+            counts = _storage_counts(filename, a, gain)
+            print(
+                "  storage quantisation up to "
+                + " ".join(f"{axis} {n:.2f}" for axis, n in zip("XYZ", counts))
+                + " ADC counts"
+            )
+            if counts.max() > 0.5:
+                print(
+                    "  WARNING: storage is coarser than the ADC, the records "
+                    "differ from a float64 run; use int32 or float32"
+                )
+
+    blocks = {
+        filename: np.empty(block_samples, dtype=dtype)
+        for filename, dtype in output_dtypes.items()
+    }
+    filenames = list(output_dtypes)
+    journal = None
+    if journal_key is not None:
+        journal_key = {"run": journal_key, "block_samples": block_samples}
+        journal = checkpoint.Journal.load(filenames, journal_key)
+    if journal is None:
+        files = {filename: open(filename, "wb") for filename in filenames}
+        if journal_key is not None:
+            journal = checkpoint.Journal.create(filenames, journal_key)
+    else:
+        # records are written in order, drop any past the last complete block
+        gaps = journal.missing(0, n_samples)
+        done = gaps[0][0] if gaps else n_samples
+        print(f"Resuming {filenames[0]}: {done:,} of {n_samples:,} records done")
+        files = {filename: open(filename, "r+b") for filename in filenames}
+        for filename, fh in files.items():
+            fh.truncate(done * output_dtypes[filename].itemsize)
+            fh.seek(0, os.SEEK_END)
+    try:
+        for a, b in bfield_engine.chunk_ranges(n_samples, block_samples):
+            if journal is not None and journal.is_done(a, b):
+                continue
+            t = time.time()
+            selections = [np.array(inp[a:b]) for inp in inputs]
+            positions = np.asarray(sampled_points[a:b])
+            stats["read_bytes"] += (b - a) * row_bytes
+            stats["read_s"] += time.time() - t
+
+            for filename, block in blocks.items():
+                t = time.time()
+                result = block[: b - a]
+                _fill_records(
+                    result, selections, gains, positions, a, b, n_samples, elapsed_usec
+                )
+                stats["mux_s"] += time.time() - t
+
+                t = time.time()
+                result.tofile(files[filename])
+                stats["write_bytes"] += result.nbytes
+                stats["write_s"] += time.time() - t
+            if journal is not None:
+                journal.record(a, b, files.values())
+    finally:
+        for fh in files.values():
+            fh.close()
+    if journal is not None:
+        journal.finish()
+    return stats
+
+
+def print_throughput(stats):
+    """Prints MB/s of each muxing phase to tell disk from CPU limits"""
+
+    def rate(n_bytes, seconds):
+        return n_bytes / 1e6 / seconds if seconds > 0 else float("inf")
+
+    total_s = stats["gain_s"] + stats["read_s"] + stats["mux_s"] + stats["write_s"]
+    print(f"gain selection: {stats['gain_s']:.2f} s")
+    print(
+        f"read:  {stats['read_bytes'] / 1e6:,.1f} MB in {stats['read_s']:.2f} s "
+        f"({rate(stats['read_bytes'], stats['read_s']):,.1f} MB/s)"
+    )
+    print(
+        f"mux:   {stats['mux_s']:.2f} s "
+        f"({rate(stats['write_bytes'], stats['mux_s']):,.1f} MB/s of records)"
+    )
+    print(
+        f"write: {stats['write_bytes'] / 1e6:,.1f} MB in {stats['write_s']:.2f} s "
+        f"({rate(stats['write_bytes'], stats['write_s']):,.1f} MB/s)"
+    )
+    print(
+        f"total: {total_s:.2f} s, "
+        f"{rate(stats['read_bytes'] + stats['write_bytes'], total_s):,.1f} MB/s moved"
+    )
 
-    result["USR1"] = np.ones(n_samples) * 0x2222
-    result["USR2"] = np.ones(n_samples) * 0x3333
-    result["USR3"] = np.ones(n_samples) * 0x5555
-    return result
 
 if __name__ == "__main__":
-    filename_list = FILES["input_list"]
-    scan_path_filename = FILES["recorded_scan_path"]
-    N_SENSORS = SYSTEM_PARAMETERS["sensor_count"]
-    N_XSCAN = SCAN_SETUP["scan_counts"]["x"]
-    N_YSCAN = SCAN_SETUP["scan_counts"]["y"]
-    N_ZSCAN = SCAN_SETUP["scan_counts"]["z"]
-    SAMPLE_RATE = SAMPLING["rate_hz"]
-
-    eight_sensors_with_position = data_writer.n_sensors_dtype_generator(N_SENSORS)
-    eight_sensors_no_position = data_writer.n_sensors_dtype_generator(
-        N_SENSORS, position_included=False
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--input-dir",
+        help="read the files.input_list B-field files from this directory, "
+        "e.g. one written by basis_fields.py",
     )
-    print(eight_sensors_with_position)
-    n_samples = calculate_n_samples(
-        n_yscans=N_YSCAN, n_xscans=N_XSCAN, n_zscans=N_ZSCAN, sample_rate=SAMPLE_RATE
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        default=PROCESSING["resume"],
+        help="start over instead of resuming an interrupted run, see checkpoint.py",
     )
+    args = parser.parse_args()
+    filename_list = FILES["input_list"]
+    if args.input_dir:
+        filename_list = [
+            os.path.join(args.input_dir, os.path.basename(f)) for f in filename_list
+        ]
+    sampled_points = scan_path.load_scan_path()
+    n_samples = configured_records()
 
-    result_with_position = create_full_data_array(
-        filename_list, scan_path_filename, n_samples, eight_sensors_with_position
+    # Both layouts are muxed in the same pass over the inputs
+    # to read this .bin back in you need to provide a dtype so numpy can interpret it
+    output_dtypes = output_layouts()
+    with_position_filename, no_position_filename = output_dtypes
+    print(output_dtypes[with_position_filename])
+    # records written are journaled, a rerun after a crash resumes the files
+    # as long as the inputs are unchanged
+    journal_key = run_cache.run_key(
+        "mux",
+        sampled_points,
+        options={
+            "inputs": [
+                [f, os.stat(f).st_size, os.stat(f).st_mtime_ns] for f in filename_list
+            ],
+            "n_samples": n_samples,
+            "outputs": {f: str(dtype) for f, dtype in output_dtypes.items()},
+        },
+    )
+    if not args.resume:
+        checkpoint.discard(list(output_dtypes))
+    stats = write_muxed_files(
+        filename_list,
+        sampled_points,
+        n_samples,
+        output_dtypes,
+        journal_key=journal_key,
     )
-    result_no_position = create_full_data_array(
-        filename_list, scan_path_filename, n_samples, eight_sensors_no_position
+    print(
+        f"Wrote {n_samples:,} records to {with_position_filename} and {no_position_filename}"
     )
+    print_throughput(stats)
+    save_indexes(sampled_points, n_samples, output_dtypes)
 
+    result_with_position = np.memmap(
+        with_position_filename, dtype=output_dtypes[with_position_filename], mode="r"
+    )
     print(result_with_position[0])
-    print(result_with_position[51234])
+    print(result_with_position[min(51234, n_samples - 1)])
     print(result_with_position[-1])
-
-    # np.save saves as an array format with a header so it can be read back in
-    # np.save("binary_data.bin",result)
-    result_with_position.tofile(FILES["output_dir"] + "/with_position_" + FILES["output_muxed_result"])
-    result_no_position.tofile(FILES["output_dir"] + "/no_position_" + FILES["output_muxed_result"])
-    # to read this .bin back in you need to provide a dtype so numpy can interpret it